@@ -0,0 +1,108 @@
+"""
+等待发原图期间, 每条频道消息在 bot_data 中占用的内存, 以及写 file_id 的开销
+对比 绑定在 session 上的 Image 与 写入数据库后的 ImageInfo
+
+用法: python -m benchmarks.pending_memory [每条消息的页数] [消息条数]
+"""
+import json
+import sys
+import timeit
+import tracemalloc
+from typing import Any, Callable
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db import Base
+from entities import Image, ImageInfo
+
+PAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+POSTS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+
+def fields(pid: int, page: int) -> dict[str, Any]:
+    # 与 pixiv 单页 json 大小相近
+    full_info = {
+        "urls": {
+            size: f"https://i.pximg.net/{size}/img/2024/01/01/00/00/00/{pid}_p{page}.jpg"
+            for size in ("mini", "thumb", "small", "regular", "original")
+        },
+        "width": 2894,
+        "height": 4093,
+        "tags": [{"tag": f"tag{i}", "translation": {"en": f"tag {i}"}} for i in range(12)],
+        "description": "x" * 600,
+    }
+    return dict(
+        userid=123456789,
+        username="nahida",
+        platform="pixiv",
+        title=f"artwork {pid}",
+        page=page,
+        filename=f"{pid}_p{page}.jpg",
+        author="author",
+        authorid=1234567,
+        pid=str(pid),
+        extension="jpg",
+        url_original_pic=full_info["urls"]["original"],
+        url_thumb_pic=full_info["urls"]["regular"],
+        r18=False,
+        width=2894,
+        height=4093,
+        full_info=json.dumps(full_info),
+        sent_message_link=f"https://t.me/channel/{pid}",
+        file_id_thumb="AgACAgUAAxkDAAIBY2Z" + "a" * 60,
+        file_hash="0" * 64,
+    )
+
+
+def measure(build: Callable[[], dict[int, list[Any]]]) -> tuple[int, dict[int, list[Any]]]:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    pending = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size, pending
+
+
+def main() -> None:
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    def orm() -> dict[int, list[Any]]:
+        # 原来的做法: get_images 中 session.add, 直到发完原图才 commit
+        pending: dict[int, list[Any]] = {}
+        for post in range(POSTS):
+            images = [Image(**fields(post, page)) for page in range(PAGES)]
+            session.add_all(images)
+            pending[post] = images
+        return pending
+
+    def dto() -> dict[int, list[Any]]:
+        # 现在的做法: 发送预览图后 save_images, 之后只保留 ImageInfo, 丢弃 full_info
+        pending: dict[int, list[Any]] = {}
+        for post in range(POSTS):
+            images = [ImageInfo(**fields(post, page)) for page in range(PAGES)]
+            for i, image in enumerate(images):
+                image.id = post * PAGES + i
+                image.full_info = None
+            pending[post] = images
+        return pending
+
+    orm_size, orm_pending = measure(orm)
+    dto_size, dto_pending = measure(dto)
+    print(f"{POSTS} 条待发原图, 每条 {PAGES} 页")
+    print(f"Image (session):  {orm_size / POSTS / 1024:7.1f} KB / 条")
+    print(f"ImageInfo:        {dto_size / POSTS / 1024:7.1f} KB / 条")
+
+    image = orm_pending[0][0]
+    info = dto_pending[0][0]
+    n = 100_000
+    orm_time = timeit.timeit(lambda: setattr(image, "file_id_original", "x"), number=n)
+    dto_time = timeit.timeit(lambda: setattr(info, "file_id_original", "x"), number=n)
+    print(f"写 file_id: Image {orm_time / n * 1e9:.0f} ns, ImageInfo {dto_time / n * 1e9:.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+import time
+
+# 统计导入耗时, 必须在其他 import 之前
+started_at = time.perf_counter()
+
 import datetime
 import os
 import logging
@@ -5,6 +10,8 @@ import logging
 from telegram import Update
 from telegram.ext import (
     Application,
+    BaseHandler,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     filters,
@@ -12,9 +19,9 @@ from telegram.ext import (
 )
 from config import config
 from commands import *
+from utils import bot_api_options
 
-if not os.path.exists(DefaultPlatform.base_downlad_path):
-    os.makedirs(DefaultPlatform.base_downlad_path)
+import_seconds = time.perf_counter() - started_at
 
 if config.debug:
     logging.basicConfig(
@@ -28,50 +35,88 @@ if config.debug:
 logger = logging.getLogger(__name__)
 
 # global application
-application = (
+builder = (
     Application.builder()
     .token(config.bot_token)
     .post_init(on_start)  # type: ignore
+    .post_stop(on_stop)  # type: ignore
     .read_timeout(60)
     .write_timeout(60)
     .connect_timeout(60)
-    .build()
+    .concurrent_updates(config.bot_concurrent_updates or False)
 )
+if options := bot_api_options():
+    # 自建 bot api server
+    builder = (
+        builder.base_url(options["base_url"])
+        .base_file_url(options["base_file_url"])
+        .local_mode(options["local_mode"])
+    )
+application = builder.build()
 
 # global bot
 bot = application.bot
 application.bot_data["last_msg"] = datetime.fromtimestamp(0)
 
+# handler 类型 -> 需要向 Telegram 订阅的 update 类型
+HANDLER_UPDATE_TYPES: dict[type[BaseHandler], list[str]] = {
+    CommandHandler: [Update.MESSAGE, Update.EDITED_MESSAGE],
+    MessageHandler: [Update.MESSAGE, Update.EDITED_MESSAGE],
+    InlineQueryHandler: [Update.INLINE_QUERY],
+    CallbackQueryHandler: [Update.CALLBACK_QUERY],
+}
 
-def main() -> None:
-    """Start the bot."""
-    # Create the Application and pass it your bot's token.
 
+def get_allowed_updates(app: Application) -> list[str]:
+    """
+    根据已注册的 handler 推导 allowed_updates, 不再拉取用不到的 update 类型
+    遇到未知的 handler 类型时退回 Update.ALL_TYPES
+    """
+    allowed: set[str] = set()
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            for handler_type, update_types in HANDLER_UPDATE_TYPES.items():
+                if isinstance(handler, handler_type):
+                    allowed.update(update_types)
+                    break
+            else:
+                logger.warning(f"未知的 handler 类型: {type(handler)}, 订阅全部 update")
+                return Update.ALL_TYPES
+    return sorted(allowed)
+
+
+def add_handlers(app: Application) -> None:
+    """注册全部 handler, 测试中也用它搭建 Application"""
     # on different commands - answer in Telegram
-    application.add_handler(CommandHandler("start", start, block=False))
-    application.add_handler(CommandHandler("ping", start, block=False))
-    application.add_handler(CommandHandler("random", random, block=False))
-    application.add_handler(CommandHandler("help", help_command, block=False))
-    application.add_handler(CommandHandler("post", post, block=False))
-    application.add_handler(CommandHandler("echo", echo, block=False))
-    # application.add_handler(CommandHandler("mark_dup", mark))
-    # application.add_handler(CommandHandler("unmark_dup", unmark))
-    # application.add_handler(CommandHandler("repost_orig", repost_orig))
-    application.add_handler(CommandHandler("set_commands", set_commands, block=False))
-    application.add_handler(CommandHandler("update", update))
-    application.add_handler(CommandHandler("get_admins", get_admins))
-    application.add_handler(
+    app.add_handler(CommandHandler("start", start, block=False))
+    app.add_handler(CommandHandler("ping", start, block=False))
+    app.add_handler(CommandHandler("random", random, block=False))
+    app.add_handler(CommandHandler("help", help_command, block=False))
+    app.add_handler(CommandHandler("post", post, block=False))
+    app.add_handler(CommandHandler("echo", echo, block=False))
+    # app.add_handler(CommandHandler("mark_dup", mark))
+    # app.add_handler(CommandHandler("unmark_dup", unmark))
+    # app.add_handler(CommandHandler("repost_orig", repost_orig))
+    app.add_handler(CommandHandler("set_commands", set_commands, block=False))
+    app.add_handler(CommandHandler("update", update))
+    app.add_handler(CommandHandler("get_admins", get_admins))
+    app.add_handler(CommandHandler("storage", storage_report, block=False))
+    app.add_handler(CommandHandler("stats", stats, block=False))
+    app.add_handler(CommandHandler("profile", profile_command, block=False))
+    app.add_handler(
         MessageHandler(
             filters.FORWARDED
-            & filters.PHOTO
+            # 动图以视频发到频道, 转发到评论区的也是视频
+            & (filters.PHOTO | filters.VIDEO)
             # & filters.ChatType.GROUPS
             & filters.User(777000),
             get_channel_post,
             block=False,
         )
     )
-    application.add_handler(CommandHandler("restart", restart))
-    application.add_handler(
+    app.add_handler(CommandHandler("restart", restart))
+    app.add_handler(CommandHandler("reload", reload))
+    app.add_handler(
         MessageHandler(
             # filters.TEXT &
             filters.ChatType.PRIVATE
@@ -80,11 +125,37 @@ def main() -> None:
             block=False,
         )
     )
-    application.add_handler(InlineQueryHandler(handle_inline_cmd, r'\/(post|echo).+',block=False))
-    application.add_handler(InlineQueryHandler(handle_inline_query,block=False))
+    app.add_handler(InlineQueryHandler(handle_inline_cmd, r'\/(post|echo).+',block=False))
+    app.add_handler(InlineQueryHandler(handle_inline_query,block=False))
+
+
+def main() -> None:
+    """Start the bot."""
+    # Create the Application and pass it your bot's token.
+
+    add_handlers(application)
+
+    application.bot_data["started_at"] = started_at
+    application.bot_data["import_seconds"] = import_seconds
+    logger.info(f"导入耗时 {import_seconds:.2f} 秒")
+
+    allowed_updates = get_allowed_updates(application)
+    logger.info(f"allowed_updates: {allowed_updates}")
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if config.bot_webhook_enabled:
+        # 本地监听, 由反向代理或 Telegram 直接推送 update
+        application.run_webhook(
+            listen=config.bot_webhook_listen,
+            port=config.bot_webhook_port,
+            url_path=config.bot_webhook_path,
+            webhook_url=config.bot_webhook_url or None,
+            secret_token=config.bot_webhook_secret_token or None,
+            allowed_updates=allowed_updates,
+            max_connections=config.bot_webhook_max_connections,
+        )
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":
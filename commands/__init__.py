@@ -2,12 +2,15 @@ import re
 import os
 import json
 import math
+import time
 import asyncio
+import functools
 import logging
 import datetime
 import subprocess
 
-from typing import Callable, Optional, Any
+from pathlib import Path
+from typing import Callable, Optional, Any, Sequence
 
 import telegram
 from telegram import (
@@ -21,6 +24,7 @@ from telegram import (
     Message,
     InputMediaDocument,
     InputMediaPhoto,
+    InputMediaVideo,
     User,
 )
 from telegram.ext import (
@@ -32,10 +36,41 @@ from uuid import uuid4
 from config import config
 from db import session
 from entities import *
-from platforms import *
+import platforms
 from utils import *
-
-DOWNLOADS: str = DefaultPlatform.base_downlad_path
+from utils.storage import storage_manager, compressed_path
+from utils.upload import is_url_fetch_error, url_upload_tracker
+from platforms.pixiv_tags import pixiv_tags
+from utils.watchdog import LoopWatchdog
+from utils.profiler import SamplingProfiler, ProfilerBusyError
+from utils.handover import Handover, handover, predecessor_pid
+from utils.jobs import job_queue
+from utils.dedup import posted_filter
+from utils.download import bandwidth
+from utils.ratelimit import ChatRateLimiter
+from utils.fairshare import ADMIN, GUEST, FairShare, Overloaded, charge, measure
+from utils.prefetch import download_cache, metadata_cache, prefetcher
+from utils.maintenance import database_maintenance
+from utils import routing
+from utils.urls import canonicalize
+
+loop_watchdog = LoopWatchdog(config.debug_loop_watchdog_threshold)
+# 从旧进程或 worker 接手的待发原图, 只恢复一次, 避免重复发送
+restored_originals: set[tuple[int, int]] = set()
+# 交给 worker 且尚未完成的任务
+job_waiters: set[asyncio.Future[tuple[str, dict[str, Any]]]] = set()
+# worker 任务进行中收到的、尚无待发原图的评论区转发, 任务完成后再回复原图
+early_forwards: dict[tuple[int, int], Message] = {}
+profiler = SamplingProfiler(config.debug_profile_interval)
+chat_limiter = ChatRateLimiter(config.bot_chat_rate_limit)
+fair_share = FairShare(
+    config.bot_fair_slots,
+    {ADMIN: config.bot_fair_admin_weight, GUEST: config.bot_fair_guest_weight},
+    {ADMIN: config.bot_fair_admin_per_user, GUEST: config.bot_fair_guest_per_user},
+    config.bot_fair_guest_byte_quota,
+    config.bot_fair_guest_byte_window,
+    config.bot_fair_guest_queue,
+)
 restart_data = os.path.join(os.getcwd(), "restart.json")
 
 logger = logging.getLogger(__name__)
@@ -110,18 +145,49 @@ async def help_command(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
 async def post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     处理post命令, 直接将投稿发至频道
+    带上 profile=1 时对本次发图做采样分析
     """
     message = update.message
     assert isinstance(message, Message)
+    assert message.from_user
     logging.debug(message.text)
 
+    async with fair_share.slot(message.from_user.id, ADMIN):
+        if not profile_requested(message):
+            if config.worker_enabled:
+                await dispatch_job("post", message, context)
+            else:
+                await post_artwork(message, context)
+            return
+        try:
+            _, path = await profiler.profile(post_artwork(message, context), "post")
+        except ProfilerBusyError as e:
+            await message.reply_text(f"{e}, 请主人稍后再试喵")
+            return
+    await reply_profile(message, path)
+
+
+def profile_requested(message: Message) -> bool:
+    try:
+        assert isinstance(message.text, str)
+        return prase_params(message.text.split()[2:]).profile
+    except Exception:
+        return False
+
+
+async def post_artwork(message: Message, context: ContextTypes.DEFAULT_TYPE) -> None:
     artwork_result = await get_artworks(message)
 
     if artwork_result.success:
         await message.reply_chat_action("upload_photo")
         assert isinstance(artwork_result.caption, str)
         artwork_result.caption += config.txt_msg_tail
-        artwork_result = await send_media_group(context, artwork_result)
+        try:
+            artwork_result = await send_media_group(context, artwork_result)
+        except Exception as e:
+            logger.error(e)
+            await message.reply_text("出错了呜呜呜，对不起主人喵，没能成功发送图片")
+            return
         if artwork_result.hint_msg:
             sent_channel_msg = artwork_result.sent_channel_msg
             assert sent_channel_msg
@@ -150,9 +216,10 @@ async def get_artworks(
 ) -> ArtworkResult:
     """
     post_mode 为 True 时, 发送到频道, 否则, 直接将消息返回给用户。
-    只有发送到频道时才会尝试去重。
+    只有发送到频道时才会尝试去重, 能由链接确定作品时, 在请求作品信息之前就去重。
     """
     artwork_result = ArtworkResult()
+    hint_msg = None
     try:
         assert isinstance(message.text, str)
         splited_msg = message.text.split()[1:]
@@ -163,33 +230,36 @@ async def get_artworks(
     except:
         artwork_result.feedback = "笨喵，哪里写错了？再检查一下呢？"
     else:
-        if ("pixiv" in post_url) or re.match(r"[1-9]\d*", post_url):
+        if prefetcher.use(post_url):
+            logger.info(f"命中预取: {post_url}")
+        if post_mode and config.bot_deduplication_mode:
+            if existing_image := check_duplication_via_url(post_url):
+                return ArtworkResult(False, duplicate_feedback(existing_image))
+        key = canonicalize(post_url)
+        platform = key.platform if key else None
+        if platform == "Pixiv":
             if instant_feedback:
                 hint_msg = await message.reply_text("正在获取 Pixiv 图片喵...")
-            artwork_result = await Pixiv.get_artworks(
+            artwork_result = await platforms.Pixiv.get_artworks(
                 post_url, artwork_param, user, post_mode
             )
-        elif "twitter" in post_url or "x.com" in post_url:
+        elif platform == "twitter":
             if instant_feedback:
                 hint_msg = await message.reply_text("正在获取 twitter 图片喵...")
-            post_url = post_url.replace("x.com", "twitter.com")
-            artwork_result = await Twitter.get_artworks(
-                post_url, artwork_param, user, post_mode
+            assert key
+            artwork_result = await platforms.Twitter.get_artworks(
+                key.url, artwork_param, user, post_mode
             )
-        elif (
-            "miyoushe.com" in post_url
-            or "bbs.mihoyo" in post_url
-            or "hoyolab" in post_url
-        ):
+        elif platform == "miyoushe":
             if instant_feedback:
                 hint_msg = await message.reply_text("正在获取米游社图片喵...")
-            artwork_result = await MiYouShe.get_artworks(
+            artwork_result = await platforms.MiYouShe.get_artworks(
                 post_url, artwork_param, user, post_mode
             )
-        elif "bilibili.com" in post_url:
+        elif platform == "bilibili":
             if instant_feedback:
                 hint_msg = await message.reply_text("正在获取 bilibili 图片喵...")
-            artwork_result = await bilibili.get_artworks(
+            artwork_result = await platforms.bilibili.get_artworks(
                 post_url, artwork_param, user, post_mode
             )
         else:
@@ -197,178 +267,488 @@ async def get_artworks(
                 hint_msg = await message.reply_text(
                     "检测到神秘的平台喵……\n咱正在试试能不能帮主人获取到，主人不要抱太大期望哦…"
                 )
-            artwork_result = await DefaultPlatform.get_artworks(
+            artwork_result = await platforms.DefaultPlatform.get_artworks(
                 post_url, artwork_param, user, post_mode
             )
             # artwork_result.feedback = "没有检测到支持的 URL 喵！主人是不是打错了喵！"
+        if artwork_result.success and artwork_result.images:
+            image = artwork_result.images[0]
+            if image.platform and image.pid:
+                # 同步的数据库写入放到线程中, 不阻塞其他 handler
+                await asyncio.to_thread(remember_url, post_url, image.platform, image.pid)
         if hint_msg:
             artwork_result.hint_msg = hint_msg
 
     return artwork_result
 
 
+async def get_input_media_photo(
+    artwork_result: ArtworkResult,
+    index: int,
+    has_spoiler: Optional[bool],
+    by_url: bool = True,
+) -> InputMediaPhoto | InputMediaVideo:
+    """
+    等待单页的预览图, 没有预览图时读取本地原图, 超出限制则压缩
+    by_url 为 True 时, 白名单 host 的预览图直接以 URL 发送
+    """
+    image: ImageInfo = artwork_result.images[index]
+    spoiler = has_spoiler if has_spoiler is not None else image.r18
+    if image.extension == "mp4":
+        # pixiv 动图
+        if image.file_id_thumb:
+            return InputMediaVideo(image.file_id_thumb, has_spoiler=spoiler)
+        file_path = await platforms.DefaultPlatform.ensure_original(image)
+        storage_manager.touch(file_path)
+        if config.bot_api_local_mode:
+            return InputMediaVideo(
+                Path(file_path), has_spoiler=spoiler, supports_streaming=True
+            )
+        with open(file_path, "rb") as f:
+            return InputMediaVideo(f, has_spoiler=spoiler, supports_streaming=True)
+    if image.file_id_thumb:
+        return InputMediaPhoto(image.file_id_thumb, has_spoiler=spoiler)
+    if by_url and platforms.DefaultPlatform.upload_by_url(image):
+        return InputMediaPhoto(image.url_thumb_pic, has_spoiler=spoiler)
+    preview: Optional[bytes] = None
+    if index < len(artwork_result.previews):
+        try:
+            preview = await artwork_result.previews[index]
+        except Exception as e:
+            logger.warning(f"获取预览图失败, 改用原图: {e}")
+    if not preview and url_upload_tracker.host_of(image.url_thumb_pic):
+        # 原本打算以 URL 发送, 没有提前下载预览图
+        try:
+            preview = await platforms.platform_class(image.platform).download_preview(image)
+        except Exception as e:
+            logger.warning(f"下载预览图失败, 改用原图: {e}")
+    if preview:
+        return InputMediaPhoto(preview, has_spoiler=spoiler)
+    file_path = await platforms.DefaultPlatform.ensure_original(image)
+    if not is_within_size_limit(file_path):
+        img_compressed = compressed_path(image)
+        if not os.path.exists(img_compressed):
+            compress_image(file_path, img_compressed)
+        file_path = img_compressed
+    storage_manager.touch(file_path)
+    if config.bot_api_local_mode:
+        # 只传本地路径, 由 bot api server 直接读取, 不读入本进程
+        return InputMediaPhoto(Path(file_path), has_spoiler=spoiler)
+    with open(file_path, "rb") as f:
+        return InputMediaPhoto(f, has_spoiler=spoiler)
+
+
+async def send_photo_group(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int | str,
+    artwork_result: ArtworkResult,
+    indexes: Sequence[int],
+    **kwargs: Any,
+) -> tuple[Message, ...]:
+    """
+    发送一组预览图, URL 模式被 telegram 拒绝时改为本地上传重发
+    """
+    has_spoiler = artwork_result.artwork_param.spoiler
+    media_group: list[InputMediaPhoto | InputMediaVideo] = await asyncio.gather(
+        *(get_input_media_photo(artwork_result, j, has_spoiler) for j in indexes)
+    )
+    logger.debug(media_group)
+    urls = [m.media for m in media_group if isinstance(m.media, str)]
+    urls = [url for url in urls if url_upload_tracker.host_of(url)]
+    await chat_limiter.acquire(chat_id, len(media_group))
+    try:
+        reply_msgs = await context.bot.send_media_group(chat_id, media_group, **kwargs)
+    except telegram.error.BadRequest as e:
+        if not urls or not is_url_fetch_error(e.message):
+            raise
+        logger.warning(f"telegram 无法从 URL 获取图片, 改为本地上传: {e}")
+        for url in urls:
+            url_upload_tracker.record(url, False)
+        media_group = await asyncio.gather(
+            *(
+                get_input_media_photo(artwork_result, j, has_spoiler, by_url=False)
+                for j in indexes
+            )
+        )
+        await chat_limiter.acquire(chat_id, len(media_group))
+        return await context.bot.send_media_group(chat_id, media_group, **kwargs)
+    for url in urls:
+        url_upload_tracker.record(url, True)
+    return reply_msgs
+
+
+def thumb_file_id(message: Message) -> Optional[str]:
+    if message.photo:
+        return message.photo[-1].file_id
+    if attachment := message.video or message.animation:
+        return attachment.file_id
+    return None
+
+
+def original_file_id(message: Message) -> Optional[str]:
+    if attachment := message.document or message.video or message.animation:
+        return attachment.file_id
+    return None
+
+
+async def upload_to_storage(
+    context: ContextTypes.DEFAULT_TYPE, artwork_result: ArtworkResult, indexes: range
+) -> None:
+    """
+    把还没有 file_id 的预览图上传到存储会话, 之后的各个目标都只发送 file_id
+    """
+    images = artwork_result.images
+    missing = [j for j in indexes if not images[j].file_id_thumb]
+    if not missing:
+        return
+    reply_msgs = await send_photo_group(
+        context, config.bot_storage_chat, artwork_result, missing, disable_notification=True
+    )
+    for j, reply_msg in zip(missing, reply_msgs):
+        images[j].file_id_thumb = thumb_file_id(reply_msg)
+
+
+async def upload_originals_to_storage(
+    context: ContextTypes.DEFAULT_TYPE, images: list[ImageInfo]
+) -> None:
+    missing = [image for image in images if not image.file_id_original]
+    if not missing:
+        return
+    media_group: list[InputMediaDocument] = await asyncio.gather(
+        *(get_input_media_document(image) for image in missing)
+    )
+    await chat_limiter.acquire(config.bot_storage_chat, len(media_group))
+    reply_msgs = await context.bot.send_media_group(
+        config.bot_storage_chat, media_group, disable_notification=True
+    )
+    for image, reply_msg in zip(missing, reply_msgs):
+        image.file_id_original = original_file_id(reply_msg)
+
+
 async def send_media_group(
     context: ContextTypes.DEFAULT_TYPE,
     artwork_result: ArtworkResult,
-    chat_id: int | str = config.bot_channel,
+    chat_id: Optional[int | str] = None,
 ) -> ArtworkResult:
     """
     发送图片(组)
     参数：
     artwork_result: 拿到的图片结果
-    chat_id: 可能是用户 群聊, 如果是发图流程则是默认的发图频道
+    chat_id: 可能是用户 群聊, 为空则是发图流程, 按路由规则发到各个频道
     context: bot 上下文
+    有多个目标时只上传一次, 其余目标并行以 file_id 发送
     """
-    media_group: list[InputMediaPhoto] = []
-    has_spoiler: Optional[bool] = artwork_result.artwork_param.spoiler
-    for image in artwork_result.images:
-        if image.file_id_thumb:
-            media_group.append(InputMediaPhoto(image.file_id_thumb))
-            continue
-        file_path = f"{DOWNLOADS}/{image.platform}/{image.filename}"
-        if not is_within_size_limit(file_path):
-            img_compressed = f"{DOWNLOADS}/{image.platform}/compressed_{image.filename}"
-            compress_image(file_path, img_compressed)
-            file_path = img_compressed
-        with open(file_path, "rb") as f:
-            media_group.append(
-                InputMediaPhoto(
-                    f, has_spoiler=has_spoiler if has_spoiler is not None else image.r18
-                )
-            )
-    logger.debug(media_group)
+    post_mode = chat_id is None
+    chat_ids: list[int | str] = (
+        [route.channel for route in routing.route(artwork_result)]
+        if chat_id is None
+        else [chat_id]
+    )
 
     # 防打扰, 若干秒内不开启通知音
     disable_notification = False
-    if chat_id == config.bot_channel:
+    if post_mode:
         now = datetime.now()
+        # worker 中的 last_msg 由前端随任务传入, 见 dispatch_job
+        interval = now - context.bot_data.get("last_msg", datetime.fromtimestamp(0))
         context.bot_data["last_msg"] = now
-        interval = now - context.bot_data["last_msg"]
         if interval.total_seconds() < config.bot_disable_notification_interval:
             disable_notification = True
         if artwork_result.artwork_param.silent is not None:
             disable_notification = artwork_result.artwork_param.silent
 
-    # 发图流程 检测到AI图则分流
-    if (
-        config.bot_enable_ai_redirect
-        and chat_id == config.bot_channel
-        and artwork_result.images[0].ai
-    ):
-        chat_id = config.bot_enable_ai_redirect_channel
-
+    # 按组发送, 每组只等待本组的预览图, 后面的页继续在后台下载
     MAX_NUM = 10
-    total_page = math.ceil(len(media_group) / MAX_NUM)
-    batch_size = math.ceil(len(media_group) / total_page)
+    images = artwork_result.images
+    total_page = math.ceil(len(images) / MAX_NUM)
+    batch_size = math.ceil(len(images) / total_page)
+    # 目标 -> 最后一组的第一条消息, 评论区中回复原图
+    sent_msgs: dict[int | str, Message] = {}
+    failed: dict[int | str, BaseException] = {}
     for i in range(total_page):
         page_count = ""
         if total_page > 1:
             page_count = f"({i+1}/{total_page})\n"
-        reply_msgs = await context.bot.send_media_group(
-            chat_id,
-            media_group[i * batch_size : (i + 1) * batch_size],
+        indexes = range(i * batch_size, min((i + 1) * batch_size, len(images)))
+        if config.bot_storage_chat:
+            await upload_to_storage(context, artwork_result, indexes)
+        kwargs = dict(
             caption=page_count + artwork_result.caption,
             parse_mode=ParseMode.HTML,
             disable_notification=disable_notification,
         )
-        for j in range(len(reply_msgs)):
-            img: Image = artwork_result.images[i * batch_size + j]
-            img.sent_message_link = reply_msgs[0].link
-            img.file_id_thumb = reply_msgs[j].photo[3].file_id
-        reply_msg = reply_msgs[0]
-        artwork_result.sent_channel_msg = reply_msg
-
-        media_group = media_group[batch_size:]
+        targets = [target for target in chat_ids if target not in failed]
+        if not targets:
+            break
+        results: dict[int | str, tuple[Message, ...] | BaseException] = {}
+        if any(not images[j].file_id_thumb for j in indexes):
+            # 第一个目标负责上传, 拿到 file_id 后其余目标并行发送, 上传失败时交给下一个目标
+            for target in targets:
+                try:
+                    reply_msgs = await send_photo_group(
+                        context, target, artwork_result, indexes, **kwargs
+                    )
+                except Exception as e:
+                    results[target] = e
+                    continue
+                for j, reply_msg in zip(indexes, reply_msgs):
+                    images[j].file_id_thumb = images[j].file_id_thumb or thumb_file_id(reply_msg)
+                results[target] = reply_msgs
+                break
+        rest = [target for target in targets if target not in results]
+        results.update(
+            zip(
+                rest,
+                await asyncio.gather(
+                    *(
+                        send_photo_group(context, target, artwork_result, indexes, **kwargs)
+                        for target in rest
+                    ),
+                    return_exceptions=True,
+                ),
+            )
+        )
+        for target, result in results.items():
+            if isinstance(result, BaseException):
+                logger.error(f"发送到 {target} 失败: {result}")
+                failed[target] = result
+                continue
+            for j, reply_msg in zip(indexes, result):
+                img: ImageInfo = images[j]
+                img.sent_message_link = img.sent_message_link or result[0].link
+                img.file_id_thumb = img.file_id_thumb or thumb_file_id(reply_msg)
+            sent_msgs[target] = result[0]
         # 防止 API 速率限制
         # await asyncio.sleep(3 * batch_size)
 
-    if (chat_id == config.bot_channel) or (
-        chat_id == config.bot_enable_ai_redirect_channel
-    ):
-        # 发原图
-        context.bot_data[artwork_result.sent_channel_msg.id] = artwork_result.images
+    if not sent_msgs:
+        raise next(iter(failed.values()))
+    # 有任意一组发送成功就写入数据库, 去重与发原图都依赖这些记录
+    save_images(images, artwork_result.image_tags)
+    artwork_result.image_tags = []
+    artwork_result.sent_channel_msg = next(iter(sent_msgs.values()))
+    if post_mode:
+        for target, sent_msg in sent_msgs.items():
+            # 发原图, 频道消息转发到评论区后回复
+            context.bot_data[(sent_msg.chat_id, sent_msg.id)] = images
+            if sent_msg is not artwork_result.sent_channel_msg:
+                artwork_result.feedback += f'\n已同时发送到 <a href="{sent_msg.link}">{target}</a>'
         logger.info(context.bot_data)
-    # session.commit()
+    for target in failed:
+        artwork_result.feedback += f"\n发送到 {target} 失败了喵"
 
     artwork_result.feedback += f"\n发送成功了喵！"
     return artwork_result
 
 
+def forwarded_channel_post(message: Message) -> Optional[tuple[int, int]]:
+    """
+    评论区中由频道自动转发的消息 -> (频道 id, 频道消息 id)
+    """
+    origin = message.forward_origin
+    if isinstance(origin, telegram.MessageOriginChannel):
+        return origin.chat.id, origin.message_id
+    chat = message.api_kwargs.get("forward_from_chat")
+    message_id = message.api_kwargs.get("forward_from_message_id")
+    if chat and message_id:
+        return chat["id"], message_id
+    return None
+
+
 async def get_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 匹配 bot_data, 匹配到则发送原图, 否则忽略该消息
     logger.info(context.bot_data)
     if not update.message:
         return
     msg: Message = update.message
-    if (
-        msg.api_kwargs["forward_from_message_id"]
-        and msg.api_kwargs["forward_from_message_id"] in context.bot_data
-    ):
+    key = forwarded_channel_post(msg)
+    if key is None:
+        return
+    if key not in context.bot_data:
+        # 交接期间旧进程发出的图片, 旧进程处理完后才会交出待发原图
+        await restore_after_drain(context.bot_data)
+    if key in context.bot_data:
         await update.message.reply_chat_action("upload_document")
         await post_original_pic(context, msg)
+    elif job_waiters:
+        # 可能是 worker 正在发的图片, 不等待任务, 由 dispatch_job 收到待发原图后回复
+        early_forwards[key] = msg
+
+
+async def get_input_media_document(image: ImageInfo) -> InputMediaDocument:
+    if image.file_id_original:
+        return InputMediaDocument(image.file_id_original)
+    file_path = await platforms.DefaultPlatform.ensure_original(image)
+    if os.path.getsize(file_path) > upload_size_limit() and image.extension != "mp4":
+        # 超出官方 bot api 的上传限制, 改为发送压缩后的图片, local mode 下不需要
+        img_compressed = compressed_path(image)
+        if not os.path.exists(img_compressed):
+            compress_image(file_path, img_compressed)
+        file_path = img_compressed
+    storage_manager.touch(file_path)
+    if config.bot_api_local_mode:
+        return InputMediaDocument(Path(file_path))
+    with open(file_path, "rb") as f:
+        return InputMediaDocument(f)
 
 
 async def post_original_pic(
     context: ContextTypes.DEFAULT_TYPE,
     message: Optional[telegram.Message] = None,
     chat_id: int | str = config.bot_channel,
-    images: Optional[list[Image]] = None,  # type: ignore
+    images: Optional[list[ImageInfo]] = None,  # type: ignore
 ) -> None:
     """
     message 与 chat_id, images 互斥, 前者用于捕获频道消息并回复原图, 后者直接发送到指定 chat_id, 目前用于获取图片信息
     """
     if not images:
         assert isinstance(message, Message)
-        images: list[Image] = context.bot_data.pop(
-            message.api_kwargs["forward_from_message_id"]
-        )
-    media_group: list[InputMediaDocument] = []
-    for image in images:
-        if image.file_id_original:
-            media_group.append(InputMediaDocument(image.file_id_original))
-            continue
-        file_path = f"{DOWNLOADS}/{image.platform}/{image.filename}"
-        with open(file_path, "rb") as f:
-            media_group.append(telegram.InputMediaDocument(f))
-
+        images: list[ImageInfo] = context.bot_data.pop(forwarded_channel_post(message))
+    # 按组等待原图, 先下载完的组先发
     MAX_NUM = 10
-    total_page = math.ceil(len(media_group) / MAX_NUM)
-    batch_size = math.ceil(len(media_group) / total_page)
+    total_page = math.ceil(len(images) / MAX_NUM)
+    batch_size = math.ceil(len(images) / total_page)
     for i in range(total_page):
+        batch = images[i * batch_size : (i + 1) * batch_size]
+        if config.bot_storage_chat:
+            await upload_originals_to_storage(context, batch)
+        media_group: list[InputMediaDocument] = await asyncio.gather(
+            *(get_input_media_document(image) for image in batch)
+        )
         if message:
-            reply_msgs = await message.reply_media_group(
-                media=media_group[i * batch_size : (i + 1) * batch_size]
-            )
+            await chat_limiter.acquire(message.chat_id, len(media_group))
+            reply_msgs = await message.reply_media_group(media=media_group)
         else:
-            reply_msgs = await context.bot.send_media_group(
-                chat_id,
-                media_group[i * batch_size : (i + 1) * batch_size],
-            )
-        for j in range(len(reply_msgs)):
-            img: Image = images[i * batch_size + j]
-            img.file_id_original = reply_msgs[j].document.file_id
-        images = images[batch_size:]
+            await chat_limiter.acquire(chat_id, len(media_group))
+            reply_msgs = await context.bot.send_media_group(chat_id, media_group)
+        for img, reply_msg in zip(batch, reply_msgs):
+            img.file_id_original = img.file_id_original or original_file_id(reply_msg)
         # 防止 API 速率限制
         # await asyncio.sleep(3 * batch_size)
-    session.commit()
+    save_images(images)
 
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert isinstance(update.message, Message)
     msg = update.message
+    assert msg.from_user
     logging.info(msg.text)
 
-    artwork_result: ArtworkResult = await get_artworks(update.message, post_mode=False)
+    user_class = ADMIN if is_admin(msg.from_user, context) else GUEST
+    try:
+        async with fair_share.slot(msg.from_user.id, user_class):
+            if config.worker_enabled:
+                await dispatch_job("echo", msg, context)
+            else:
+                await echo_artwork(msg, context)
+    except Overloaded as e:
+        await msg.reply_text(str(e))
+
+
+async def echo_artwork(msg: Message, context: ContextTypes.DEFAULT_TYPE) -> None:
+    artwork_result: ArtworkResult = await get_artworks(msg, post_mode=False)
     if artwork_result.success:
-        await update.message.reply_chat_action("upload_photo")
+        await msg.reply_chat_action("upload_photo")
         artwork_result.caption += config.txt_msg_tail
         await send_media_group(context, artwork_result, msg.chat_id)
-    await update.message.reply_chat_action("upload_document")
+    await msg.reply_chat_action("upload_document")
     await post_original_pic(
         context=context, chat_id=msg.chat_id, images=artwork_result.images
     )
 
 
+async def dispatch_job(
+    kind: str, message: Message, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """
+    交给 worker 进程处理, 提示消息由 worker 发送和编辑, 完成后接收待发原图
+    """
+    payload: dict[str, Any] = {"message": message.to_dict()}
+    if "last_msg" in context.bot_data:
+        # 频道上一次发图的时间, 用于静音发送
+        payload["last_msg"] = context.bot_data["last_msg"].timestamp()
+    job_id = job_queue.enqueue(kind, payload)
+    ahead = job_queue.queued_count() - 1
+    if ahead > 0:
+        await message.reply_text(f"已加入队列喵，前面还有 {ahead} 个任务")
+    waiter = asyncio.ensure_future(job_queue.wait(job_id))
+    job_waiters.add(waiter)
+    try:
+        status, result = await waiter
+    finally:
+        job_waiters.discard(waiter)
+    if status == "failed":
+        logger.error(f"任务 {job_id} 失败: {result.get('error')}")
+        await message.reply_text("出错了呜呜呜，对不起主人喵，没能成功发送图片")
+    else:
+        # worker 中下载的字节数记到发起请求的用户上
+        charge(result.get("bytes", 0))
+        restore_pending_originals(context.bot_data, result.get("pending", {}))
+        if last_msg := result.get("last_msg"):
+            context.bot_data["last_msg"] = max(
+                context.bot_data.get("last_msg", datetime.fromtimestamp(0)),
+                datetime.fromtimestamp(last_msg),
+            )
+    forwards = [
+        early_forwards.pop(key) for key in list(early_forwards) if key in context.bot_data
+    ]
+    if not job_waiters:
+        # 没有进行中的任务, 剩下的转发与 bot 无关
+        early_forwards.clear()
+    for forward in forwards:
+        await forward.reply_chat_action("upload_document")
+        await post_original_pic(context, forward)
+
+
+async def run_post_job(context: Any, payload: dict[str, Any]) -> dict[str, Any]:
+    """在 worker 中运行, context 只需要 bot 与 bot_data"""
+    message = Message.de_json(payload["message"], context.bot)
+    if "last_msg" in payload:
+        context.bot_data["last_msg"] = datetime.fromtimestamp(payload["last_msg"])
+    with measure() as usage:
+        await post_artwork(message, context)
+        await download_pending_originals(context.bot_data)
+    result: dict[str, Any] = {
+        "pending": pending_originals(context.bot_data),
+        "bytes": usage.bytes,
+    }
+    if "last_msg" in context.bot_data:
+        result["last_msg"] = context.bot_data["last_msg"].timestamp()
+    return result
+
+
+async def download_pending_originals(bot_data: dict[Any, Any]) -> None:
+    """
+    worker 完成任务前等待待发原图下载完成, file_hash 写入数据库后前端直接使用, 不再重新下载
+    """
+    images: list[ImageInfo] = [
+        image
+        for key, images in bot_data.items()
+        if isinstance(key, tuple)
+        for image in images
+    ]
+    results = await asyncio.gather(
+        *(platforms.DefaultPlatform.ensure_original(image) for image in images),
+        return_exceptions=True,
+    )
+    for image, result in zip(images, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"下载原图 {image.filename} 失败, 由前端重试: {result}")
+
+
+async def run_echo_job(context: Any, payload: dict[str, Any]) -> dict[str, Any]:
+    message = Message.de_json(payload["message"], context.bot)
+    with measure() as usage:
+        await echo_artwork(message, context)
+    return {"bytes": usage.bytes}
+
+
+JOB_RUNNERS = {
+    "post": run_post_job,
+    "echo": run_echo_job,
+}
+
+
 @admin
 async def set_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert isinstance(update.message, Message)
@@ -379,6 +759,10 @@ async def set_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             BotCommand("mark_dup", "(admin) /mark_dup url 标记图片已被发送过"),
             BotCommand("unmark_dup", "(admin) /unmark_dup url 反标记该图片信息"),
             BotCommand("repost_orig", "(admin) /repost_orig 在频道评论区回复"),
+            BotCommand("storage", "(admin) /storage 查看本地图片占用"),
+            BotCommand("stats", "(admin) /stats 查看运行统计"),
+            BotCommand("reload", "(admin) /reload 重新加载平台模块"),
+            BotCommand("profile", "(admin) /profile 60s 采样分析一段时间"),
             BotCommand("ping", "hello"),
         ]
     )
@@ -470,12 +854,13 @@ async def _get_admins(
         ]
         context.bot_data["admins"] = admins
     else:
-        # 初始化调用
+        # 初始化调用, 合并各个评论群组的管理员
         admins: list[int] = [
             admin.user.id
             for admin in await application.bot.get_chat_administrators(chat_id)
         ]
-        application.bot_data["admins"] = admins
+        admins += application.bot_data.get("admins", [])
+        application.bot_data["admins"] = list(dict.fromkeys(admins))
     logger.debug(application.bot_data)
 
 
@@ -485,9 +870,8 @@ def is_admin(user: telegram.User, context: ContextTypes.DEFAULT_TYPE) -> bool:
     result = (
         user.id in context.bot_data.get("admins", [])
         or user.id in config.bot_admin_chats
-        or user.id == config.bot_channel_comment_group
-        or user.username == config.bot_channel
-        or user.username == config.bot_enable_ai_redirect_channel
+        or user.id in routing.comment_groups()
+        or user.username in routing.channels()
     )
     logger.debug(user)
     logger.debug(context.bot_data)
@@ -497,11 +881,169 @@ def is_admin(user: telegram.User, context: ContextTypes.DEFAULT_TYPE) -> bool:
 
 # 定义一个异步的初始化函数
 async def on_start(application: Any):
+    init_db()
     # 在这里调用 _get_admins 函数
-    await _get_admins(config.bot_channel_comment_group, application=application)
+    for chat_id in routing.comment_groups():
+        await _get_admins(chat_id, application=application)
     # 这里还可以添加其他在机器人启动前需要执行的代码
-    await restore_from_restart(application)
     application.bot_data["me"] = await application.bot.get_me()
+    if config.bot_deduplication_mode and posted_filter.enabled:
+        posted_filter.load()
+    if predecessor_pid():
+        # 预热完成, 等旧进程停止拉取 update 后再开始
+        Handover.mark_ready()
+        await Handover.wait_for("released", config.bot_handover_timeout)
+        restore_pending_originals(application.bot_data, Handover.pending())
+        run_in_background(restore_after_drain(application.bot_data))
+    if config.debug_loop_watchdog:
+        loop_watchdog.start()
+    if config.storage_max_bytes:
+        run_in_background(
+            storage_manager.run(
+                config.storage_check_interval, config.storage_evict_batch
+            )
+        )
+    run_in_background(prefetcher.run(60, metadata_cache, download_cache))
+    if config.db_maintenance_hour >= 0:
+        run_in_background(database_maintenance.run())
+    if "started_at" in application.bot_data:
+        application.bot_data["startup_seconds"] = (
+            time.perf_counter() - application.bot_data["started_at"]
+        )
+        logger.info(startup_report(application.bot_data))
+    await restore_from_restart(application)
+
+
+async def on_stop(application: Any) -> None:
+    posted_filter.save()
+    if handover.released:
+        # 处理中的 update 都已完成, 交出这期间新增的待发原图
+        handover.release(pending_originals(application.bot_data), drained=True)
+
+
+def pending_originals(bot_data: dict[Any, Any]) -> dict[str, list[int]]:
+    """
+    bot_data 中 (频道 id, 频道消息 id) -> 待发原图, 转为 "频道 id:频道消息 id" -> Image.id 交给新进程
+    图片在发送预览图时已经写入数据库
+    """
+    return {
+        f"{key[0]}:{key[1]}": [image.id for image in images]
+        for key, images in bot_data.items()
+        if isinstance(key, tuple)
+    }
+
+
+def restore_pending_originals(
+    bot_data: dict[Any, Any], pending: dict[str, list[int]]
+) -> None:
+    for name, ids in pending.items():
+        chat_id, _, message_id = name.partition(":")
+        if not message_id:
+            # 旧版本只记录了频道消息 id, 无法确定是哪个频道
+            continue
+        key = (int(chat_id), int(message_id))
+        if key in restored_originals:
+            continue
+        restored_originals.add(key)
+        bot_data[key] = load_images(ids)
+    logger.debug(f"已恢复 {len(pending)} 组待发原图")
+
+
+async def restore_after_drain(bot_data: dict[Any, Any]) -> None:
+    """交接启动时只执行一次, 之后直接返回"""
+    if predecessor_pid() is None:
+        return
+    await Handover.wait_for("drained", config.bot_handover_timeout)
+    if predecessor_pid() is None:
+        # 等待期间已由其他调用完成
+        return
+    restore_pending_originals(bot_data, Handover.pending())
+    Handover.finish()
+    if posted_filter.bloom is not None:
+        # 旧进程在交接期间发出的作品
+        posted_filter.sync()
+
+
+def startup_report(bot_data: dict[str, Any]) -> str:
+    if "startup_seconds" not in bot_data:
+        return "启动耗时: 未知"
+    import_seconds = bot_data["import_seconds"]
+    startup_seconds = bot_data["startup_seconds"]
+    return (
+        f"启动耗时: {startup_seconds:.2f} 秒 "
+        f"(导入 {import_seconds:.2f} 秒, 初始化 {startup_seconds - import_seconds:.2f} 秒)"
+    )
+
+
+@admin
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    查看运行统计
+    """
+    assert isinstance(update.message, Message)
+    lines = [
+        startup_report(context.bot_data),
+        pixiv_tags.stats(),
+    ]
+    if config.bot_deduplication_mode:
+        lines.append(posted_filter.stats())
+    lines.append(bandwidth.stats())
+    lines.append(fair_share.stats())
+    lines.append(prefetcher.stats())
+    lines.append(database_maintenance.stats())
+    if config.debug_loop_watchdog:
+        lines.append(loop_watchdog.stats())
+    await update.message.reply_text("\n".join(lines))
+
+
+@admin
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    对接下来一段时间做采样分析, 例如 /profile 60s, 默认 30 秒
+    """
+    message = update.message
+    assert isinstance(message, Message)
+    try:
+        seconds = parse_duration(context.args[0]) if context.args else 30
+    except ValueError as e:
+        await message.reply_text(str(e))
+        return
+    seconds = min(seconds, config.debug_profile_max_seconds)
+    try:
+        hint_msg = await message.reply_text(f"开始采样分析 {seconds:g} 秒喵...")
+        path = await profiler.run_for(seconds)
+    except ProfilerBusyError as e:
+        await message.reply_text(f"{e}, 请主人稍后再试喵")
+        return
+    await hint_msg.delete()
+    await reply_profile(message, path)
+
+
+async def reply_profile(message: Message, path: str) -> None:
+    with open(path, "rb") as f:
+        await message.reply_document(
+            f,
+            caption=f"共 {profiler.sample_count} 次采样, 可以用 speedscope.app 打开",
+        )
+
+
+@admin
+async def storage_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    查看 data/downloads 占用与淘汰情况
+    """
+    assert isinstance(update.message, Message)
+    if not storage_manager.last_run:
+        files = await asyncio.to_thread(storage_manager.scan)
+        storage_manager.used_bytes = sum(f.size for f in files)
+    budget = (
+        format_size(config.storage_max_bytes) if config.storage_max_bytes else "不限制"
+    )
+    await update.message.reply_text(
+        f"本地图片占用: {format_size(storage_manager.used_bytes)} / {budget}\n"
+        f"已淘汰 {storage_manager.evicted_files} 个文件, "
+        f"回收 {format_size(storage_manager.reclaimed_bytes)}"
+    )
 
 
 @admin
@@ -521,29 +1063,79 @@ async def restore_from_restart(application: Any) -> None:
     if os.path.exists(restart_data):
         with open(restart_data) as f:
             msg: Message = Message.de_json(json.load(f), application.bot)  # type: ignore
-            await msg.edit_text("重启成功了喵！")
+            await msg.edit_text(
+                f"重启成功了喵！\n{startup_report(application.bot_data)}"
+            )
         os.remove(restart_data)
 
 
 @admin
-async def update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def reload(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, update_msg: str = ""
+) -> None:
+    """
+    重新加载平台模块, 不中断正在处理的 update
+    """
     assert isinstance(update.message, Message)
     try:
-        command = ["git", "pull", "-f"]
-        result: subprocess.CompletedProcess[str] = subprocess.run(
-            command,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
+        modules = platforms.reload()
+    except Exception as e:
+        logger.error(f"重新加载平台模块失败: {e!r}")
+        await update.message.reply_text(
+            update_msg + f"呜呜，重新加载失败了喵，请主人看下日志吧\n{e!r}"
         )
-        logger.debug(result.stdout)
-        logger.debug("更新成功了喵！")
-    except subprocess.CalledProcessError as e:
-        logger.error("呜呜，更新出错了喵:" + str(e))
+        return
+    await update.message.reply_text(
+        update_msg + f"重新加载了 {len(modules)} 个平台模块喵！"
+    )
+
+
+async def start_handover(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, update_msg: str = ""
+) -> None:
+    """
+    启动新进程, 预热完成后交出 update 的拉取, 本进程处理完手上的 update 再退出
+    """
+    assert isinstance(update.message, Message)
+    msg = await update.message.reply_text(
+        update_msg + "正在启动新进程喵，咱处理完手上的图片就交班..."
+    )
+    # 新进程启动后编辑这条消息
+    with open(restart_data, "w", encoding="utf-8") as f:
+        f.write(msg.to_json())
+    handover.spawn()
+    if not await handover.wait_ready(config.bot_handover_timeout):
+        if os.path.exists(restart_data):
+            os.remove(restart_data)
+        await msg.edit_text("呜呜，新进程没能启动，咱继续值班喵，请主人看下日志吧")
+        return
+    application = context.application
+    assert application.updater
+    await application.updater.stop()
+    handover.release(pending_originals(application.bot_data))
+    logger.info("已交出 update 的拉取, 等待处理中的 update 完成后退出")
+    application.stop_running()
+
+
+@admin
+async def update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    assert isinstance(update.message, Message)
+    process = await asyncio.create_subprocess_exec(
+        "git", "pull", "-f", stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        logger.error("呜呜，更新出错了喵:" + stderr.decode(errors="ignore"))
         await update.message.reply_text("呜呜，更新失败了喵，请主人看下日志吧")
         return
-    await restart(update, context, "更新成功了喵！")
+    logger.debug(stdout.decode(errors="ignore"))
+    logger.debug("更新成功了喵！")
+    if config.bot_update_mode == "handover":
+        await start_handover(update, context, "更新成功了喵！")
+    elif config.bot_update_mode == "reload":
+        await reload(update, context, "更新成功了喵！")
+    else:
+        await restart(update, context, "更新成功了喵！")
 
 
 async def handle_private_share(
@@ -557,6 +1149,10 @@ async def handle_private_share(
     urls = find_url(message)
     if not urls:
         return
+    if config.bot_prefetch_pages > 0 and not config.worker_enabled:
+        # 管理员选择 tag 的同时在后台预取, worker 模式下由 worker 获取, 预取没有意义
+        for url in urls:
+            prefetcher.start(url, functools.partial(prefetch_artwork, url, message.from_user))
     urls = json.dumps(urls).replace(" ", "")
     logger.debug(urls)
     from_link = ""
@@ -589,6 +1185,31 @@ async def handle_private_share(
     )
 
 
+async def prefetch_artwork(url: str, user: User) -> list[ImageInfo]:
+    """
+    投机预取私聊中分享的链接, 发过的作品不再预取
+    """
+    if config.bot_deduplication_mode and check_duplication_via_url(url):
+        return []
+    key = canonicalize(url)
+    platform = key.platform if key else None
+    if platform == "bilibili":
+        assert key
+        # bilibili 获取作品时就会下载全部原图并写入数据库, 只预取作品信息
+        await platforms.bilibili.get_post(key.pid)
+        return []
+    if platform == "Pixiv":
+        platform_class = platforms.Pixiv
+    elif platform == "twitter":
+        assert key
+        platform_class, url = platforms.Twitter, key.url
+    elif platform == "miyoushe":
+        platform_class = platforms.MiYouShe
+    else:
+        platform_class = platforms.DefaultPlatform
+    return await platform_class.prefetch(url, user, config.bot_prefetch_pages)
+
+
 async def handle_inline_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert update.inline_query
     query = update.inline_query
@@ -1,20 +1,149 @@
+from typing import Optional
+
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
 
+class Route(BaseModel):
+    """
+    发图路由规则, 下列条件全部满足时发到 channel, 为空的条件不做限制
+    tags / platforms / authors 命中其中任意一个即可, tag 不区分大小写, 可以不带 #
+    """
+
+    channel: str
+    # 频道关联的评论群组, 用于获取管理员列表
+    comment_group: Optional[int] = None
+    tags: list[str] = []
+    platforms: list[str] = []
+    # 作者名或作者 id
+    authors: list[str] = []
+    r18: Optional[bool] = None
+    ai: Optional[bool] = None
+
+
 class Settings(BaseSettings):
     debug: bool = True
 
+    # 事件循环卡顿检测, 阻塞超过阈值 (seconds) 时记录调用栈
+    debug_loop_watchdog: bool = False
+    debug_loop_watchdog_threshold: float = 0.5
+    # /profile 采样分析的间隔 (seconds) 与最长时间 (seconds)
+    debug_profile_interval: float = 0.005
+    debug_profile_max_seconds: int = 600
+
     bot_token: str = ""
     bot_admin_chats: list[int] = []
     bot_channel: str = "@"
     bot_channel_comment_group: int = -1
     bot_deduplication_mode: bool = False
+    # 去重用的布隆过滤器的初始容量与误判率, 超出容量后下次启动时自动扩容
+    bot_dedup_filter_capacity: int = 100000
+    bot_dedup_filter_error_rate: float = 0.001
     bot_disable_notification_interval: int = 600
 
     bot_enable_ai_redirect: bool = False
     bot_enable_ai_redirect_channel: str = ""
+    # 存储会话, 每页只上传到这里一次, 频道与用户都通过 file_id 发送, 为空则直接上传到目标
+    bot_storage_chat: str = ""
+    # 发图路由, 作品会发到所有命中的频道, 一条都没命中时发到 bot_channel
+    # 设置后 bot_enable_ai_redirect 不再生效
+    bot_routes: list[Route] = []
+    # 自建 bot api server, 例如 http://127.0.0.1:8081/bot, 为空则使用官方 api
+    bot_api_base_url: str = ""
+    # 为空时由 bot_api_base_url 推出 (.../file/bot)
+    bot_api_base_file_url: str = ""
+    # 与 bot api server 在同一台机器 (或挂载了相同的 data 目录) 时开启, 上传时只传本地路径
+    bot_api_local_mode: bool = False
+    # 每个会话每分钟最多发送的消息数 (相册中每张图计一条), 0 为不限制
+    bot_chat_rate_limit: int = 20
+
+    # 同时分发的 update 数量, 0 为逐个分发
+    # /post, /echo 等以 block=False 注册的 handler 无论如何都在后台并发执行, 只有其余 handler 受此限制
+    bot_concurrent_updates: int = 16
+
+    # /post 与 /echo 的公平调度, 同时处理的请求数, 空出位置时按权重在 admin 与 guest 之间分配
+    bot_fair_slots: int = 8
+    bot_fair_admin_weight: int = 4
+    bot_fair_guest_weight: int = 1
+    # 每个用户同时处理的请求数, admin 超出时排队, guest 超出时拒绝
+    bot_fair_admin_per_user: int = 4
+    bot_fair_guest_per_user: int = 1
+    # guest 在窗口 (seconds) 内最多下载的字节数, 0 为不限制
+    bot_fair_guest_byte_quota: int = 200 * 1024 * 1024
+    bot_fair_guest_byte_window: int = 3600
+    # 排队的 guest 请求超过该数量时拒绝新的 guest 请求
+    bot_fair_guest_queue: int = 8
+
+    # /update 拉取代码后的切换方式
+    # restart: 退出进程, 由 systemd 等重新拉起
+    # handover: 先启动新进程, 预热完成后交接, 旧进程处理完手上的 update 再退出
+    # reload: 只在进程内重新加载平台模块
+    bot_update_mode: str = "restart"
+    # 等待新进程预热完成的最长时间 (seconds)
+    bot_handover_timeout: int = 120
+
+    # 开启后 /post 与 /echo 写入任务队列, 由 worker.py 进程处理
+    worker_enabled: bool = False
+    # 每个 worker 进程同时处理的任务数
+    worker_concurrency: int = 4
+    # 没有任务时查询队列的间隔 (seconds)
+    worker_poll_interval: float = 1.0
+    # 租约时长 (seconds), worker 崩溃后任务在租约过期时被其他 worker 接手
+    worker_lease: int = 300
+    worker_max_attempts: int = 3
+
+    # 这些 host 的预览图直接把 URL 交给 telegram 拉取, 为空则关闭
+    bot_url_upload_hosts: list[str] = [
+        "pbs.twimg.com",
+        "hdslb.com",
+        "upload-bbs.miyoushe.com",
+        "upload-bbs.mihoyo.com",
+        "upload-os-bbs.hoyolab.com",
+    ]
+    # 成功率低于该值时暂停该 host 的 URL 模式
+    bot_url_upload_min_success_rate: float = 0.8
+
+    # webhook 模式 (默认关闭, 使用 long polling)
+    bot_webhook_enabled: bool = False
+    bot_webhook_listen: str = "127.0.0.1"
+    bot_webhook_port: int = 8443
+    bot_webhook_path: str = "webhook"
+    bot_webhook_url: str = ""
+    bot_webhook_secret_token: str = ""
+    bot_webhook_max_connections: int = 40
+
+    # data/downloads 容量预算 (字节), 0 为不限制
+    storage_max_bytes: int = 0
+    storage_check_interval: int = 600
+    storage_evict_batch: int = 50
+
+    # 下载重试与熔断
+    download_max_retries: int = 4
+    download_backoff_base: float = 1.0
+    download_backoff_max: float = 30.0
+    # 超过该大小且服务器支持 Range 时分段并行下载
+    download_segment_threshold: int = 16 * 1024 * 1024
+    download_segments: int = 4
+    # 同一 host 连续失败多少次后熔断, 以及熔断持续的秒数
+    download_breaker_failures: int = 5
+    download_breaker_reset: int = 60
+    # 全局下载带宽 (bytes/s), 按 预览图 > 原图 > guest > 预取 的优先级分配, 0 为不限速
+    download_bandwidth_limit: int = 0
+
+    # 私聊分享链接时预取作品信息, 并以最低优先级下载前几页原图, 0 为关闭
+    bot_prefetch_pages: int = 3
+    # 预取结果与作品信息缓存的有效期 (seconds), 过期未使用的预取会被清理
+    bot_prefetch_ttl: int = 600
 
     db_url: str = "sqlite://data/data.db"
+    # 每天几点 (本地时间) 维护数据库, -1 为关闭
+    db_maintenance_hour: int = 4
+    # 删除多少天前的 guest (/echo) 图片, 期间被 /post 过的不会删除, 0 为不删除
+    db_guest_retention_days: int = 90
+    # 清空多少天前的 guest 图片的原始 json (full_info), 0 为不清空
+    db_guest_compact_days: int = 7
+    # 删除多少天前已完成的 worker 任务, 0 为不删除
+    db_job_retention_days: int = 7
 
     pixiv_refresh_token: str = ""
     pixiv_phpsessid: str = ""
@@ -1,4 +1,5 @@
-from dataclasses import dataclass, field
+import asyncio
+from dataclasses import dataclass, field, fields
 import os
 from datetime import datetime
 from db import Base, engine
@@ -9,19 +10,20 @@ from sqlalchemy import (
     String,
     DateTime,
     Boolean,
+    Float,
+    Index,
+    inspect,
+    text,
 )
 from datetime import datetime
 from typing import Optional
 
-if not os.path.exists("./data"):
-    os.makedirs("./data")
-
 class Image(Base):
     __tablename__ = "images"
     id = Column(Integer, primary_key=True)  # id 一般自增
     userid = Column(Integer)  # telegram user id
     username = Column(String)  # telegram username 对于没有用户名的用户 为全名
-    create_time = Column(DateTime, default=datetime.now())  # 图片发送时间
+    create_time = Column(DateTime, default=datetime.now, index=True)  # 图片发送时间
     platform = Column(String)  # 图片所属平台, 例如 Pixiv
     title = Column(
         String
@@ -48,8 +50,55 @@ class Image(Base):
     sent_message_link = Column(String)  # telegram file_id 预览图
     file_id_thumb = Column(String)  # telegram file_id 预览图
     file_id_original = Column(String) # telegram file_id 原图
-    update_time = Column(DateTime, default=datetime.now()) # 最后一次发送时间
+    update_time = Column(DateTime, default=datetime.now) # 最后一次发送时间
     post_count = Column(Integer(), default=1) # 发送次数计数
+    file_hash = Column(String, index=True) # 原图 sha256, 文件位于 data/downloads/sha256/ 下
+
+    # 去重与缓存都按 (platform, pid) 查询
+    __table_args__ = (Index("ix_images_platform_pid", "platform", "pid"),)
+
+
+@dataclass(slots=True)
+class ImageInfo:
+    '''
+    发图流程中传递的图片信息, 字段与 Image 一一对应
+    不绑定 session, 没有 ORM 的属性追踪开销, 只在发送成功后由 save_images 写入数据库
+    :param id: 对应 Image.id, 新图片在写入数据库之前为 None
+    '''
+    id: Optional[int] = None
+    userid: Optional[int] = None
+    username: Optional[str] = None
+    create_time: Optional[datetime] = None
+    platform: Optional[str] = None
+    title: Optional[str] = None
+    page: Optional[int] = None
+    size: Optional[int] = None
+    filename: Optional[str] = None
+    author: Optional[str] = None
+    authorid: Optional[int] = None
+    pid: Optional[str] = None
+    extension: Optional[str] = None
+    url_original_pic: Optional[str] = None
+    url_thumb_pic: Optional[str] = None
+    r18: Optional[bool] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    post_by_guest: bool = False
+    ai: bool = False
+    full_info: Optional[str] = None
+    sent_message_link: Optional[str] = None
+    file_id_thumb: Optional[str] = None
+    file_id_original: Optional[str] = None
+    update_time: Optional[datetime] = None
+    post_count: int = 1
+    file_hash: Optional[str] = None
+
+    @classmethod
+    def from_orm(cls, image: Image) -> "ImageInfo":
+        return cls(**{name: getattr(image, name) for name in IMAGE_FIELDS})
+
+
+IMAGE_FIELDS = [f.name for f in fields(ImageInfo)]
 
 
 class ImageTag(Base):
@@ -59,7 +108,72 @@ class ImageTag(Base):
     tag = Column(String)  # tag
 
 
-Base.metadata.create_all(engine)
+class PixivTag(Base):
+    __tablename__ = "pixiv_tags"
+    tag = Column(String, primary_key=True)  # pixiv 原始 tag
+    translation_en = Column(String)  # 英文翻译, 空字符串表示 pixiv 没有提供翻译
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)  # post / echo
+    status = Column(String, index=True)  # queued / running / done / failed
+    payload = Column(String)  # json, 包括原始的 telegram 消息
+    result = Column(String)  # json, 包括待发原图或错误信息
+    worker = Column(String)  # 正在处理的 worker, hostname:pid
+    attempts = Column(Integer, default=0)
+    lease_until = Column(Float)  # worker 的租约到期时间 (timestamp), 过期后其他 worker 可以接手
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class ArtworkUrl(Base):
+    """
+    链接 -> 作品, 不需要请求作品信息就能按链接去重
+    支持的平台记录规范化后的作品链接, 其他平台 (gallery-dl) 记录 utils.urls.normalize_url 的结果
+    """
+    __tablename__ = "artwork_urls"
+    id = Column(Integer, primary_key=True)
+    url = Column(String, unique=True, index=True)
+    platform = Column(String)
+    pid = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+def add_missing_columns() -> None:
+    """
+    create_all 不会修改已存在的表, 给旧数据库补上新增的列与索引
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def init_db() -> None:
+    """
+    建表并补上新增的列, 启动时调用一次, 不在导入时执行
+    """
+    os.makedirs("./data", exist_ok=True)
+    Base.metadata.create_all(engine)
+    add_missing_columns()
+    if engine.dialect.name == "sqlite":
+        # WAL 模式下 worker 进程写入时, bot 进程仍然可以读取
+        # journal_mode 不能在事务中修改
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("PRAGMA journal_mode=WAL"))
 
 
 @dataclass
@@ -74,6 +188,7 @@ class ArtworkParam:
     :param upscale: 上采样倍数 (需要waifu2x) 
     :param silent: 是否静默发图 (覆盖默认行为) 
     :param spoiler: 是否打上spoiler, 覆盖默认的行为 (给NSFW图片自动加上) 
+    :param profile: 是否对本次发图做采样分析
     '''
     input_tags: list[str] = field(default_factory=list)
     pages: Optional[list[int]] = None
@@ -84,6 +199,7 @@ class ArtworkParam:
     silent: Optional[bool] = None
     spoiler: Optional[bool] = None
     is_NSFW: Optional[bool] = None
+    profile: bool = False
 
 
 @dataclass
@@ -93,7 +209,7 @@ class ArtworkResult:
     :param success: bool 获取图片是否成功
     :param feedback: str admin chat 中 bot 对命令的反馈
     :param caption str 图片的描述
-    :param images: list[Image] 
+    :param images: list[ImageInfo] 
     :param hint_msg: Message feedback 对应的消息, 用作后续编辑
     :param is_NSFW: bool
     :param is_AIGC: bool
@@ -103,11 +219,13 @@ class ArtworkResult:
     :param is_international: 仅对米游社生效, 用于标记是否来源为 hoyolab
     :param cached: 数据库中是否找到了有效的缓存
     :param artwork_param: 传入的参数
+    :param previews: 与 images 一一对应的预览图下载任务, 结果为 None 时使用本地原图
+    :param image_tags: 待写入的 tag, 发送成功后由 save_images 写入
     '''
     success: bool = False
     feedback: Optional[str] = None
     caption: Optional[str] = None
-    images: list[Image] = field(default_factory=list)
+    images: list[ImageInfo] = field(default_factory=list)
     hint_msg: Optional[Message] = None
     is_NSFW: bool = False
     is_AIGC: bool = False
@@ -117,3 +235,5 @@ class ArtworkResult:
     is_international: bool = False
     cached: bool = False
     artwork_param: ArtworkParam = field(default_factory=ArtworkParam)
+    previews: list[asyncio.Task[Optional[bytes]]] = field(default_factory=list)
+    image_tags: list[ImageTag] = field(default_factory=list)
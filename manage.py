@@ -0,0 +1,51 @@
+"""
+数据库的导出与导入, 用于备份, 或者从 sqlite 迁移到其他数据库
+    python manage.py export backup/
+    DB_URL=postgresql://... python manage.py import backup/
+"""
+import argparse
+import sys
+
+from entities import init_db
+from utils.backup import (
+    BATCH_ROWS,
+    CHUNK_ROWS,
+    DEFAULT_TABLES,
+    BackupError,
+    export_database,
+    import_database,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Nahida Picbot 数据库管理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="流式导出为 jsonl.gz")
+    export_parser.add_argument("directory", help="导出目录")
+    export_parser.add_argument("--tables", nargs="+", default=DEFAULT_TABLES)
+    export_parser.add_argument(
+        "--chunk-rows", type=int, default=CHUNK_ROWS, help="每个文件的行数"
+    )
+
+    import_parser = subparsers.add_parser("import", help="导入到 DB_URL 指定的数据库, 目标表必须为空")
+    import_parser.add_argument("directory", help="export 的导出目录")
+    import_parser.add_argument("--tables", nargs="+", help="默认导入导出中的全部表")
+    import_parser.add_argument(
+        "--batch-rows", type=int, default=BATCH_ROWS, help="每次批量插入的行数"
+    )
+
+    args = parser.parse_args()
+    init_db()
+    try:
+        if args.command == "export":
+            export_database(args.directory, args.tables, args.chunk_rows)
+        else:
+            import_database(args.directory, args.tables, args.batch_rows)
+    except BackupError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
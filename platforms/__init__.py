@@ -1,15 +1,61 @@
-from .default import DefaultPlatform
-from .twitter import Twitter
-from .pixiv import Pixiv
-from .miyoushe import MiYouShe
+import importlib
+import sys
+from typing import Any, Optional
 
-import platforms.bilibili as bilibili
+# 各平台模块在第一次用到时才导入, 加快启动速度
+# 使用 platforms.Pixiv 这样的属性访问, 不要 from platforms import *
+_modules = {
+    'DefaultPlatform': '.default',
+    'Twitter': '.twitter',
+    'Pixiv': '.pixiv',
+    'MiYouShe': '.miyoushe',
+    'bilibili': '.bilibili',
+}
+
+# Image.platform -> 平台类名, 用于根据数据库中的记录找回下载参数 (referer 等)
+_platform_classes = {
+    'Pixiv': 'Pixiv',
+    'twitter': 'Twitter',
+    'miyoushe': 'MiYouShe',
+}
 
 # 重导出
-__all__ = [
-    'DefaultPlatform',
-    'Twitter',
-    'Pixiv',
-    'MiYouShe',
-    'bilibili',
-]
\ No newline at end of file
+__all__ = list(_modules)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_modules[name], __name__)
+    value = module if name == 'bilibili' else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def platform_class(platform: Optional[str]) -> Any:
+    """
+    按 Image.platform 取平台类, 对应模块没有导入过时才导入, 未知平台使用 DefaultPlatform
+    """
+    return getattr(sys.modules[__name__], _platform_classes.get(platform or '', 'DefaultPlatform'))
+
+
+def reload() -> list[str]:
+    """
+    按依赖顺序重新加载已经导入的平台模块, 用于 /reload 与 /update
+    正在执行的任务继续使用旧的代码, 之后的调用使用新的代码
+    """
+    default = sys.modules.get(f'{__name__}.default')
+    original_downloads = default.DefaultPlatform.original_downloads if default else {}
+    reloaded: list[str] = []
+    for name in dict.fromkeys(_modules.values()):
+        module = sys.modules.get(f'{__name__}{name}')
+        if module is None:
+            continue
+        importlib.reload(module)
+        reloaded.append(module.__name__)
+    for name in _modules:
+        globals().pop(name, None)
+    if default:
+        # 保留正在下载的原图, 避免重复下载
+        default.DefaultPlatform.original_downloads.update(original_downloads)
+    return reloaded
@@ -5,9 +5,11 @@ from telegram import User
 import requests
 
 from config import config
-from entities import ArtworkParam, Image, ImageTag, ArtworkResult
-from utils import check_duplication, html_esc
-from db import session
+from entities import ArtworkParam, ImageInfo, ImageTag, ArtworkResult
+from utils import check_duplication, duplicate_feedback, html_esc
+from utils.urls import canonicalize
+from utils.prefetch import metadata_cache
+from .default import DefaultPlatform
 
 logger = logging.getLogger(__name__)
 
@@ -15,10 +17,7 @@ platform = "bilibili"
 download_path = f"./data/downloads/{platform}/"
 
 
-if not os.path.exists(download_path):
-    os.makedirs(download_path)
-
-
+@metadata_cache.memoize
 async def get_post(post_id: int | str) -> dict:
     headers = {
         "referer": "https://t.bilibili.com/",
@@ -42,27 +41,14 @@ async def get_post(post_id: int | str) -> dict:
     return None
 
 
-async def download(url: str, path: str, filename: str) -> bool:
-    if os.path.exists(path + filename):
-        return True
-    try:
-        req = requests.get(url)
-        with open(path + filename, "wb") as f:
-            f.write(req.content)
-        return True
-    except Exception as e:
-        logger.error("在下载 bilibili 图片时发生了一个错误")
-        logger.error(e)
-    return False
-
-
 async def get_artworks(
     url: str, artwork_param: ArtworkParam, user: User, post_mode: bool = True
 ) -> ArtworkResult:
     """
     只有 post_mode 和 config.bot_deduplication_mode 都为 True, 才检测重复
     """
-    id = url.strip("/").split("/")[-1]
+    key = canonicalize(url)
+    id = key.pid if key else url.strip("/").split("/")[-1]
 
     post_json = await get_post(id)
     image_list: list = post_json["module_dynamic"]["major"]["opus"]["pics"]
@@ -76,36 +62,29 @@ async def get_artworks(
     msg = f"获取成功！\n" f"<b>{title}</b>\n" f"共有{page_count}张图片\n"
 
     if post_mode and config.bot_deduplication_mode:
-        existing_image = check_duplication(id)
+        existing_image = check_duplication(id, platform)
         if existing_image:
-            logger.warning(f"试图发送重复的图片: {platform}" + str(id))
-            user = User(existing_image.userid, existing_image.username, is_bot=False)
-            return (
-                False,
-                f"该图片已经由 {user.mention_html()} 于 {str(existing_image.create_time)[:-7]} 发过",
-                None,
-                None,
-            )
+            logger.warning(f"试图发送重复的图片: {platform} {id}")
+            return ArtworkResult(False, duplicate_feedback(existing_image))
 
     tags: set[str] = set()
+    image_tags: list[ImageTag] = []
     for tag in artwork_param.input_tags:
         tag = "#" + tag.strip("#")
         if len(tag) <= 3:
             tag = tag.upper()
-        image_tag = ImageTag(pid=id, tag=tag)
-        session.add(image_tag)
+        image_tags.append(ImageTag(pid=id, tag=tag))
         tags.add(tag)
     if "#AI" in tags:
         tags.add("#AI")
         ai = True
 
-    images: list[Image] = []
+    images: list[ImageInfo] = []
     for i in range(page_count):
         extension: str = image_list[i]["url"].split("/")[-1].split(".")[-1]
         filename: str = f"{id}_{i+1}.{extension}"
         size = int(image_list[i]["size"] * 1024)
-        await download(image_list[i]["url"], download_path, filename)
-        image = Image(
+        image = ImageInfo(
             userid=user.id,
             username=user.name,
             platform=platform,
@@ -125,10 +104,13 @@ async def get_artworks(
             height=image_list[i]["height"],
             ai=ai,
         )
+        try:
+            await DefaultPlatform.download_image(image, refer="https://t.bilibili.com/")
+        except Exception as e:
+            logger.error("在下载 bilibili 图片时发生了一个错误")
+            logger.error(e)
         images.append(image)
-        session.add(image)
         msg += f"第{i+1}张图片：{image.width}x{image.height}\n"
-    session.commit()
 
     post_url = f"https://www.bilibili.com/opus/{id}"
     author_url = f"https://space.bilibili.com/{authorid}"
@@ -140,4 +122,6 @@ async def get_artworks(
     if tags:
         caption += f'{" ".join(tags)}\n'
     
-    return ArtworkResult(True, msg, caption, images)
+    artwork_result = ArtworkResult(True, msg, caption, images)
+    artwork_result.image_tags = image_tags
+    return artwork_result
@@ -6,13 +6,17 @@ import logging
 import subprocess
 from typing import Any, Optional
 
-import httpx
 from telegram import User
 
+import platforms
 from config import config
-from entities import ArtworkParam, Image, ImageTag, ArtworkResult
-from utils import check_duplication_via_url, check_cache, get_source_str, html_esc
-from db import session
+from entities import ArtworkParam, Image, ImageInfo, ImageTag, ArtworkResult
+from utils import MAX_FILE_SIZE, MAX_SIDE, check_duplication_via_url, check_cache, duplicate_feedback, get_source_str, html_esc, save_file_hash
+from utils.bandwidth import Priority
+from utils.download import CircuitOpenError, download, download_bytes, promote
+from utils.prefetch import download_cache, metadata_cache, prefetching
+from utils.storage import hash_path, image_path
+from utils.upload import url_upload_tracker
 
 logger = logging.getLogger(__name__)
 
@@ -25,10 +29,18 @@ class DefaultPlatform:
     platform = "default"
     base_downlad_path = f"./data/downloads"
     download_path = f"{base_downlad_path}/{platform}/"
-    if not os.path.exists(download_path):
-        os.makedirs(download_path)
+
+    # 频道预览图的来源
+    # thumb: 使用平台缩放过的 url_thumb_pic, 原图只用于评论区
+    # original: 下载原图, 超出限制时压缩
+    preview_source = "thumb"
+    referer = ""
+
+    # url_original_pic -> 后台下载原图的任务
+    original_downloads: dict[str, asyncio.Task[Optional[bytes]]] = {}
 
     @classmethod
+    @metadata_cache.memoize
     async def get_info_from_gallery_dl(cls, url: str) -> list[list[Any]]:
         try:
             # 要执行的命令, 包括 gallery-dl 命令和要下载的图库URL
@@ -50,21 +62,21 @@ class DefaultPlatform:
             raise GetArtInfoError(f"获取 {cls.platform} 平台图片出错！")
     
     @classmethod
-    async def check_duplication(cls, artwork_info: list[list[Any]], user: User, post_mode: bool) -> ArtworkResult:
+    def duplicated(cls, existing_image: Optional[Image]) -> ArtworkResult:
+        if existing_image:
+            logger.warning(f"试图发送重复的图片: {cls.platform} {existing_image.pid}")
+            return ArtworkResult(False, duplicate_feedback(existing_image))
+        return ArtworkResult(True)
+
+    @classmethod
+    async def check_duplication(cls, url: str, user: User, post_mode: bool) -> ArtworkResult:
         if post_mode and config.bot_deduplication_mode:
-            existing_image = check_duplication_via_url(artwork_info[1][1])
-            if existing_image:
-                logger.warning(f"试图发送重复的图片: {cls.platform}" + existing_image)
-                user = User(existing_image.userid, existing_image.username, is_bot=False)
-                return ArtworkResult(
-                    False,
-                    f"该图片已经由 {user.mention_html()} 于 {str(existing_image.create_time)[:-7]} 发过"
-                )
+            return cls.duplicated(check_duplication_via_url(url))
         return ArtworkResult(True)
     
     @classmethod
-    def check_cache(cls, pid: str, post_mode: bool, user: User) -> Optional[list[Image]]:
-        existing_images =  check_cache(pid, cls.platform)
+    def check_cache(cls, pid: str, post_mode: bool, user: User) -> Optional[list[ImageInfo]]:
+        existing_images = [ImageInfo.from_orm(image) for image in check_cache(pid, cls.platform) or []]
         if existing_images:
             for image in existing_images:
                 image.create_time = datetime.now()
@@ -85,12 +97,12 @@ class DefaultPlatform:
         artwork_info: list[list[Any]], 
         artwork_meta: dict[str, Any], 
         artwork_result: ArtworkResult
-    ) -> list[Image]:
+    ) -> list[ImageInfo]:
         pid: str = artwork_meta.get("id") or artwork_meta.get("gallery_id") or artwork_meta.get("media_id")
         if existing_images := cls.check_cache(pid, post_mode, user):
             artwork_result.cached = True
             return existing_images
-        images: list[Image] = []
+        images: list[ImageInfo] = []
         pages = list(range(1,page_count+1))
         if artwork_result.artwork_param.pages is not None:
             pages = artwork_result.artwork_param.pages
@@ -103,7 +115,7 @@ class DefaultPlatform:
             if image[0] == 3:
                 image_info: dict[str,Any] = image[2]
                 extension = artwork_meta.get("extension") or artwork_meta.get("file_ext")
-                img = Image(
+                img = ImageInfo(
                     userid=user.id,
                     username=user.name,
                     platform=cls.platform,
@@ -131,29 +143,180 @@ class DefaultPlatform:
                 )
                 img.filename = f"{img.pid}_{img.page}.{img.extension}"
                 images.append(img)
-                session.add(img)
                 artwork_result.feedback += f'第{i}张图片：{img.width}x{img.height}\n'
         return images
 
     @classmethod
-    async def download_image(cls, image: Image, refer: str = "") -> None:
-        async with httpx.AsyncClient(http2=True) as client:
-            headers = {
-                "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
-            }
-            if refer:
-                headers["referer"] = refer
-            response = await client.get(image.url_original_pic, headers=headers, timeout=60)
-            response.raise_for_status()
-            file_path = cls.download_path + image.filename
-            if os.path.exists(file_path):
-                return
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            logger.debug(f"已下载：{image.filename}")
-            if not image.size:
-                image.size = os.path.getsize(file_path)
+    def get_headers(cls, refer: str = "") -> dict[str, str]:
+        headers = {
+            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+        }
+        if refer := refer or cls.referer:
+            headers["referer"] = refer
+        return headers
+
+    @classmethod
+    async def download_image(
+        cls, image: ImageInfo, refer: str = "", priority: Optional[Priority] = None
+    ) -> Optional[bytes]:
+        """
+        下载原图到内容寻址存储, 并记录 image.file_hash
+        失败时断点续传并退避重试, 同一平台持续出错时熔断, 直接失败
+        :return: 不超过 IN_MEMORY_MAX 的原图同时返回其内容, 否则返回 None
+        """
+        if os.path.exists(image_path(image)) or cls.reuse_download(image):
+            return None
+        result = await download(
+            image.url_original_pic,
+            image.extension or "bin",
+            cls.get_headers(refer),
+            priority or cls.download_priority(image, Priority.ORIGINAL),
+        )
+        image.file_hash = result.digest
+        logger.debug(f"已下载：{image.filename} -> {image_path(image)}")
+        if not image.size:
+            image.size = result.size
+        await cls.remember_download(image)
+        return result.content
+
+    @staticmethod
+    def reuse_download(image: ImageInfo) -> bool:
+        """
+        刚下载过的原图 (例如预取) 直接使用本地文件
+        """
+        cached: Optional[tuple[str, int]] = download_cache.get(image.url_original_pic)
+        if not cached:
+            return False
+        file_hash, size = cached
+        if not os.path.exists(hash_path(file_hash, image.extension or "bin")):
+            return False
+        image.file_hash = file_hash
+        if not image.size:
+            image.size = size
+        return True
+
+    @staticmethod
+    async def remember_download(image: ImageInfo) -> None:
+        if not image.file_hash:
+            return
+        download_cache.put(image.url_original_pic, (image.file_hash, image.size))
+        if image.id:
+            # 已经由 save_images 写入, 补写 file_hash, 交接后的新进程与前端才能找到原图
+            await asyncio.to_thread(save_file_hash, image.id, image.file_hash)
+
+    @classmethod
+    async def download_preview(cls, image: ImageInfo) -> Optional[bytes]:
+        """
+        下载平台缩放过的预览图到内存, 没有单独的缩略图时返回 None
+        """
+        if (
+            cls.preview_source != "thumb"
+            or not image.url_thumb_pic
+            or image.url_thumb_pic == image.url_original_pic
+        ):
+            return None
+        content = await download_bytes(
+            image.url_thumb_pic,
+            cls.get_headers(),
+            cls.download_priority(image, Priority.PREVIEW),
+        )
+        if len(content) >= MAX_FILE_SIZE:
+            return None
+        return content
+
+    @staticmethod
+    def download_priority(image: ImageInfo, priority: Priority) -> Priority:
+        # guest 请求一律排在 /post 之后
+        return max(priority, Priority.GUEST) if image.post_by_guest else priority
+
+    @classmethod
+    def start_download(
+        cls, image: ImageInfo, priority: Optional[Priority] = None
+    ) -> asyncio.Task[Optional[bytes]]:
+        """
+        在后台下载原图, 同一个 url 只会有一个下载任务
+        """
+        url: str = image.url_original_pic
+        task = DefaultPlatform.original_downloads.get(url)
+        if task is None:
+            task = asyncio.create_task(cls.download_image(image, priority=priority))
+            DefaultPlatform.original_downloads[url] = task
+            task.add_done_callback(lambda _: DefaultPlatform.original_downloads.pop(url, None))
+        else:
+            # 可能是预取中的下载, 按本次的优先级继续
+            promote(url, priority or cls.download_priority(image, Priority.ORIGINAL))
+        return task
+
+    @classmethod
+    async def ensure_original(cls, image: ImageInfo) -> str:
+        """
+        等待后台的原图下载完成, 本地文件不存在时重新下载
+        :return: 原图的本地路径
+        """
+        if task := DefaultPlatform.original_downloads.get(image.url_original_pic):
+            try:
+                await task
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                logger.error(f"后台下载原图失败, 重试: {e}")
+        if not os.path.exists(image_path(image)):
+            await platforms.platform_class(image.platform).download_image(image)
+        return image_path(image)
+
+    @staticmethod
+    def upload_by_url(image: ImageInfo) -> bool:
+        """
+        预览图是否直接以 URL 的形式交给 telegram
+        """
+        size = image.size if image.url_thumb_pic == image.url_original_pic else None
+        return url_upload_tracker.accepts(image.url_thumb_pic, size)
+
+    @classmethod
+    async def get_preview(cls, image: ImageInfo) -> Optional[bytes]:
+        """
+        单页的预览图, 返回 None 时由发图流程读取本地原图 (必要时压缩)
+        缩略图优先, 原图在后台下载, 供评论区使用
+        """
+        if cls.upload_by_url(image):
+            # 预览图由 telegram 直接从 URL 拉取, 本地只准备评论区的原图
+            cls.start_download(image)
+            return None
+        preview: Optional[bytes] = None
+        try:
+            preview = await cls.download_preview(image)
+        except Exception as e:
+            logger.warning(f"下载预览图失败, 改用原图: {e}")
+        # 没有缩略图时原图就是预览图, 按预览图的优先级下载
+        priority = Priority.ORIGINAL if preview else Priority.PREVIEW
+        task = cls.start_download(image, cls.download_priority(image, priority))
+        if preview:
+            return preview
+        # 没有可用的缩略图, 等原图下载完, 小图直接用内存里的内容
+        content = await task
+        if (
+            content
+            and image.width
+            and image.height
+            and max(image.width, image.height) <= MAX_SIDE
+        ):
+            return content
+        return None
+
+    @classmethod
+    def prepare_images(cls, artwork_result: ArtworkResult) -> None:
+        """
+        为每一页创建预览图任务, 不等待下载完成
+        send_media_group 按组等待, 凑齐一组就先发出去, 后面的页继续下载
+        预取时不需要预览图, 原图由 prefetch 下载
+        """
+        if prefetching.get():
+            return
+        artwork_result.previews = [
+            asyncio.create_task(cls.get_preview(image))
+            for image in artwork_result.images
+        ]
 
     @classmethod
     async def get_artworks(
@@ -162,7 +325,7 @@ class DefaultPlatform:
         try:
             artwork_info = await cls.get_info_from_gallery_dl(url)
 
-            artwork_result = await cls.check_duplication(artwork_info, user, post_mode)
+            artwork_result = await cls.check_duplication(url, user, post_mode)
             if not artwork_result.success:
                 return artwork_result
             artwork_result.artwork_param = artwork_param
@@ -176,8 +339,7 @@ class DefaultPlatform:
             artwork_result = await cls.get_tags(artwork_param.input_tags, artwork_meta, artwork_result)
 
             if not artwork_result.cached:
-                tasks = [asyncio.create_task(cls.download_image(image)) for image in artwork_result.images]
-                await asyncio.wait(tasks)
+                cls.prepare_images(artwork_result)
             
             # session.commit() # 移至 command handler 发出 Image Group 之后
             artwork_result = cls.get_caption(artwork_result, artwork_meta)
@@ -186,6 +348,28 @@ class DefaultPlatform:
         except:
             return ArtworkResult(False, "出错了呜呜呜，对不起主人喵，没能成功获取到图片")
 
+    @classmethod
+    async def prefetch(cls, url: str, user: User, pages: int) -> list[ImageInfo]:
+        """
+        投机预取: 获取作品信息 (写入 metadata_cache), 以最低优先级下载前 pages 页原图
+        不写入数据库, 之后的 /post 从缓存中读取作品信息, 原图由 download_cache 找回
+        :return: 预取的图片
+        """
+        token = prefetching.set(True)
+        try:
+            artwork_result = await cls.get_artworks(url, ArtworkParam(), user, post_mode=False)
+        finally:
+            prefetching.reset(token)
+        if not artwork_result.success or artwork_result.cached:
+            # 发过的作品已经有 file_id
+            return []
+        images = artwork_result.images[:pages]
+        await asyncio.gather(
+            *(cls.start_download(image, Priority.PREFETCH) for image in images),
+            return_exceptions=True,
+        )
+        return images
+
     @classmethod
     def get_caption(cls, artwork_result: ArtworkResult, artwork_meta: dict[str, Any]) -> ArtworkResult:
         caption = ''
@@ -218,7 +402,7 @@ class DefaultPlatform:
             input_set.add(tag)
 
             if not artwork_result.cached:
-                session.add(
+                artwork_result.image_tags.append(
                     ImageTag(
                         pid=artwork_meta.get("id") or artwork_meta.get("media_id"), 
                         tag=tag
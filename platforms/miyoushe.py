@@ -3,17 +3,17 @@ from datetime import datetime
 import json
 import os
 import logging
-import re
 from typing import Any, Optional
 
 from telegram import User
 import requests
 
-from entities import ArtworkParam, Image, ImageTag, ArtworkResult
+from config import config
+from entities import ArtworkParam, ImageInfo, ImageTag, ArtworkResult
 from platforms.default import DefaultPlatform
-from platforms.pixiv import Pixiv
-from utils import get_source_str, html_esc
-from db import session
+from utils import check_duplication, get_source_str, html_esc
+from utils.urls import canonicalize
+from utils.prefetch import metadata_cache
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +22,9 @@ class MiYouShe(DefaultPlatform):
 
     platform = "miyoushe"
     download_path = f"{DefaultPlatform.base_downlad_path}/{platform}/"
-    if not os.path.exists(download_path):
-        os.mkdir(download_path)
 
     @classmethod
+    @metadata_cache.memoize
     async def get_post(
         cls, post_id: str, is_global: bool = False
     ) -> Optional[dict[str, Any]]:
@@ -63,12 +62,12 @@ class MiYouShe(DefaultPlatform):
         artwork_info: Optional[list[dict[str, Any]]],
         artwork_meta: dict[str, Any],
         artwork_result: ArtworkResult,
-    ) -> list[Image]:
+    ) -> list[ImageInfo]:
         pid: str = artwork_meta["id"]
         if existing_images := cls.check_cache(pid, post_mode, user):
             artwork_result.cached = True
             return existing_images
-        images: list[Image] = []
+        images: list[ImageInfo] = []
         assert isinstance(artwork_info, list)
         x_oss_process = "?x-oss-process=image//resize,l_2560/quality,q_100/auto-orient,0/interlace,1/format,jpg"
         pages = list(range(1, page_count + 1))
@@ -82,7 +81,7 @@ class MiYouShe(DefaultPlatform):
                     extension = 'jpg'
                 elif extension == 'PNG':
                     extension = 'png'
-            img = Image(
+            img = ImageInfo(
                 userid=user.id,
                 username=user.name,
                 platform=cls.platform,
@@ -104,7 +103,6 @@ class MiYouShe(DefaultPlatform):
                 full_info=json.dumps(image_info if i!=1 else artwork_meta),
             )
             images.append(img)
-            session.add(img)
             assert isinstance(artwork_result.feedback, str)
             artwork_result.feedback += f"第{i}张图片：{img.width}x{img.height}\n"
         logger.debug(images)
@@ -112,7 +110,9 @@ class MiYouShe(DefaultPlatform):
 
     @classmethod
     async def check_duplication(cls, post_id: str, user: User, post_mode: bool) -> ArtworkResult:  # type: ignore
-        return await Pixiv.check_duplication(post_id, user, post_mode)
+        if post_mode and config.bot_deduplication_mode:
+            return cls.duplicated(check_duplication(post_id, cls.platform))
+        return ArtworkResult(True)
 
     @classmethod
     async def get_artworks(
@@ -125,16 +125,14 @@ class MiYouShe(DefaultPlatform):
             https://bbs.mihoyo.com/ys/article/54064752
             https://hoyolab.com/article/30083385
             https://www.hoyolab.com/article/30083385
+            以及 utils.urls.canonicalize 支持的移动端链接
         '''
         try:
             # url 识别
-            reg = re.compile(
-                r"^(?:https?:\/\/)?(?:www\.)?(?:(?:miyoushe|hoyolab|bbs.mihoyo)\.com\/(?:[a-z]+\/)?)article\/(\d+)"
-            )
-            is_global = False
-            post_id = reg.split(url)[1]
-            if 'hoyolab' in url:
-                is_global = True
+            key = canonicalize(url)
+            assert key and key.platform == cls.platform, f"无法识别的米游社链接: {url}"
+            post_id = key.pid
+            is_global = 'hoyolab' in key.url
             artwork_meta = await cls.get_post(post_id, is_global)
             assert artwork_meta
             image_list: list[dict[str, Any]] = artwork_meta["image_list"]
@@ -162,11 +160,7 @@ class MiYouShe(DefaultPlatform):
             )
 
             if not artwork_result.cached:
-                tasks = [
-                    asyncio.create_task(cls.download_image(image))
-                    for image in artwork_result.images
-                ]
-                await asyncio.wait(tasks)
+                cls.prepare_images(artwork_result)
 
             # session.commit() # 移至 command handler 发出 Image Group 之后
             artwork_result = cls.get_caption(artwork_result, artwork_meta)
@@ -229,7 +223,7 @@ class MiYouShe(DefaultPlatform):
             tag = "#" + html_esc(tag.lstrip("#"))
             input_set.add(tag)
             if not artwork_result.cached:
-                session.add(ImageTag(pid=post_id, tag=tag))
+                artwork_result.image_tags.append(ImageTag(pid=post_id, tag=tag))
 
         all_tags = input_set & set(artwork_result.raw_tags)
         artwork_result.is_AIGC = "#AI" in all_tags
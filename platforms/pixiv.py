@@ -10,20 +10,29 @@ from telegram import User
 import httpx
 
 from config import config
-from entities import ArtworkParam, Image, ImageTag, ArtworkResult
+from entities import ArtworkParam, ImageInfo, ImageTag, ArtworkResult
 from utils import check_duplication, get_source_str, html_esc
-from db import session
+from utils.urls import canonicalize
+from utils.bandwidth import Priority
+from utils.download import download, hash_file
+from utils.prefetch import metadata_cache
+from utils.storage import TMP_ROOT, hash_path, image_path, store_file
+from utils.ugoira import encode, ffmpeg_available
 from .default import DefaultPlatform
+from .pixiv_tags import pixiv_tags
 
 logger = logging.getLogger(__name__)
 
+# 动图编码后的扩展名
+UGOIRA_EXTENSION = "mp4"
+
 
 class Pixiv(DefaultPlatform):
 
     platform = "Pixiv"
     download_path = f"{DefaultPlatform.base_downlad_path}/{platform}/"
-    if not os.path.exists(download_path):
-        os.mkdir(download_path)
+
+    referer = "https://www.pixiv.net/"
 
     cookies = {
         "PHPSESSID": config.pixiv_phpsessid,
@@ -31,6 +40,7 @@ class Pixiv(DefaultPlatform):
     }
 
     @classmethod
+    @metadata_cache.memoize
     async def get_info_from_web_api(
         cls, pid: int | str, language: str = ""
     ) -> dict[str, Any]:
@@ -59,6 +69,7 @@ class Pixiv(DefaultPlatform):
             return j["body"]
 
     @classmethod
+    @metadata_cache.memoize
     async def get_multi_page(cls, pid: str) -> list[dict[str, Any]]:
         """
         示例: ./json_examples/pixiv_web_pages.json
@@ -90,16 +101,7 @@ class Pixiv(DefaultPlatform):
     @classmethod
     async def check_duplication(cls, pid: str, user: User, post_mode: bool) -> ArtworkResult:  # type: ignore
         if post_mode and config.bot_deduplication_mode:
-            existing_image = check_duplication(pid)
-            if existing_image:
-                logger.warning(f"试图发送重复的图片: {cls.platform}" + existing_image)
-                user = User(
-                    existing_image.userid, existing_image.username, is_bot=False
-                )
-                return ArtworkResult(
-                    False,
-                    f"该图片已经由 {user.mention_html()} 于 {str(existing_image.create_time)[:-7]} 发过",
-                )
+            return cls.duplicated(check_duplication(pid, cls.platform))
         return ArtworkResult(True)
 
     @classmethod
@@ -115,16 +117,20 @@ class Pixiv(DefaultPlatform):
         https://pixiv.net/artworks/123456
         https://www.pixiv.net/en/artworks/123456
         https://www.pixiv.net/member_illust.php?mode=medium&illust_id=123456
+        以及 utils.urls.canonicalize 支持的其他形式
         """
-        reg = re.compile(
-            r"^(?:https?:\/\/)?(?:www\.)?(?:pixiv\.net\/(?:en\/)?(?:(?:i|artworks)\/|member_illust\.php\?(?:mode=[a-z_]*&)?illust_id=))?(\d+)$"
-        )
         try:
-            pid: str = reg.split(url)[1]
+            key = canonicalize(url)
+            assert key and key.platform == cls.platform, f"无法识别的 Pixiv 链接: {url}"
+            pid = key.pid
 
-            artwork_meta, artwork_meta_en = await asyncio.gather(
-                cls.get_info_from_web_api(pid), cls.get_info_from_web_api(pid, "en")
-            )
+            artwork_meta = await cls.get_info_from_web_api(pid)
+            # 只有词典中缺少翻译时才请求 en 版本的作品信息
+            raw_tags: list[dict[str, Any]] = artwork_meta["tags"]["tags"]
+            if pixiv_tags.need_en(raw_tags):
+                en_meta = await cls.get_info_from_web_api(pid, "en")
+                await pixiv_tags.learn(en_meta["tags"]["tags"])
+            artwork_meta_en = pixiv_tags.to_en_meta(raw_tags)
 
             artwork_result = await cls.check_duplication(pid, user, post_mode)
             if not artwork_result.success:
@@ -149,13 +155,7 @@ class Pixiv(DefaultPlatform):
             )
 
             if not artwork_result.cached:
-                tasks = [
-                    asyncio.create_task(
-                        cls.download_image(image, refer="https://www.pixiv.net/")
-                    )
-                    for image in artwork_result.images
-                ]
-                await asyncio.wait(tasks)
+                cls.prepare_images(artwork_result)
 
             # session.commit() # 移至 command handler 发出 Image Group 之后
             artwork_result = cls.get_caption(artwork_result, artwork_meta)
@@ -177,12 +177,12 @@ class Pixiv(DefaultPlatform):
         artwork_info: Optional[list[dict[str, Any]]],
         artwork_meta: dict[str, Any],
         artwork_result: ArtworkResult,
-    ) -> list[Image]:
+    ) -> list[ImageInfo]:
         pid: str = artwork_meta["id"]
         if existing_images := cls.check_cache(pid, post_mode, user):
             artwork_result.cached = True
             return existing_images
-        images: list[Image] = []
+        images: list[ImageInfo] = []
         assert isinstance(artwork_info, list)
         pages = list(range(1, page_count + 1))
         if artwork_result.artwork_param.pages is not None:
@@ -194,7 +194,7 @@ class Pixiv(DefaultPlatform):
             image_info: dict[str, Union[dict[str, str], str]] = artwork_info[i - 1]
             assert isinstance(image_info["urls"], dict)
             urls: dict[str, str] = image_info["urls"]
-            img = Image(
+            img = ImageInfo(
                 userid=user.id,
                 username=user.name,
                 platform=cls.platform,
@@ -215,13 +215,80 @@ class Pixiv(DefaultPlatform):
                 ai=artwork_result.is_AIGC or artwork_meta["aiType"] == 2,
                 full_info=json.dumps(image_info if i!=1 else artwork_meta),
             )
+            if cls.is_ugoira(artwork_meta):
+                # 动图: 下载帧压缩包, 编码为 mp4 发送
+                img.extension = UGOIRA_EXTENSION
+                img.filename = f"{pid}_ugoira.{UGOIRA_EXTENSION}"
             images.append(img)
-            session.add(img)
             assert isinstance(artwork_result.feedback, str)
             artwork_result.feedback += f"第{i}张图片：{img.width}x{img.height}\n"
         logger.debug(images)
         return images
 
+    @staticmethod
+    def is_ugoira(artwork_meta: dict[str, Any]) -> bool:
+        """
+        illustType 2 为动图, 没有 ffmpeg 时退化为发送第一帧
+        """
+        return artwork_meta.get("illustType") == 2 and ffmpeg_available()
+
+    @classmethod
+    @metadata_cache.memoize
+    async def get_ugoira_meta(cls, pid: int | str) -> dict[str, Any]:
+        """
+        动图的帧信息与压缩包地址
+        {"src": ..., "originalSrc": ..., "mime_type": "image/jpeg", "frames": [{"file": "000000.jpg", "delay": 80}, ...]}
+        """
+        url = f"https://www.pixiv.net/ajax/illust/{pid}/ugoira_meta"
+        async with httpx.AsyncClient(http2=True) as client:
+            response = await client.get(
+                url, cookies=cls.cookies, headers=cls.get_headers(), timeout=30
+            )
+            response.raise_for_status()
+            j: dict[str, Any] = response.json()
+            return j["body"]
+
+    @classmethod
+    async def download_image(
+        cls, image: ImageInfo, refer: str = "", priority: Optional[Priority] = None
+    ) -> Optional[bytes]:
+        """
+        动图下载原始帧的压缩包, 在工作进程中编码为 mp4, 结果按内容寻址保存
+        同一个 pid 之后的发送直接复用数据库中的 Image 与 file_id
+        """
+        if image.extension != UGOIRA_EXTENSION:
+            return await super().download_image(image, refer, priority)
+        if os.path.exists(image_path(image)) or cls.reuse_download(image):
+            return None
+        ugoira_meta = await cls.get_ugoira_meta(image.pid)
+        frames_zip = await download(
+            ugoira_meta["originalSrc"],
+            "zip",
+            cls.get_headers(refer),
+            priority or cls.download_priority(image, Priority.ORIGINAL),
+        )
+        zip_path = hash_path(frames_zip.digest, "zip")
+        try:
+            tmp_path = await encode(zip_path, ugoira_meta["frames"], TMP_ROOT)
+        finally:
+            # 压缩包只是中间产物
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+        image.file_hash = await asyncio.to_thread(hash_file, tmp_path)
+        image.size = os.path.getsize(tmp_path)
+        store_file(tmp_path, image.file_hash, UGOIRA_EXTENSION)
+        await cls.remember_download(image)
+        logger.debug(f"动图编码完成：{image.filename} -> {image_path(image)}")
+        return None
+
+    @classmethod
+    async def get_preview(cls, image: ImageInfo) -> Optional[bytes]:
+        if image.extension == UGOIRA_EXTENSION:
+            # 动图在频道中直接发送 mp4
+            await cls.start_download(image, cls.download_priority(image, Priority.PREVIEW))
+            return None
+        return await super().get_preview(image)
+
     @classmethod
     def get_caption(
         cls, artwork_result: ArtworkResult, artwork_meta: dict[str, Any]
@@ -300,7 +367,7 @@ class Pixiv(DefaultPlatform):
             tag = "#" + html_esc(tag.lstrip("#"))
             input_set.add(tag)
             if not artwork_result.cached:
-                session.add(ImageTag(pid=pid, tag=tag))
+                artwork_result.image_tags.append(ImageTag(pid=pid, tag=tag))
 
         all_tags: set[str] = input_set & set(artwork_result.raw_tags)
         artwork_result.is_AIGC = "#AI" in all_tags
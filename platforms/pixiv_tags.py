@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+from sqlalchemy.exc import OperationalError
+
+from db import Session
+from entities import PixivTag
+
+logger = logging.getLogger(__name__)
+
+
+class PixivTagDictionary:
+    """
+    Pixiv tag -> 英文翻译的本地词典
+    从每次拿到的 en 作品信息中收集, 只有 zh 结果里存在词典中没有的 tag 时, 才需要再请求一次 en
+    """
+
+    def __init__(self) -> None:
+        # 空字符串表示已确认 pixiv 没有提供英文翻译
+        self.translations: Optional[dict[str, str]] = None
+        self.lookups = 0
+        self.hits = 0
+        self.en_requests = 0
+        self.en_requests_saved = 0
+
+    def load(self) -> dict[str, str]:
+        if self.translations is None:
+            with Session() as s:
+                self.translations = {
+                    row.tag: row.translation_en
+                    for row in s.query(PixivTag).yield_per(1000)
+                    if row.translation_en is not None
+                }
+            logger.info(f"已载入 {len(self.translations)} 条 pixiv tag 翻译")
+        return self.translations
+
+    def need_en(self, tags: list[dict[str, Any]]) -> bool:
+        """
+        zh 结果中是否有未知翻译的 tag, 同时统计命中率
+        """
+        translations = self.load()
+        missing = False
+        for tag in tags:
+            self.lookups += 1
+            if tag["tag"] in translations:
+                self.hits += 1
+            else:
+                missing = True
+        if missing:
+            self.en_requests += 1
+        else:
+            self.en_requests_saved += 1
+        return missing
+
+    async def learn(self, tags: list[dict[str, Any]]) -> None:
+        """
+        记录 en 结果中的翻译, 在线程中写入数据库, 写入失败只影响下次启动时的词典
+        """
+        translations = self.load()
+        learned: dict[str, str] = {}
+        for tag in tags:
+            en: str = (tag.get("translation") or {}).get("en", "")
+            if translations.get(tag["tag"]) != en:
+                learned[tag["tag"]] = en
+        if not learned:
+            return
+        translations.update(learned)
+        try:
+            await asyncio.to_thread(self.save, learned)
+        except OperationalError as e:
+            # sqlite 被其他写入锁住超时
+            logger.warning(f"保存 pixiv tag 翻译失败: {e}")
+
+    @staticmethod
+    def save(learned: dict[str, str]) -> None:
+        # 独立的 session, 不与发图流程中尚未提交的数据混在一起
+        with Session() as s:
+            for tag, en in learned.items():
+                s.merge(PixivTag(tag=tag, translation_en=en))
+            s.commit()
+
+    def to_en_meta(self, tags: list[dict[str, Any]]) -> dict[str, Any]:
+        """
+        用词典拼出与 en 请求结构相同的 tag 信息, 供 get_en_tags 使用
+        """
+        translations = self.load()
+        en_tags: list[dict[str, Any]] = []
+        for tag in tags:
+            en_tag: dict[str, Any] = {"tag": tag["tag"]}
+            if en := translations.get(tag["tag"]):
+                en_tag["translation"] = {"en": en}
+            en_tags.append(en_tag)
+        return {"tags": {"tags": en_tags}}
+
+    def stats(self) -> str:
+        hit_rate = self.hits / self.lookups if self.lookups else 0
+        return (
+            f"Pixiv tag 词典: {len(self.translations or {})} 条, 命中率 {hit_rate:.1%}, "
+            f"节省 en 请求 {self.en_requests_saved} 次 / 实际请求 {self.en_requests} 次"
+        )
+
+
+pixiv_tags = PixivTagDictionary()
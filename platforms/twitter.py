@@ -5,9 +5,8 @@ from typing import Any
 
 from telegram import User
 
-from entities import Image, ImageTag, ArtworkResult
+from entities import ImageInfo, ImageTag, ArtworkResult
 from utils import get_source_str, html_esc
-from db import session
 from .default import DefaultPlatform
 
 logger = logging.getLogger(__name__)
@@ -17,8 +16,6 @@ class Twitter(DefaultPlatform):
 
     platform = "twitter"
     download_path = f"{DefaultPlatform.base_downlad_path}/{platform}/"
-    if not os.path.exists(download_path):
-        os.mkdir(download_path)
 
     @classmethod
     async def get_images(
@@ -29,12 +26,12 @@ class Twitter(DefaultPlatform):
         artwork_info: list[list[Any]], 
         artwork_meta: dict[str, Any], 
         artwork_result: ArtworkResult
-    ) -> list[Image]:
+    ) -> list[ImageInfo]:
         pid: str = artwork_meta["tweet_id"]
         if existing_images := cls.check_cache(pid, post_mode, user):
             artwork_result.cached = True
             return existing_images
-        images: list[Image] = []
+        images: list[ImageInfo] = []
         pages = list(range(1, page_count + 1))
         if artwork_result.artwork_param.pages is not None:
             pages = artwork_result.artwork_param.pages
@@ -45,7 +42,7 @@ class Twitter(DefaultPlatform):
             image = artwork_info[i]
             if image[0] == 3:
                 image_info: dict[str,Any] = image[2]
-                img = Image(
+                img = ImageInfo(
                     userid=user.id,
                     username=user.name,
                     platform=cls.platform,
@@ -69,7 +66,6 @@ class Twitter(DefaultPlatform):
                 )
                 img.filename = f"{img.pid}_{img.page}.{img.extension}"
                 images.append(img)
-                session.add(img)
                 artwork_result.feedback += f"第{i}张图片：{img.width}x{img.height}\n"
         logger.debug(images)
         return images
@@ -113,7 +109,7 @@ class Twitter(DefaultPlatform):
             tag = "#" + html_esc(tag.lstrip("#"))
             input_set.add(tag)
             if not artwork_result.cached:
-                session.add(ImageTag(pid=tweet_id, tag=tag))
+                artwork_result.image_tags.append(ImageTag(pid=tweet_id, tag=tag))
 
         all_tags = input_set & set(artwork_result.raw_tags)
         artwork_result.is_AIGC = "#AI" in all_tags
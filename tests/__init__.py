@@ -0,0 +1,12 @@
+"""
+运行: python -m unittest discover -s tests -t .
+测试使用临时目录中的 sqlite, 不读取真实的 BOT_TOKEN 与数据库
+"""
+import os
+import tempfile
+
+DATA_DIR = tempfile.mkdtemp(prefix="nahida-test-")
+
+os.environ["BOT_TOKEN"] = "123:abc"
+os.environ["DB_URL"] = f"sqlite:///{DATA_DIR}/test.db"
+os.environ["DEBUG"] = "False"
@@ -0,0 +1,75 @@
+"""
+本地的 bot api server 替身, 记录收到的请求, 按方法返回最小的合法结果
+"""
+import json
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+BOT_USER = {"id": 123, "is_bot": True, "first_name": "Nahida", "username": "nahida_test_bot"}
+
+
+def message(message_id: int = 1) -> dict[str, Any]:
+    return {"message_id": message_id, "date": 0, "chat": {"id": 1, "type": "private"}}
+
+
+RESULTS: dict[str, Any] = {
+    "getMe": BOT_USER,
+    "sendMessage": message(),
+    "sendDocument": message(),
+    "sendPhoto": message(),
+    "sendMediaGroup": [message()],
+}
+
+
+@dataclass
+class Request:
+    method: str
+    content_type: str
+    body: bytes
+
+
+class BotApiStub:
+    """
+    用法:
+        with BotApiStub() as stub:
+            Application.builder().token(...).base_url(stub.base_url)
+    """
+
+    def __init__(self) -> None:
+        self.requests: list[Request] = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                method = self.path.rsplit("/", 1)[-1]
+                stub.requests.append(Request(method, self.headers.get("Content-Type", ""), body))
+                data = json.dumps({"ok": True, "result": RESULTS.get(method, True)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+
+    def calls(self, method: str) -> list[Request]:
+        return [request for request in self.requests if request.method == method]
+
+    def __enter__(self) -> "BotApiStub":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,102 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from db import Base
+from entities import ArtworkUrl, Image, ImageTag, PixivTag
+from utils import backup
+from utils.backup import MANIFEST, BackupError, export_database, import_database
+
+TABLES = ["images", "imagetags", "artwork_urls", "pixiv_tags"]
+
+
+def create_database(path: str) -> Engine:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def dump(engine: Engine) -> dict[str, list[tuple]]:
+    with engine.connect() as conn:
+        return {
+            name: [tuple(row) for row in conn.execute(select(table).order_by(*table.primary_key))]
+            for name, table in Base.metadata.tables.items()
+            if name in TABLES
+        }
+
+
+class BackupTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, "backup")
+        self.source = create_database(os.path.join(self.tmp.name, "source.db"))
+        self.target = create_database(os.path.join(self.tmp.name, "target.db"))
+        with Session(self.source) as s:
+            for i in range(25):
+                s.add(
+                    Image(
+                        platform="Pixiv",
+                        pid=str(1000 + i // 3),
+                        page=i % 3,
+                        title=f"作品 {i}",
+                        create_time=datetime(2024, 6, 13, 12, 0, i),
+                        post_by_guest=i % 2 == 0,
+                        full_info=None if i % 5 else '{"tags": ["原神"]}',
+                    )
+                )
+            s.add_all(ImageTag(pid=str(1000 + i), tag=f"#tag{i}") for i in range(5))
+            s.add(ArtworkUrl(url="https://www.pixiv.net/artworks/1000", platform="Pixiv", pid="1000"))
+            s.add(PixivTag(tag="原神", translation_en="Genshin Impact"))
+            s.add(PixivTag(tag="オリジナル", translation_en=""))
+            s.commit()
+
+    def tearDown(self) -> None:
+        self.source.dispose()
+        self.target.dispose()
+        self.tmp.cleanup()
+
+    def export(self, chunk_rows: int, tables: list[str] = TABLES) -> None:
+        with mock.patch.object(backup, "engine", self.source), contextlib.redirect_stdout(io.StringIO()):
+            export_database(self.directory, tables, chunk_rows)
+
+    def import_(self, tables: list[str] | None = None) -> None:
+        with mock.patch.object(backup, "engine", self.target), contextlib.redirect_stdout(io.StringIO()):
+            import_database(self.directory, tables, batch_rows=7)
+
+    def test_round_trip(self) -> None:
+        self.export(chunk_rows=10)
+        self.assertIn("images.00002.jsonl.gz", os.listdir(self.directory))
+        self.import_()
+        self.assertEqual(dump(self.target), dump(self.source))
+
+    def test_import_requires_empty_tables(self) -> None:
+        self.export(chunk_rows=10)
+        self.import_(["pixiv_tags"])
+        with self.assertRaises(BackupError):
+            self.import_(["pixiv_tags"])
+
+    def test_incomplete_export_rejected(self) -> None:
+        self.export(chunk_rows=10)
+        os.remove(os.path.join(self.directory, MANIFEST))
+        with self.assertRaises(BackupError):
+            self.import_()
+
+    def test_export_replaces_previous_export(self) -> None:
+        self.export(chunk_rows=10)
+        self.export(chunk_rows=100, tables=["images"])
+        images = [name for name in os.listdir(self.directory) if name.startswith("images.")]
+        self.assertEqual(images, ["images.00000.jsonl.gz"])
+        self.import_()
+        self.assertEqual(dump(self.target)["images"], dump(self.source)["images"])
+
+
+if __name__ == "__main__":
+    unittest.main()
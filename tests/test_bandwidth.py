@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from utils.bandwidth import BandwidthScheduler, Priority
+
+CHUNK = 64 * 1024
+
+
+class BandwidthSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_unlimited_only_counts(self) -> None:
+        scheduler = BandwidthScheduler(0, CHUNK)
+        for _ in range(100):
+            await scheduler.acquire(CHUNK, Priority.PREFETCH)
+        self.assertEqual(scheduler.bytes[Priority.PREFETCH], 100 * CHUNK)
+        self.assertFalse(scheduler.queue)
+
+    async def test_higher_priority_first(self) -> None:
+        # 每秒 20 个 chunk, 先用完积攒的令牌
+        scheduler = BandwidthScheduler(20 * CHUNK, CHUNK)
+        scheduler.tokens = 0
+        order: list[Priority] = []
+
+        async def download(priority: Priority) -> None:
+            await scheduler.acquire(CHUNK, priority)
+            order.append(priority)
+
+        tasks = [asyncio.create_task(download(p)) for p in (Priority.PREFETCH, Priority.GUEST)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(download(p)) for p in (Priority.ORIGINAL, Priority.PREVIEW)]
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, [Priority.PREVIEW, Priority.ORIGINAL, Priority.GUEST, Priority.PREFETCH])
+
+    async def test_rate_limited(self) -> None:
+        scheduler = BandwidthScheduler(20 * CHUNK, CHUNK)
+        scheduler.tokens = 0
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        for _ in range(4):
+            await scheduler.acquire(CHUNK, Priority.ORIGINAL)
+        self.assertGreaterEqual(loop.time() - started_at, 0.15)
+
+    async def test_cancelled_waiter_skipped(self) -> None:
+        scheduler = BandwidthScheduler(20 * CHUNK, CHUNK)
+        scheduler.tokens = 0
+        cancelled = asyncio.create_task(scheduler.acquire(CHUNK, Priority.PREVIEW))
+        waiting = asyncio.create_task(scheduler.acquire(CHUNK, Priority.PREFETCH))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, timeout=1)
+        self.assertTrue(cancelled.cancelled())
+
+
+if __name__ == "__main__":
+    unittest.main()
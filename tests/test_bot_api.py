@@ -0,0 +1,97 @@
+import json
+import os
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs
+
+from telegram.ext import Application
+
+from commands import get_input_media_document
+from config import config
+from entities import ImageInfo
+from tests import DATA_DIR
+from tests.botapi import BotApiStub
+from utils import LOCAL_MAX_UPLOAD_SIZE, MAX_UPLOAD_SIZE, bot_api_options, upload_size_limit
+from utils.storage import hash_path
+
+CONTENT = os.urandom(64 * 1024)
+
+
+class BotApiOptionsTest(unittest.TestCase):
+    def test_official_api(self) -> None:
+        with mock.patch.object(config, "bot_api_base_url", ""):
+            self.assertEqual(bot_api_options(), {})
+
+    def test_derived_file_url(self) -> None:
+        with (
+            mock.patch.object(config, "bot_api_base_url", "http://127.0.0.1:8081/bot/"),
+            mock.patch.object(config, "bot_api_base_file_url", ""),
+            mock.patch.object(config, "bot_api_local_mode", True),
+        ):
+            self.assertEqual(
+                bot_api_options(),
+                {
+                    "base_url": "http://127.0.0.1:8081/bot",
+                    "base_file_url": "http://127.0.0.1:8081/file/bot",
+                    "local_mode": True,
+                },
+            )
+
+    def test_upload_size_limit(self) -> None:
+        with mock.patch.object(config, "bot_api_local_mode", False):
+            self.assertEqual(upload_size_limit(), MAX_UPLOAD_SIZE)
+        with mock.patch.object(config, "bot_api_local_mode", True):
+            self.assertEqual(upload_size_limit(), LOCAL_MAX_UPLOAD_SIZE)
+
+
+class LocalModeUploadTest(unittest.IsolatedAsyncioTestCase):
+    """向 bot api 替身发送原图, local mode 下只传路径"""
+
+    def setUp(self) -> None:
+        # 原图保存在相对路径 ./data/downloads 下
+        self.cwd = os.getcwd()
+        os.chdir(DATA_DIR)
+        self.image = ImageInfo(
+            platform="Pixiv", pid="1", page=0, extension="png", file_hash="0" * 64
+        )
+        path = hash_path(self.image.file_hash, "png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(CONTENT)
+        self.path = os.path.abspath(path)
+
+    def tearDown(self) -> None:
+        os.remove(self.path)
+        os.chdir(self.cwd)
+
+    async def send_original(self, local_mode: bool) -> bytes:
+        with (
+            BotApiStub() as stub,
+            mock.patch.object(config, "bot_api_local_mode", local_mode),
+        ):
+            app = (
+                Application.builder()
+                .token("123:abc")
+                .base_url(stub.base_url)
+                .local_mode(local_mode)
+                .build()
+            )
+            async with app:
+                media = await get_input_media_document(self.image)
+                await app.bot.send_media_group(1, [media])
+            [request] = stub.calls("sendMediaGroup")
+            return request.body
+
+    async def test_local_mode_sends_path(self) -> None:
+        body = await self.send_original(local_mode=True)
+        self.assertNotIn(CONTENT, body)
+        [media] = json.loads(parse_qs(body.decode())["media"][0])
+        self.assertEqual(media["media"], f"file://{self.path}")
+
+    async def test_official_api_uploads_content(self) -> None:
+        body = await self.send_original(local_mode=False)
+        self.assertIn(CONTENT, body)
+
+
+if __name__ == "__main__":
+    unittest.main()
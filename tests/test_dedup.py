@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from config import config
+from db import Session
+from entities import Image, init_db
+from utils.dedup import BloomFilter, PostedFilter
+
+PLATFORM = "dedup-test"
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self) -> None:
+        bloom = BloomFilter(1000, 0.01)
+        keys = [f"Pixiv\0{pid}" for pid in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        # 所有位都已被占用的 key 不计数
+        self.assertAlmostEqual(bloom.count, 1000, delta=10)
+
+    def test_false_positive_rate(self) -> None:
+        bloom = BloomFilter(1000, 0.01)
+        for pid in range(1000):
+            bloom.add(f"Pixiv\0{pid}")
+        false_positives = sum(f"twitter\0{pid}" in bloom for pid in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertAlmostEqual(bloom.expected_error_rate(), 0.01, delta=0.005)
+
+
+class PostedFilterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        init_db()
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "posted.bloom")
+        self.add_image("1")
+        self.add_image("2", post_by_guest=True)
+
+    def tearDown(self) -> None:
+        with Session() as s:
+            s.query(Image).filter_by(platform=PLATFORM).delete()
+            s.commit()
+        self.tmp.cleanup()
+
+    @staticmethod
+    def add_image(pid: str, post_by_guest: bool = False) -> None:
+        with Session() as s:
+            s.add(Image(platform=PLATFORM, pid=pid, page=0, post_by_guest=post_by_guest))
+            s.commit()
+
+    def posted_filter(self) -> PostedFilter:
+        posted = PostedFilter(100, 0.001, self.path)
+        posted.load()
+        return posted
+
+    def test_build_from_database(self) -> None:
+        posted = self.posted_filter()
+        self.assertTrue(posted.might_contain(PLATFORM, "1"))
+        # guest 请求的图片不算发过
+        self.assertFalse(posted.might_contain(PLATFORM, "2"))
+        self.assertEqual(posted.skipped, 1)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_snapshot_catches_up(self) -> None:
+        self.posted_filter()
+        self.add_image("3")
+        posted = self.posted_filter()
+        self.assertTrue(posted.might_contain(PLATFORM, "1"))
+        self.assertTrue(posted.might_contain(PLATFORM, "3"))
+
+    def test_snapshot_of_other_database_ignored(self) -> None:
+        self.posted_filter()
+        with mock.patch.object(config, "db_url", "sqlite:///other.db"):
+            self.assertFalse(PostedFilter(100, 0.001, self.path).load_snapshot())
+
+    def test_worker_mode_bypasses_filter(self) -> None:
+        posted = PostedFilter(100, 0.001, self.path)
+        with mock.patch.object(config, "worker_enabled", True):
+            self.assertTrue(posted.might_contain(PLATFORM, "404"))
+        self.assertIsNone(posted.bloom)
+        self.assertEqual(posted.skipped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
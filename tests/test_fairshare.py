@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+
+from utils.fairshare import ADMIN, GUEST, FairShare, Overloaded, charge
+
+
+def fair_share(slots: int = 1, byte_quota: int = 0, max_guest_queue: int = 100) -> FairShare:
+    return FairShare(
+        slots,
+        {ADMIN: 4, GUEST: 1},
+        {ADMIN: 100, GUEST: 1},
+        byte_quota,
+        byte_window=3600,
+        max_guest_queue=max_guest_queue,
+    )
+
+
+class FairShareTest(unittest.IsolatedAsyncioTestCase):
+    async def test_weighted_between_classes(self) -> None:
+        scheduler = fair_share()
+        order: list[str] = []
+
+        async def request(user_id: int, user_class: str) -> None:
+            async with scheduler.slot(user_id, user_class):
+                order.append(user_class)
+                await asyncio.sleep(0)
+
+        # 占住唯一的位置, 让后面的请求都排队
+        async with scheduler.slot(0, ADMIN):
+            tasks = [asyncio.create_task(request(1, ADMIN)) for _ in range(20)]
+            tasks += [asyncio.create_task(request(100 + i, GUEST)) for i in range(20)]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(order[:10].count(GUEST), 2)
+        self.assertEqual(len(order), 40)
+
+    async def test_guest_per_user_limit(self) -> None:
+        scheduler = fair_share(slots=4)
+        async with scheduler.slot(1, GUEST):
+            with self.assertRaises(Overloaded):
+                async with scheduler.slot(1, GUEST):
+                    pass
+            # 其他 guest 不受影响
+            async with scheduler.slot(2, GUEST):
+                pass
+        async with scheduler.slot(1, GUEST):
+            pass
+        self.assertEqual(scheduler.counters[GUEST]["shed"], 1)
+
+    async def test_guest_byte_quota(self) -> None:
+        scheduler = fair_share(slots=4, byte_quota=1000)
+        async with scheduler.slot(1, GUEST) as usage:
+            charge(600)
+            charge(600)
+        self.assertEqual(usage.bytes, 1200)
+        with self.assertRaises(Overloaded):
+            async with scheduler.slot(1, GUEST):
+                pass
+        # admin 没有字节限额
+        async with scheduler.slot(2, ADMIN):
+            charge(10_000)
+        async with scheduler.slot(2, ADMIN):
+            pass
+
+    async def test_guest_queue_limit(self) -> None:
+        scheduler = fair_share(max_guest_queue=1)
+        async with scheduler.slot(0, ADMIN):
+            queued = asyncio.create_task(scheduler.slot(1, GUEST).__aenter__())
+            await asyncio.sleep(0)
+            with self.assertRaises(Overloaded):
+                async with scheduler.slot(2, GUEST):
+                    pass
+            queued.cancel()
+            await asyncio.gather(queued, return_exceptions=True)
+        self.assertFalse(scheduler.queues[GUEST])
+        self.assertEqual(sum(scheduler.running.values()), 0)
+
+    async def test_cancelled_while_queued(self) -> None:
+        scheduler = fair_share()
+        async with scheduler.slot(0, ADMIN):
+            task = asyncio.create_task(scheduler.slot(1, ADMIN).__aenter__())
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.sleep(0)
+        async with scheduler.slot(2, ADMIN):
+            self.assertEqual(scheduler.running[ADMIN], 1)
+        self.assertFalse(scheduler.user_running)
+        self.assertFalse(scheduler.user_queued)
+
+
+if __name__ == "__main__":
+    unittest.main()
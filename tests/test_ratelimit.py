@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+
+from utils.ratelimit import ChatRateLimiter
+
+
+class ChatRateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_unlimited(self) -> None:
+        limiter = ChatRateLimiter(0)
+        self.assertEqual(await limiter.acquire(1, 1000), 0.0)
+
+    async def test_burst_then_wait(self) -> None:
+        # 每秒补充 10 条
+        limiter = ChatRateLimiter(600)
+        self.assertEqual(await limiter.acquire(1, 600), 0.0)
+        waited = await limiter.acquire(1, 1)
+        self.assertAlmostEqual(waited, 0.1, delta=0.02)
+
+    async def test_album_larger_than_bucket(self) -> None:
+        limiter = ChatRateLimiter(5)
+        # 一次最多扣除整个桶, 不会永远等待
+        self.assertEqual(await limiter.acquire(1, 10), 0.0)
+
+    async def test_chats_independent(self) -> None:
+        limiter = ChatRateLimiter(600)
+        await limiter.acquire(1, 600)
+        waited = await asyncio.gather(limiter.acquire(1, 1), limiter.acquire(2, 10))
+        self.assertGreater(waited[0], 0)
+        self.assertEqual(waited[1], 0.0)
+
+    async def test_same_chat_in_order(self) -> None:
+        limiter = ChatRateLimiter(600)
+        await limiter.acquire(1, 600)
+        order: list[int] = []
+
+        async def send(n: int) -> None:
+            await limiter.acquire(1, 1)
+            order.append(n)
+
+        await asyncio.gather(*(send(n) for n in range(3)))
+        self.assertEqual(order, [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+from utils.urls import ArtworkKey, canonicalize, normalize_url
+
+PIXIV = ArtworkKey("Pixiv", "119574221", "https://www.pixiv.net/artworks/119574221")
+TWITTER = ArtworkKey("twitter", "1801234567890123456", "https://twitter.com/i/web/status/1801234567890123456")
+MIYOUSHE = ArtworkKey("miyoushe", "54064752", "https://www.miyoushe.com/ys/article/54064752")
+HOYOLAB = ArtworkKey("miyoushe", "26744588", "https://www.hoyolab.com/article/26744588")
+BILIBILI = ArtworkKey("bilibili", "939311237519917104", "https://www.bilibili.com/opus/939311237519917104")
+
+
+class CanonicalizeTest(unittest.TestCase):
+    def assertCanonical(self, key: ArtworkKey, *urls: str) -> None:
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(canonicalize(url), key)
+
+    def test_pixiv(self) -> None:
+        self.assertCanonical(
+            PIXIV,
+            "119574221",
+            " https://www.pixiv.net/artworks/119574221 ",
+            "https://www.pixiv.net/en/artworks/119574221",
+            "http://pixiv.net/artworks/119574221/",
+            "www.pixiv.net/artworks/119574221?utm_source=share",
+            "https://www.pixiv.net/member_illust.php?mode=medium&illust_id=119574221",
+            "https://www.pixiv.net/i/119574221",
+            "https://i.pximg.net/img-original/img/2024/06/13/00/00/00/119574221_p0.png",
+            "https://i.pximg.net/img-zip-ugoira/img/2024/06/13/00/00/00/119574221_ugoira1920x1080.zip",
+        )
+
+    def test_twitter(self) -> None:
+        self.assertCanonical(
+            TWITTER,
+            "https://twitter.com/nahida/status/1801234567890123456",
+            "https://x.com/nahida/status/1801234567890123456?s=20",
+            "https://mobile.twitter.com/nahida/status/1801234567890123456",
+            "https://vxtwitter.com/nahida/status/1801234567890123456",
+            "https://fixupx.com/nahida/status/1801234567890123456/photo/1",
+            "https://twitter.com/i/web/status/1801234567890123456",
+        )
+
+    def test_miyoushe(self) -> None:
+        self.assertCanonical(
+            MIYOUSHE,
+            "https://www.miyoushe.com/ys/article/54064752",
+            "https://m.miyoushe.com/ys/#/article/54064752",
+            "https://bbs.mihoyo.com/ys/article/54064752",
+        )
+        self.assertCanonical(
+            HOYOLAB,
+            "https://www.hoyolab.com/article/26744588",
+            "https://m.hoyolab.com/#/article/26744588?utm_source=share",
+        )
+
+    def test_bilibili(self) -> None:
+        self.assertCanonical(
+            BILIBILI,
+            "https://www.bilibili.com/opus/939311237519917104",
+            "https://t.bilibili.com/939311237519917104?share_source=pc_native",
+            "https://m.bilibili.com/dynamic/939311237519917104",
+        )
+
+    def test_unsupported(self) -> None:
+        for url in (
+            "https://www.pixiv.net/users/12345",
+            "https://twitter.com/nahida",
+            "https://www.miyoushe.com/ys/",
+            "https://danbooru.donmai.us/posts/123",
+            "not a url",
+        ):
+            with self.subTest(url=url):
+                self.assertIsNone(canonicalize(url))
+
+
+class NormalizeUrlTest(unittest.TestCase):
+    def test_strips_tracking_and_fragment(self) -> None:
+        self.assertEqual(
+            normalize_url("http://www.Danbooru.donmai.us/posts/123/?utm_source=x&b=2&a=1&ref=home#comments"),
+            "https://danbooru.donmai.us/posts/123?a=1&b=2",
+        )
+
+    def test_same_artwork_same_url(self) -> None:
+        self.assertEqual(
+            normalize_url("danbooru.donmai.us/posts/123"),
+            normalize_url("https://danbooru.donmai.us/posts/123/"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
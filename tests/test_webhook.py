@@ -0,0 +1,131 @@
+import asyncio
+import copy
+import json
+import os
+import socket
+import unittest
+from typing import Any
+
+import httpx
+from telegram import Update
+from telegram.ext import Application
+
+import bot
+from tests.botapi import BotApiStub
+
+SECRET_TOKEN = "nahida-secret"
+CHANNEL_POST = os.path.join(
+    os.path.dirname(__file__), "..", "json_examples", "telegram", "update_sent_photo.json"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def comment_group_forward(update_id: int) -> dict[str, Any]:
+    """录制的频道消息被自动转发到评论区后的 update"""
+    with open(CHANNEL_POST, encoding="utf-8") as f:
+        post = json.load(f)[0]
+    message = copy.deepcopy(post)
+    message["message_id"] = 1000
+    message["chat"] = {"id": -1001234567890, "title": "评论区", "type": "supergroup"}
+    message["from"] = {"id": 777000, "is_bot": False, "first_name": "Telegram"}
+    message["forward_origin"] = {
+        "type": "channel",
+        "chat": post["chat"],
+        "message_id": post["message_id"],
+        "date": post["date"],
+    }
+    message["is_automatic_forward"] = True
+    return {"update_id": update_id, "message": message}
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+    """向 webhook 推送录制的 update, 检查分发到的 handler"""
+
+    async def asyncSetUp(self) -> None:
+        self.stub = BotApiStub().__enter__()
+        self.app = Application.builder().token("123:abc").base_url(self.stub.base_url).build()
+        bot.add_handlers(self.app)
+        self.dispatched: asyncio.Queue[tuple[str, Update]] = asyncio.Queue()
+        for handlers in self.app.handlers.values():
+            for handler in handlers:
+                # @admin 装饰的命令是 admin 实例
+                callback = getattr(handler.callback, "func", handler.callback)
+                handler.callback = self.recorder(callback.__name__)
+        self.port = free_port()
+        await self.app.initialize()
+        await self.app.start()
+        assert self.app.updater is not None
+        await self.app.updater.start_webhook(
+            listen="127.0.0.1",
+            port=self.port,
+            url_path="webhook",
+            webhook_url=f"http://127.0.0.1:{self.port}/webhook",
+            secret_token=SECRET_TOKEN,
+            allowed_updates=bot.get_allowed_updates(self.app),
+        )
+
+    async def asyncTearDown(self) -> None:
+        assert self.app.updater is not None
+        await self.app.updater.stop()
+        await self.app.stop()
+        await self.app.shutdown()
+        self.stub.__exit__()
+
+    def recorder(self, name: str) -> Any:
+        async def callback(update: Update, context: Any) -> None:
+            await self.dispatched.put((name, update))
+
+        return callback
+
+    async def post(self, data: dict[str, Any], secret_token: str = SECRET_TOKEN) -> httpx.Response:
+        async with httpx.AsyncClient() as client:
+            return await client.post(
+                f"http://127.0.0.1:{self.port}/webhook",
+                json=data,
+                headers={"X-Telegram-Bot-Api-Secret-Token": secret_token},
+            )
+
+    async def test_set_webhook_with_derived_allowed_updates(self) -> None:
+        [request] = self.stub.calls("setWebhook")
+        body = request.body.decode()
+        self.assertIn(SECRET_TOKEN, body)
+        self.assertIn("inline_query", body)
+        self.assertNotIn("callback_query", body)
+
+    async def test_comment_group_forward_dispatched(self) -> None:
+        response = await self.post(comment_group_forward(1))
+        self.assertEqual(response.status_code, 200)
+        name, update = await asyncio.wait_for(self.dispatched.get(), timeout=5)
+        self.assertEqual(name, "get_channel_post")
+        self.assertEqual(update.update_id, 1)
+        self.assertTrue(self.dispatched.empty())
+
+    async def test_ugoira_forward_dispatched(self) -> None:
+        data = comment_group_forward(2)
+        message = data["message"]
+        del message["photo"]
+        message["video"] = {
+            "file_id": "video",
+            "file_unique_id": "video",
+            "width": 640,
+            "height": 800,
+            "duration": 3,
+        }
+        await self.post(data)
+        name, _ = await asyncio.wait_for(self.dispatched.get(), timeout=5)
+        self.assertEqual(name, "get_channel_post")
+
+    async def test_wrong_secret_token_rejected(self) -> None:
+        response = await self.post(comment_group_forward(3), secret_token="wrong")
+        self.assertEqual(response.status_code, 403)
+        await asyncio.sleep(0.2)
+        self.assertTrue(self.dispatched.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
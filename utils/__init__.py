@@ -1,18 +1,28 @@
+import asyncio
 import io
 import logging
 import os
 import re
-from typing import Optional
-import PIL.Image
-from db import session
-from sqlalchemy import func
-from entities import ArtworkParam, Image
-from telegram import Message
+from typing import Any, Coroutine, Optional
+from config import config
+from db import Session, session
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from entities import IMAGE_FIELDS, ArtworkParam, ArtworkUrl, Image, ImageInfo, ImageTag
+from telegram import Message, User
+from utils.urls import ArtworkKey, canonicalize, normalize_url
+from utils.dedup import posted_filter
 
 logger = logging.getLogger(__name__)
 
 MAX_SIDE = 2560
 MAX_FILE_SIZE = 10 * 1024 * 1024
+# bot api 上传文件的大小限制, 自建 server 的 local mode 为 2000MB
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+LOCAL_MAX_UPLOAD_SIZE = 2000 * 1024 * 1024
+
+# 常驻后台任务, 保留引用防止被 GC
+_background_tasks: set[asyncio.Task[Any]] = set()
 
 
 """
@@ -45,6 +55,8 @@ def compress_image(
     """
     Compress an image to the target size (in MB) to upload it.
     """
+    import PIL.Image  # 只在需要压缩时才导入, 加快启动
+
     # Open the image
     with PIL.Image.open(input_path) as img:
         # If the image has an alpha (transparency) channel, convert it to RGB
@@ -83,6 +95,8 @@ def is_within_size_limit(input_path: str) -> bool:
     if size >= MAX_FILE_SIZE:
         return False
 
+    import PIL.Image
+
     with PIL.Image.open(input_path) as img:
         width, height = img.size
         if max(height, width) > MAX_SIDE:
@@ -90,16 +104,104 @@ def is_within_size_limit(input_path: str) -> bool:
     return True
 
 
-def check_duplication(pid: int | str) -> Image | None:
-    image = session.query(Image).filter_by(pid=pid, post_by_guest=False).first()
+def bot_api_options() -> dict[str, Any]:
+    """
+    自建 bot api server 的参数, bot.py 与 worker.py 共用
+    """
+    if not config.bot_api_base_url:
+        return {}
+    base_url = config.bot_api_base_url.rstrip("/")
+    base_file_url = config.bot_api_base_file_url
+    if not base_file_url:
+        base_file_url = base_url.removesuffix("/bot") + "/file/bot"
+    return {
+        "base_url": base_url,
+        "base_file_url": base_file_url,
+        "local_mode": config.bot_api_local_mode,
+    }
+
+
+def upload_size_limit() -> int:
+    return LOCAL_MAX_UPLOAD_SIZE if config.bot_api_local_mode else MAX_UPLOAD_SIZE
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def run_in_background(coro: Coroutine[Any, Any, Any]) -> asyncio.Task[Any]:
+    """
+    启动常驻后台任务
+    不使用 Application.create_task, 因为 Application.stop 会等待其中的任务结束
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def check_duplication(pid: int | str, platform: Optional[str] = None) -> Image | None:
+    if platform and not posted_filter.might_contain(platform, str(pid)):
+        # 过滤器中没有, 一定没有发过
+        return None
+    query = session.query(Image).filter_by(pid=str(pid), post_by_guest=False)
+    if platform:
+        query = query.filter_by(platform=platform)
+    image = query.first()
+    if platform:
+        posted_filter.record(image is not None)
     logger.debug(image)
     return image
 
 
+def lookup_url(url: str) -> Optional[ArtworkKey]:
+    """
+    链接 -> 作品, 支持的平台直接解析, 其他平台查询 artwork_urls
+    """
+    if key := canonicalize(url):
+        return key
+    normalized = normalize_url(url)
+    row = session.query(ArtworkUrl).filter_by(url=normalized).first()
+    if row is None:
+        return None
+    return ArtworkKey(row.platform, row.pid, normalized)
+
+
 def check_duplication_via_url(url: str) -> Image | None:
-    image = session.query(Image).filter_by(url=url, post_by_guest=False).first()
-    logger.debug(image)
-    return image
+    """
+    只凭链接去重, 在请求作品信息之前调用
+    """
+    key = lookup_url(url)
+    if key is None:
+        return None
+    return check_duplication(key.pid, key.platform)
+
+
+def remember_url(url: str, platform: str, pid: int | str) -> None:
+    """
+    获取作品成功后记录链接, 下次同一链接不需要请求作品信息就能去重
+    使用独立的 Session, 不提交也不回滚全局 session 中其他请求的改动, 可以在线程中调用
+    """
+    key = canonicalize(url)
+    normalized = key.url if key else normalize_url(url)
+    with Session() as s:
+        if s.query(ArtworkUrl.id).filter_by(url=normalized).first():
+            return
+        s.add(ArtworkUrl(url=normalized, platform=platform, pid=str(pid)))
+        try:
+            s.commit()
+        except IntegrityError:
+            # 同一链接被并发记录
+            s.rollback()
+
+
+def duplicate_feedback(image: Image) -> str:
+    user = User(image.userid, image.username, is_bot=False)
+    return f"该图片已经由 {user.mention_html()} 于 {str(image.create_time)[:-7]} 发过"
 
 
 def check_cache(pid: str, platform: str) -> Optional[list[Image]]:
@@ -114,8 +216,59 @@ def check_cache(pid: str, platform: str) -> Optional[list[Image]]:
     return image
 
 
+def load_images(ids: list[int]) -> list[ImageInfo]:
+    """
+    按 id 读取图片, 保持 ids 的顺序
+    """
+    rows = session.query(Image).filter(Image.id.in_(ids)).all()
+    rows.sort(key=lambda image: ids.index(image.id))
+    return [ImageInfo.from_orm(image) for image in rows]
+
+
+def save_images(images: list[ImageInfo], tags: Optional[list[ImageTag]] = None) -> None:
+    """
+    发图流程的持久化边界: 新图片插入, 缓存命中的图片更新, 只写入非空字段, tags 一并写入
+    写入后丢弃 full_info, 等待发原图期间不再占用内存
+    """
+    rows: list[Image] = []
+    for info in images:
+        image = session.get(Image, info.id) if info.id else None
+        if image is None:
+            image = Image()
+            session.add(image)
+        for name in IMAGE_FIELDS:
+            value = getattr(info, name)
+            if name != "id" and value is not None:
+                setattr(image, name, value)
+        rows.append(image)
+    session.add_all(tags or [])
+    session.commit()
+    for info, image in zip(images, rows):
+        info.id = image.id
+        info.full_info = None
+    posted_filter.add_images(images)
+
+
+def save_file_hash(id: int, file_hash: str) -> None:
+    """
+    save_images 之后才下载完的原图补写 file_hash, 在线程中执行, 使用独立的 Session
+    """
+    with Session() as s:
+        s.query(Image).filter_by(id=id).update({Image.file_hash: file_hash})
+        s.commit()
+
+
 def get_random_image() -> Image:
-    return session.query(Image).order_by(func.random()).first()
+    # 动图的 file_id 不能作为图片发送
+    return (
+        session.query(Image)
+        .filter(
+            Image.file_id_thumb.isnot(None),
+            or_(Image.extension.is_(None), Image.extension != "mp4"),
+        )
+        .order_by(func.random())
+        .first()
+    )
 
 
 def unmark_deduplication(pid: int | str) -> None:
@@ -165,6 +318,17 @@ def parse_page_ranges(page_ranges: str) -> list[int]:
     return sorted(pages)
 
 
+def parse_duration(duration: str) -> float:
+    """
+    解析 30 / 30s / 2m 这样的时长, 返回秒数
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([sm]?)", duration.strip().lower())
+    if not match:
+        raise ValueError(f"无法识别的时长: {duration}")
+    seconds = float(match.group(1))
+    return seconds * 60 if match.group(2) == "m" else seconds
+
+
 def prase_params(words: list[str]) -> ArtworkParam:
     # TODO
     params = ArtworkParam()
@@ -173,7 +337,9 @@ def prase_params(words: list[str]) -> ArtworkParam:
             params.input_tags.append(word)
         elif "=" in word:
             key, value = word.split("=")
-            if "p" in key:
+            if "profile" in key:
+                params.profile = value.lower() not in ("0", "f", "false")
+            elif "p" in key:
                 # pages
                 params.pages = parse_page_ranges(value)
             elif "tag" in key:
@@ -198,6 +364,8 @@ def prase_params(words: list[str]) -> ArtworkParam:
                 params.is_NSFW = "t" in value.lower()
             elif "sfw" in key.lower():
                 params.is_NSFW = "f" in value.lower()
+        elif word == "profile":
+            params.profile = True
         elif "silent" in word:
             params.silent = True
         elif "spoiler" in word:
@@ -0,0 +1,216 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Iterator, Optional
+
+from sqlalchemy import DateTime, Integer, Table, func, select, text
+from sqlalchemy.engine import Connection
+
+from db import Base, engine
+
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+# 每个文件最多保存的行数
+CHUNK_ROWS = 100_000
+# 导出时每次从数据库取的行数, 导入时每次 executemany 的行数
+BATCH_ROWS = 10_000
+# jobs 是临时数据, 不导出
+DEFAULT_TABLES = ["images", "imagetags", "artwork_urls", "pixiv_tags"]
+
+
+class BackupError(Exception):
+    pass
+
+
+class Progress:
+    """每隔 interval 秒输出一次进度与速度"""
+
+    def __init__(self, name: str, total: Optional[int], interval: float = 2.0) -> None:
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.rows = 0
+        self.started_at = self.printed_at = time.perf_counter()
+
+    def update(self, rows: int) -> None:
+        self.rows += rows
+        if time.perf_counter() - self.printed_at >= self.interval:
+            self.print()
+
+    def print(self, done: bool = False) -> None:
+        self.printed_at = time.perf_counter()
+        elapsed = self.printed_at - self.started_at
+        total = f"/{self.total}" if self.total is not None else ""
+        rate = self.rows / elapsed if elapsed > 0 else 0
+        state = f"完成, 耗时 {elapsed:.1f} 秒" if done else "..."
+        print(f"{self.name}: {self.rows}{total} 行, {rate:.0f} 行/秒 {state}", flush=True)
+
+
+def get_table(name: str) -> Table:
+    table = Base.metadata.tables.get(name)
+    if table is None:
+        raise BackupError(f"没有这个表: {name}")
+    return table
+
+
+def encode(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"无法序列化 {type(value)}")
+
+
+def chunk_name(table: Table, index: int) -> str:
+    return f"{table.name}.{index:05d}.jsonl.gz"
+
+
+def export_table(conn: Connection, table: Table, directory: str, chunk_rows: int) -> dict[str, Any]:
+    """
+    按主键顺序流式读取, 写入多个 jsonl.gz 文件, 内存占用与表的大小无关
+    :return: manifest 中该表的信息
+    """
+    total = conn.execute(select(func.count()).select_from(table)).scalar()
+    progress = Progress(table.name, total)
+    columns = [column.name for column in table.columns]
+    chunks: list[str] = []
+    rows_in_chunk = chunk_rows
+    f = None
+    # yield_per 使用服务器端游标 (postgresql 等), sqlite 本身就是逐行读取
+    result = conn.execution_options(yield_per=BATCH_ROWS).execute(
+        select(table).order_by(*table.primary_key.columns)
+    )
+    try:
+        for rows in result.partitions():
+            for row in rows:
+                if rows_in_chunk >= chunk_rows:
+                    if f:
+                        f.close()
+                    chunks.append(chunk_name(table, len(chunks)))
+                    f = gzip.open(os.path.join(directory, chunks[-1]), "wt", encoding="utf-8")
+                    rows_in_chunk = 0
+                assert f
+                f.write(json.dumps(dict(row._mapping), ensure_ascii=False, default=encode))
+                f.write("\n")
+                rows_in_chunk += 1
+            progress.update(len(rows))
+    finally:
+        if f:
+            f.close()
+    progress.print(done=True)
+    return {"columns": columns, "rows": progress.rows, "chunks": chunks}
+
+
+def remove_previous_export(directory: str, tables: list[Table]) -> None:
+    """
+    覆盖已有的导出: 先删除 manifest.json, 中途失败时不会被当成完整的导出, 再删除这些表的旧文件
+    """
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        os.remove(os.path.join(directory, MANIFEST))
+    prefixes = tuple(f"{table.name}." for table in tables)
+    for name in os.listdir(directory):
+        if name.startswith(prefixes) and name.endswith(".jsonl.gz"):
+            os.remove(os.path.join(directory, name))
+
+
+def export_database(directory: str, tables: list[str], chunk_rows: int = CHUNK_ROWS) -> None:
+    """
+    导出到 directory, manifest.json 最后写入, 存在即表示导出完整
+    """
+    os.makedirs(directory, exist_ok=True)
+    remove_previous_export(directory, [get_table(name) for name in tables])
+    manifest: dict[str, Any] = {
+        "version": MANIFEST_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "dialect": engine.dialect.name,
+        "tables": {},
+    }
+    started_at = time.perf_counter()
+    with engine.connect() as conn:
+        for name in tables:
+            manifest["tables"][name] = export_table(conn, get_table(name), directory, chunk_rows)
+    with open(os.path.join(directory, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    rows = sum(t["rows"] for t in manifest["tables"].values())
+    print(f"导出完成: {rows} 行, 耗时 {time.perf_counter() - started_at:.1f} 秒")
+
+
+def read_chunk(path: str, table: Table, columns: list[str]) -> Iterator[dict[str, Any]]:
+    """只保留目标表中存在的列, 旧版本的导出也可以导入"""
+    datetimes = {c.name for c in table.columns if isinstance(c.type, DateTime)}
+    keep = [name for name in columns if name in table.columns]
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            yield {
+                name: (
+                    datetime.fromisoformat(row[name])
+                    if name in datetimes and row.get(name) is not None
+                    else row.get(name)
+                )
+                for name in keep
+            }
+
+
+def reset_sequences(conn: Connection, table: Table) -> None:
+    """postgresql 按原 id 导入后, 自增序列要跟上最大的 id"""
+    if engine.dialect.name != "postgresql":
+        return
+    for column in table.primary_key.columns:
+        if isinstance(column.type, Integer):
+            conn.execute(
+                text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', '{column.name}'), "
+                    f"COALESCE(MAX({column.name}), 1)) FROM {table.name}"
+                )
+            )
+
+
+def import_table(
+    table: Table, directory: str, info: dict[str, Any], batch_rows: int
+) -> int:
+    """
+    每个文件一个事务, 文件内每 batch_rows 行一次 executemany
+    """
+    with engine.connect() as conn:
+        if conn.execute(select(func.count()).select_from(table)).scalar():
+            raise BackupError(f"{table.name} 不为空, 只能导入到空表")
+    progress = Progress(table.name, info["rows"])
+    for chunk in info["chunks"]:
+        with engine.begin() as conn:
+            batch: list[dict[str, Any]] = []
+            for row in read_chunk(os.path.join(directory, chunk), table, info["columns"]):
+                batch.append(row)
+                if len(batch) >= batch_rows:
+                    conn.execute(table.insert(), batch)
+                    progress.update(len(batch))
+                    batch = []
+            if batch:
+                conn.execute(table.insert(), batch)
+                progress.update(len(batch))
+    with engine.begin() as conn:
+        reset_sequences(conn, table)
+    progress.print(done=True)
+    return progress.rows
+
+
+def import_database(
+    directory: str, tables: Optional[list[str]] = None, batch_rows: int = BATCH_ROWS
+) -> None:
+    """
+    从 export_database 的导出导入到当前数据库 (config.db_url), 目标表必须为空
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except OSError:
+        raise BackupError(f"{directory} 中没有 {MANIFEST}, 导出可能没有完成")
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise BackupError(f"不支持的导出版本: {manifest.get('version')}")
+    started_at = time.perf_counter()
+    rows = 0
+    for name in tables or list(manifest["tables"]):
+        if name not in manifest["tables"]:
+            raise BackupError(f"导出中没有这个表: {name}")
+        rows += import_table(get_table(name), directory, manifest["tables"][name], batch_rows)
+    print(f"导入完成: {rows} 行, 耗时 {time.perf_counter() - started_at:.1f} 秒")
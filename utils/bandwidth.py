@@ -0,0 +1,105 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Optional
+
+
+class Priority(IntEnum):
+    """
+    下载的优先级, 数值越小越先分配带宽
+    """
+    # /post 的预览图, 以及没有缩略图时代替预览图的原图
+    PREVIEW = 0
+    # /post 评论区的原图
+    ORIGINAL = 1
+    # /echo 等 guest 请求
+    GUEST = 2
+    # 预取
+    PREFETCH = 3
+
+
+@dataclass(order=True)
+class Waiter:
+    priority: int
+    seq: int
+    nbytes: int = field(compare=False)
+    future: asyncio.Future[None] = field(compare=False)
+    since: float = field(compare=False)
+
+
+class BandwidthScheduler:
+    """
+    全局下载带宽预算 (令牌桶), 每秒补充 rate 字节, 最多积攒 1 秒
+    下载循环每收到一个 chunk 申请一次令牌, 高优先级先分配, 同一优先级按申请顺序,
+    各个下载每个 chunk 重新排队, 并发的多个作品轮流分到带宽
+    拿不到令牌时不再读取, 由 TCP 流控让服务器放慢发送
+    rate 为 0 时不限速, 只做统计
+    """
+
+    def __init__(self, rate: int, chunk_size: int) -> None:
+        self.rate = rate
+        self.burst = max(rate, chunk_size)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.queue: list[Waiter] = []
+        self.counter = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.bytes: Counter[Priority] = Counter()
+        self.waited: Counter[Priority] = Counter()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def dispatch(self) -> None:
+        self.timer = None
+        self.refill()
+        while self.queue:
+            head = self.queue[0]
+            if head.future.done():
+                # 下载被取消
+                heapq.heappop(self.queue)
+                continue
+            if self.tokens < head.nbytes:
+                delay = (head.nbytes - self.tokens) / self.rate
+                self.timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+                return
+            self.tokens -= head.nbytes
+            heapq.heappop(self.queue)
+            self.waited[Priority(head.priority)] += time.monotonic() - head.since
+            head.future.set_result(None)
+
+    async def acquire(self, nbytes: int, priority: Priority) -> None:
+        """
+        申请 nbytes 字节的带宽, 在读取下一个 chunk 之前调用
+        """
+        self.bytes[priority] += nbytes
+        if self.rate <= 0:
+            return
+        waiter = Waiter(
+            priority,
+            next(self.counter),
+            min(nbytes, self.burst),
+            asyncio.get_running_loop().create_future(),
+            time.monotonic(),
+        )
+        heapq.heappush(self.queue, waiter)
+        if self.timer is None:
+            self.dispatch()
+        await waiter.future
+
+    def stats(self) -> str:
+        limit = f"{self.rate / 1024 / 1024:.1f}MB/s" if self.rate > 0 else "不限速"
+        waiting = Counter(Priority(w.priority) for w in self.queue if not w.future.done())
+        lines = [f"下载带宽: {limit}"]
+        for priority in Priority:
+            lines.append(
+                f"  {priority.name.lower()}: {self.bytes[priority] / 1024 / 1024:.1f}MB, "
+                f"排队 {waiting[priority]}, 累计等待 {self.waited[priority]:.1f} 秒"
+            )
+        return "\n".join(lines)
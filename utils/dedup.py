@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime
+from typing import Any, Iterable, Iterator, Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session as OrmSession
+
+from config import config
+from db import Session
+from entities import Image, ImageInfo
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = "./data/posted.bloom"
+SNAPSHOT_VERSION = 1
+# 追赶数据库时向前多查的秒数, 容忍多台机器之间的时钟误差
+SYNC_MARGIN = 60
+
+
+class BloomFilter:
+    """
+    布隆过滤器, 只会误判存在, 不会误判不存在
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: str) -> Iterator[int]:
+        # 双重哈希, 一次 blake2b 得到全部位置
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        added = False
+        for position in self.positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position // 8] & (1 << (position % 8))
+            for position in self.positions(key)
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+    def expected_error_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class PostedFilter:
+    """
+    已发到频道 (非 guest) 的作品 (platform, pid) 的布隆过滤器, 用于去重
+    过滤器中不存在时直接判定没有发过, 不查询数据库; 存在时再用索引查询确认
+    启动时读取快照, 只追赶快照之后的变化, 没有快照时扫描一遍 images 表
+    worker 模式下多个进程同时写入, 过滤器跟不上其他进程, 不使用过滤器, 直接查询数据库
+    """
+
+    def __init__(self, capacity: int, error_rate: float, path: str = SNAPSHOT_PATH) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self.bloom: Optional[BloomFilter] = None
+        self.max_id = 0
+        self.synced_at = 0.0
+        self.skipped = 0
+        self.confirmed = 0
+        self.false_positives = 0
+
+    @property
+    def enabled(self) -> bool:
+        return not config.worker_enabled
+
+    @staticmethod
+    def key(platform: str, pid: str) -> str:
+        return f"{platform}\0{pid}"
+
+    @staticmethod
+    def database_id() -> str:
+        # 换了数据库时快照作废
+        return hashlib.sha1(config.db_url.encode()).hexdigest()[:16]
+
+    def load(self) -> BloomFilter:
+        if self.bloom is not None:
+            return self.bloom
+        started_at = time.perf_counter()
+        if self.load_snapshot():
+            added = self.sync()
+            source = f"快照, 追赶 {added} 条"
+        else:
+            self.build()
+            source = "扫描 images 表"
+        assert self.bloom is not None
+        logger.info(
+            f"去重过滤器已载入 ({source}): {self.bloom.count} 条, "
+            f"{self.bloom.nbytes / 1024:.0f}KB, 耗时 {time.perf_counter() - started_at:.2f} 秒"
+        )
+        return self.bloom
+
+    @staticmethod
+    def rows(s: OrmSession, *criteria: Any) -> Iterable[tuple[int, str, str]]:
+        return (
+            s.query(Image.id, Image.platform, Image.pid)
+            .filter_by(post_by_guest=False)
+            .filter(*criteria)
+            .yield_per(10000)
+        )
+
+    def build(self) -> None:
+        self.synced_at = time.time()
+        with Session() as s:
+            count = s.query(func.count(Image.id)).filter_by(post_by_guest=False).scalar()
+            bloom = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+            max_id = 0
+            for id, platform, pid in self.rows(s):
+                bloom.add(self.key(platform, pid))
+                max_id = max(max_id, id)
+        self.bloom, self.max_id = bloom, max_id
+        self.save()
+
+    def sync(self) -> int:
+        """
+        追赶其他进程写入的数据: 新增的行, 以及由 guest 改为正式发送的行 (create_time 会被更新)
+        :return: 追赶的条数
+        """
+        assert self.bloom is not None
+        since = datetime.fromtimestamp(self.synced_at - SYNC_MARGIN)
+        self.synced_at = time.time()
+        added = 0
+        with Session() as s:
+            for id, platform, pid in self.rows(
+                s, or_(Image.id > self.max_id, Image.create_time >= since)
+            ):
+                self.bloom.add(self.key(platform, pid))
+                self.max_id = max(self.max_id, id)
+                added += 1
+        return added
+
+    def might_contain(self, platform: str, pid: str) -> bool:
+        if not self.enabled:
+            return True
+        bloom = self.load()
+        if self.key(platform, pid) in bloom:
+            return True
+        self.skipped += 1
+        return False
+
+    def record(self, found: bool) -> None:
+        """记录过滤器判定存在之后数据库查询的结果"""
+        if not self.enabled:
+            return
+        self.confirmed += 1
+        if not found:
+            self.false_positives += 1
+
+    def add_images(self, images: list[ImageInfo]) -> None:
+        """写入数据库后调用"""
+        if self.bloom is None:
+            return
+        for image in images:
+            if image.post_by_guest or not image.platform or not image.pid:
+                continue
+            self.bloom.add(self.key(image.platform, str(image.pid)))
+            self.max_id = max(self.max_id, image.id or 0)
+        if self.bloom.count > self.bloom.capacity:
+            logger.warning("去重过滤器超出容量, 误判率上升, 下次启动时重建")
+
+    def save(self) -> None:
+        if self.bloom is None:
+            return
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "database": self.database_id(),
+            "capacity": self.bloom.capacity,
+            "error_rate": self.bloom.error_rate,
+            "count": self.bloom.count,
+            "max_id": self.max_id,
+            "synced_at": self.synced_at,
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(self.bloom.bits)
+        os.replace(tmp_path, self.path)
+
+    def load_snapshot(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                header = json.loads(f.readline())
+                bits = bytearray(f.read())
+        except (OSError, ValueError):
+            return False
+        if (
+            header.get("version") != SNAPSHOT_VERSION
+            or header.get("database") != self.database_id()
+            or header["error_rate"] != self.error_rate
+            or header["count"] > header["capacity"]
+        ):
+            return False
+        bloom = BloomFilter(max(header["capacity"], self.capacity), self.error_rate)
+        if bloom.capacity != header["capacity"] or len(bits) != bloom.nbytes:
+            # 调大了容量
+            return False
+        bloom.bits = bits
+        bloom.count = header["count"]
+        self.bloom = bloom
+        self.max_id = header["max_id"]
+        self.synced_at = header["synced_at"]
+        return True
+
+    def stats(self) -> str:
+        if not self.enabled:
+            return "去重过滤器: worker 模式下不使用"
+        if self.bloom is None:
+            return "去重过滤器: 未载入"
+        return (
+            f"去重过滤器: {self.bloom.count} 条, 占用 {self.bloom.nbytes / 1024:.0f}KB, "
+            f"预计误判率 {self.bloom.expected_error_rate():.3%}, "
+            f"跳过数据库查询 {self.skipped} 次, 确认 {self.confirmed} 次 (误判 {self.false_positives} 次)"
+        )
+
+
+posted_filter = PostedFilter(config.bot_dedup_filter_capacity, config.bot_dedup_filter_error_rate)
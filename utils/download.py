@@ -0,0 +1,345 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from config import config
+from utils.bandwidth import BandwidthScheduler, Priority
+from utils.fairshare import charge
+from utils.storage import TMP_ROOT, store_file
+
+logger = logging.getLogger(__name__)
+
+# 小于该大小的文件下载后同时返回内容, 上传时不再从磁盘读回
+IN_MEMORY_MAX = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = httpx.Timeout(60, connect=10)
+
+bandwidth = BandwidthScheduler(config.download_bandwidth_limit, CHUNK_SIZE)
+# url -> 进行中的下载
+active_downloads: dict[str, "Downloader"] = {}
+
+
+class DownloadError(Exception):
+    pass
+
+
+class CircuitOpenError(DownloadError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    单个 host 的熔断器
+    连续失败 failure_threshold 次后熔断, reset_timeout 秒内直接失败,
+    之后放行一次试探请求, 成功则恢复
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_request(self, host: str) -> None:
+        state = self.state
+        if state == "open" or (state == "half-open" and self.probing):
+            raise CircuitOpenError(f"{host} 暂时不可用, 已熔断")
+        if state == "half-open":
+            self.probing = True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(url: str) -> tuple[str, CircuitBreaker]:
+    host = urlparse(url).hostname or ""
+    if host not in breakers:
+        breakers[host] = CircuitBreaker(
+            config.download_breaker_failures, config.download_breaker_reset
+        )
+    return host, breakers[host]
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    网络错误与 5xx / 408 / 429 可以重试, 其余 4xx 说明请求本身有问题
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        code = e.response.status_code
+        return code >= 500 or code in (408, 429)
+    return isinstance(e, (httpx.TransportError, DownloadError))
+
+
+def backoff(attempt: int) -> float:
+    """
+    带随机抖动的指数退避 (full jitter)
+    """
+    cap = min(config.download_backoff_max, config.download_backoff_base * 2**attempt)
+    return random.uniform(0, cap)
+
+
+async def with_retry(url: str, func, *args):  # type: ignore
+    """
+    按 host 熔断, 并对可重试的错误做指数退避重试
+    """
+    host, breaker = get_breaker(url)
+    attempt = 0
+    while True:
+        breaker.before_request(host)
+        try:
+            result = await func(*args)
+        except Exception as e:
+            retryable = is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if not retryable or attempt >= config.download_max_retries:
+                raise
+            delay = backoff(attempt)
+            attempt += 1
+            logger.warning(f"下载 {url} 失败 ({e!r}), {delay:.1f} 秒后第 {attempt} 次重试")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+@dataclass
+class DownloadResult:
+    digest: str
+    size: int
+    content: Optional[bytes] = None
+
+
+def part_path(url: str, segment: Optional[int] = None) -> str:
+    """
+    未完成的下载以 url 命名, 重试或重启后可以从断点继续
+    """
+    key = hashlib.sha1(url.encode()).hexdigest()
+    suffix = f".part{segment}" if segment is not None else ".part"
+    return f"{TMP_ROOT}/{key}{suffix}"
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Downloader:
+    """
+    单个文件的下载过程
+    - 使用 HTTP Range 从 .part 文件断点续传
+    - 服务器支持 Range 且文件足够大时, 分成多段并行下载
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: dict[str, str],
+        priority: Priority = Priority.ORIGINAL,
+    ) -> None:
+        self.client = client
+        self.url = url
+        self.headers = headers
+        self.priority = priority
+        self.total: Optional[int] = None
+        self.segmented = False
+        # 单连接下载时顺便保留小文件的内容
+        self.buffer: Optional[list[bytes]] = None
+        self.sha256: Optional["hashlib._Hash"] = None
+
+    async def fetch_range(self, path: str, start: int = 0, end: Optional[int] = None) -> None:
+        """
+        下载 [start, end] 区间到 path, path 已有的内容视为已完成的部分
+        """
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if end is not None and start + offset > end:
+            return
+        headers = dict(self.headers)
+        if start + offset or end is not None:
+            headers["Range"] = f"bytes={start + offset}-{'' if end is None else end}"
+        async with self.client.stream("GET", self.url, headers=headers, timeout=TIMEOUT) as response:
+            if response.status_code == 416 and offset:
+                # 已经下载完了
+                return
+            response.raise_for_status()
+            if "Range" in headers and response.status_code != 206:
+                # 服务器不支持 Range, 从头开始
+                if start or end is not None:
+                    raise DownloadError(f"{self.url} 不支持分段下载")
+                offset = 0
+            if self.total is None and not start and end is None:
+                self.total = self.content_length(response, offset)
+                if self.should_split(response, offset):
+                    self.segmented = True
+                    return
+            whole_file = not offset and not start and end is None
+            # 从头开始的单连接下载边下边算 sha256, 续传时改为下载完后读文件计算
+            self.sha256 = hashlib.sha256() if whole_file else None
+            self.buffer = [] if whole_file else None
+            buffered = 0
+            with open(path, "ab" if offset else "wb") as f:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    await bandwidth.acquire(len(chunk), self.priority)
+                    charge(len(chunk))
+                    f.write(chunk)
+                    if self.sha256 is not None:
+                        self.sha256.update(chunk)
+                    if self.buffer is not None:
+                        self.buffer.append(chunk)
+                        buffered += len(chunk)
+                        if buffered > IN_MEMORY_MAX:
+                            self.buffer = None
+        if end is not None and os.path.getsize(path) != end - start + 1:
+            raise DownloadError(f"{self.url} 分段 {start}-{end} 不完整")
+
+    @staticmethod
+    def content_length(response: httpx.Response, offset: int) -> Optional[int]:
+        if response.headers.get("Content-Encoding", "identity") != "identity":
+            # 压缩传输时 Content-Length 与写入的字节数不一致
+            return None
+        if response.status_code == 206:
+            content_range = response.headers.get("Content-Range", "")
+            total = content_range.rsplit("/", 1)[-1]
+            return int(total) if total.isdigit() else None
+        length = response.headers.get("Content-Length")
+        return int(length) + offset if length and length.isdigit() else None
+
+    def should_split(self, response: httpx.Response, offset: int) -> bool:
+        return (
+            not offset
+            and config.download_segments > 1
+            and self.total is not None
+            and self.total >= config.download_segment_threshold
+            and response.headers.get("Accept-Ranges") == "bytes"
+        )
+
+    async def fetch_segments(self) -> str:
+        assert self.total
+        count = config.download_segments
+        step = -(-self.total // count)
+        ranges = [
+            (i, i * step, min((i + 1) * step, self.total) - 1) for i in range(count)
+        ]
+        await asyncio.gather(
+            *(
+                with_retry(self.url, self.fetch_range, part_path(self.url, i), start, end)
+                for i, start, end in ranges
+                if start < self.total
+            )
+        )
+        path = part_path(self.url)
+        with open(path, "wb") as out:
+            for i, start, _ in ranges:
+                if start >= self.total:
+                    continue
+                segment = part_path(self.url, i)
+                with open(segment, "rb") as f:
+                    while chunk := f.read(1024 * 1024):
+                        out.write(chunk)
+                os.remove(segment)
+        return path
+
+    async def run(self) -> str:
+        path = part_path(self.url)
+        await with_retry(self.url, self.fetch_range, path)
+        if self.segmented:
+            logger.debug(f"分段下载 {self.url}, 共 {self.total} 字节")
+            self.sha256 = None
+            path = await self.fetch_segments()
+        if self.total is not None and os.path.getsize(path) != self.total:
+            os.remove(path)
+            raise DownloadError(f"{self.url} 下载不完整")
+        return path
+
+
+def promote(url: str, priority: Priority) -> None:
+    """
+    提高进行中的下载的优先级, 例如 /post 用到了预取中的原图
+    """
+    if (downloader := active_downloads.get(url)) and priority < downloader.priority:
+        downloader.priority = priority
+
+
+async def download(
+    url: str,
+    extension: str,
+    headers: dict[str, str],
+    priority: Priority = Priority.ORIGINAL,
+) -> DownloadResult:
+    """
+    下载文件到内容寻址存储
+    """
+    os.makedirs(TMP_ROOT, exist_ok=True)
+    async with httpx.AsyncClient(http2=True) as client:
+        downloader = Downloader(client, url, headers, priority)
+        active_downloads[url] = downloader
+        try:
+            path = await downloader.run()
+        finally:
+            if active_downloads.get(url) is downloader:
+                del active_downloads[url]
+    content = b"".join(downloader.buffer) if downloader.buffer is not None else None
+    size = os.path.getsize(path)
+    if content is not None and len(content) != size:
+        content = None
+    if downloader.sha256 is not None:
+        digest = downloader.sha256.hexdigest()
+    else:
+        digest = await asyncio.to_thread(hash_file, path)
+    store_file(path, digest, extension)
+    return DownloadResult(digest, size, content)
+
+
+async def download_bytes(
+    url: str, headers: dict[str, str], priority: Priority = Priority.PREVIEW
+) -> bytes:
+    """
+    下载小文件到内存, 例如预览图
+    """
+
+    async def get() -> bytes:
+        chunks: list[bytes] = []
+        async with httpx.AsyncClient(http2=True) as client:
+            async with client.stream("GET", url, headers=headers, timeout=TIMEOUT) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    await bandwidth.acquire(len(chunk), priority)
+                    charge(len(chunk))
+                    chunks.append(chunk)
+        return b"".join(chunks)
+
+    return await with_retry(url, get)
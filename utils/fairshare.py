@@ -0,0 +1,201 @@
+import asyncio
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterator, Optional
+
+ADMIN = "admin"
+GUEST = "guest"
+USER_CLASSES = (ADMIN, GUEST)
+
+
+class Overloaded(Exception):
+    """guest 的请求被拒绝, 消息内容会回复给用户"""
+
+
+@dataclass
+class Usage:
+    """一次请求的资源占用, 下载时通过 current_usage 记账"""
+    user_id: int
+    user_class: str
+    bytes: int = 0
+
+
+@dataclass
+class Waiter:
+    usage: Usage
+    future: asyncio.Future[None]
+    since: float = field(default_factory=time.monotonic)
+
+
+current_usage: ContextVar[Optional[Usage]] = ContextVar("current_usage", default=None)
+
+
+def charge(nbytes: int) -> None:
+    """把下载的字节数记到当前请求的用户上, 不在请求中时忽略"""
+    usage = current_usage.get()
+    if usage is not None:
+        usage.bytes += nbytes
+
+
+@contextmanager
+def measure() -> Iterator[Usage]:
+    """在 worker 中统计一个任务下载的字节数, 随结果返回给前端记账"""
+    usage = Usage(0, "")
+    token = current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_usage.reset(token)
+
+
+class FairShare:
+    """
+    admin 与 guest 之间的加权公平排队
+    - 全局最多同时处理 slots 个请求, 空出位置时按权重在两类用户之间轮流分配, 同一类内按到达顺序
+    - 每个用户同时处理的请求数有上限, 超出时排队 (admin) 或直接拒绝 (guest)
+    - guest 在 byte_window 秒内下载超过 byte_quota 字节后拒绝, 排队的 guest 超过 max_guest_queue 时拒绝
+    """
+
+    def __init__(
+        self,
+        slots: int,
+        weights: dict[str, int],
+        per_user: dict[str, int],
+        byte_quota: int,
+        byte_window: int,
+        max_guest_queue: int,
+    ) -> None:
+        self.slots = slots
+        self.weights = weights
+        self.per_user = per_user
+        self.byte_quota = byte_quota
+        self.byte_window = byte_window
+        self.max_guest_queue = max_guest_queue
+        self.queues: dict[str, deque[Waiter]] = {c: deque() for c in USER_CLASSES}
+        # 虚拟时间, 每分配一个位置前进 1 / 权重, 取最小的一类
+        self.vtime: dict[str, float] = {c: 0.0 for c in USER_CLASSES}
+        self.clock = 0.0
+        self.running: Counter[str] = Counter()
+        self.user_running: Counter[int] = Counter()
+        self.user_queued: Counter[int] = Counter()
+        # 用户 -> (窗口开始时间, 窗口内下载的字节数)
+        self.user_bytes: dict[int, tuple[float, int]] = {}
+        self.counters: defaultdict[str, Counter[str]] = defaultdict(Counter)
+        self.waited: Counter[str] = Counter()
+
+    def window_bytes(self, user_id: int) -> int:
+        started_at, nbytes = self.user_bytes.get(user_id, (0.0, 0))
+        if time.monotonic() - started_at >= self.byte_window:
+            return 0
+        return nbytes
+
+    def add_bytes(self, usage: Usage) -> None:
+        self.counters[usage.user_class]["bytes"] += usage.bytes
+        now = time.monotonic()
+        started_at, nbytes = self.user_bytes.get(usage.user_id, (now, 0))
+        if now - started_at >= self.byte_window:
+            started_at, nbytes = now, 0
+        self.user_bytes[usage.user_id] = (started_at, nbytes + usage.bytes)
+
+    def check(self, user_id: int, user_class: str) -> None:
+        """guest 的请求超出限额或系统繁忙时抛出 Overloaded"""
+        if user_class != GUEST:
+            return
+        reason = ""
+        if self.user_running[user_id] + self.user_queued[user_id] >= self.per_user[GUEST]:
+            reason = "上一张图还在处理中喵，等它发完再来吧"
+        elif self.byte_quota > 0 and self.window_bytes(user_id) >= self.byte_quota:
+            reason = "你最近要的图太多啦，休息一会儿再来喵"
+        elif len(self.queues[GUEST]) >= self.max_guest_queue:
+            reason = "现在太忙了喵，请稍后再试"
+        if reason:
+            self.counters[GUEST]["shed"] += 1
+            raise Overloaded(reason)
+
+    def eligible(self, user_class: str) -> Optional[Waiter]:
+        for waiter in self.queues[user_class]:
+            if waiter.future.done():
+                # 排队时被取消
+                continue
+            if self.user_running[waiter.usage.user_id] < self.per_user[user_class]:
+                return waiter
+        return None
+
+    def dispatch(self) -> None:
+        while sum(self.running.values()) < self.slots:
+            candidates = [
+                (self.vtime[c] + 1 / self.weights[c], c, waiter)
+                for c in USER_CLASSES
+                if (waiter := self.eligible(c))
+            ]
+            if not candidates:
+                return
+            finish, user_class, waiter = min(candidates, key=lambda x: x[:2])
+            self.vtime[user_class] = self.clock = finish
+            self.queues[user_class].remove(waiter)
+            self.grant(waiter.usage)
+            self.waited[user_class] += time.monotonic() - waiter.since
+            waiter.future.set_result(None)
+
+    def grant(self, usage: Usage) -> None:
+        self.running[usage.user_class] += 1
+        self.user_running[usage.user_id] += 1
+        self.counters[usage.user_class]["admitted"] += 1
+
+    def release(self, usage: Usage) -> None:
+        self.running[usage.user_class] -= 1
+        self.user_running[usage.user_id] -= 1
+        if not self.user_running[usage.user_id]:
+            del self.user_running[usage.user_id]
+        self.add_bytes(usage)
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, user_class: str) -> AsyncIterator[Usage]:
+        """
+        占用一个处理位置, 期间的下载记到该用户上
+        :raise Overloaded: guest 被拒绝
+        """
+        self.check(user_id, user_class)
+        usage = Usage(user_id, user_class)
+        queue = self.queues[user_class]
+        if not queue:
+            # 空闲过的一类不能攒下虚拟时间, 否则回来后会连续占满位置
+            self.vtime[user_class] = max(self.vtime[user_class], self.clock)
+        waiter = Waiter(usage, asyncio.get_running_loop().create_future())
+        queue.append(waiter)
+        self.user_queued[user_id] += 1
+        self.dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in queue:
+                queue.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                self.release(usage)
+            raise
+        finally:
+            self.user_queued[user_id] -= 1
+            if not self.user_queued[user_id]:
+                del self.user_queued[user_id]
+        token = current_usage.set(usage)
+        try:
+            yield usage
+        finally:
+            current_usage.reset(token)
+            self.release(usage)
+
+    def stats(self) -> str:
+        lines = [f"公平调度: 同时处理 {sum(self.running.values())}/{self.slots}"]
+        for user_class in USER_CLASSES:
+            counter = self.counters[user_class]
+            lines.append(
+                f"  {user_class}: 处理中 {self.running[user_class]}, "
+                f"排队 {len(self.queues[user_class])}, 已接受 {counter['admitted']}, "
+                f"拒绝 {counter['shed']}, 下载 {counter['bytes'] / 1024 / 1024:.1f}MB, "
+                f"累计等待 {self.waited[user_class]:.1f} 秒"
+            )
+        return "\n".join(lines)
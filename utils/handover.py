@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 新进程通过该环境变量得知旧进程的 pid
+HANDOVER_ENV = "NAHIDA_HANDOVER_PID"
+# 新进程预热完成后写入自己的 pid
+READY_FILE = "./data/handover.ready"
+# 旧进程写入交接状态与待发原图
+STATE_FILE = "./data/handover.json"
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def predecessor_pid() -> Optional[int]:
+    """
+    本进程是由 /update 交接启动时, 返回旧进程的 pid
+    """
+    pid = os.environ.get(HANDOVER_ENV)
+    return int(pid) if pid and pid.isdigit() else None
+
+
+def write_json(path: str, data: dict[str, Any]) -> None:
+    # 先写临时文件再替换, 另一个进程不会读到写了一半的内容
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def notify_main_pid(pid: int) -> None:
+    """
+    在 systemd 下运行时, 告诉 systemd 主进程换成了新进程, 旧进程退出后不会被重新拉起
+    需要在 service 中设置 NotifyAccess=all
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(f"MAINPID={pid}".encode(), address)
+    except OSError as e:
+        logger.warning(f"通知 systemd 失败: {e}")
+
+
+async def wait_until(predicate: Callable[[], bool], timeout: float, interval: float = 0.2) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+class Handover:
+    """
+    /update 的进程交接, 不依赖 systemd 重新拉起
+    1. 旧进程启动新进程, 新进程完成导入、建表、连接等预热后写入 READY_FILE, 在开始拉取 update 前等待
+    2. 旧进程停止拉取 update (webhook 模式下释放端口), 写入 released 状态与待发原图
+    3. 新进程开始拉取 update, 旧进程等待处理中的 update 完成后写入 drained 状态并退出
+    """
+
+    def __init__(self) -> None:
+        self.successor: Optional[subprocess.Popen[bytes]] = None
+        self.released = False
+
+    # 旧进程
+
+    def spawn(self) -> subprocess.Popen[bytes]:
+        for path in (READY_FILE, STATE_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        env = dict(os.environ)
+        env[HANDOVER_ENV] = str(os.getpid())
+        self.successor = subprocess.Popen(
+            [sys.executable, *sys.argv], env=env, start_new_session=True
+        )
+        logger.info(f"已启动新进程 {self.successor.pid}")
+        return self.successor
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """
+        等待新进程预热完成, 新进程提前退出或超时返回 False
+        """
+        process = self.successor
+        assert process is not None
+
+        def ready() -> bool:
+            if process.poll() is not None:
+                return True
+            try:
+                with open(READY_FILE, encoding="utf-8") as f:
+                    return f.read().strip() == str(process.pid)
+            except OSError:
+                return False
+
+        if not await wait_until(ready, timeout) or process.poll() is not None:
+            if process.poll() is None:
+                process.terminate()
+            return False
+        return True
+
+    def release(self, pending: dict[str, list[int]], drained: bool = False) -> None:
+        """
+        写入交接状态, pending 为 "频道 id:频道消息 id" -> 待发原图的 Image.id
+        """
+        if not self.released and self.successor:
+            notify_main_pid(self.successor.pid)
+        self.released = True
+        write_json(
+            STATE_FILE,
+            {
+                "pid": os.getpid(),
+                "released": True,
+                "drained": drained,
+                "pending": pending,
+            },
+        )
+
+    # 新进程
+
+    @staticmethod
+    def mark_ready() -> None:
+        tmp_path = f"{READY_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(os.getpid()))
+        os.replace(tmp_path, READY_FILE)
+
+    @staticmethod
+    def state() -> dict[str, Any]:
+        return read_json(STATE_FILE) or {}
+
+    @classmethod
+    async def wait_for(cls, key: str, timeout: float) -> bool:
+        """
+        等待旧进程进入 released / drained 状态, 旧进程已退出时不再等待
+        """
+        pid = predecessor_pid()
+        if pid is None:
+            return True
+        return await wait_until(
+            lambda: bool(cls.state().get(key)) or not pid_alive(pid), timeout
+        )
+
+    @classmethod
+    def pending(cls) -> dict[str, list[int]]:
+        return cls.state().get("pending", {})
+
+    @staticmethod
+    def finish() -> None:
+        """
+        交接完成, 之后 predecessor_pid() 返回 None, 并删除交接文件
+        """
+        os.environ.pop(HANDOVER_ENV, None)
+        for path in (READY_FILE, STATE_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+handover = Handover()
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Optional
+
+from sqlalchemy import and_, or_
+
+from config import config
+from db import Session
+from entities import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    基于数据库的任务队列, 前端 (bot.py) 写入, worker (worker.py) 领取
+    多个 worker 可以在不同机器上共享同一个数据库
+    worker 领取任务时获得租约, 处理期间定时续约, 租约过期 (worker 崩溃) 的任务可以被其他 worker 接手
+    每个操作使用独立的 Session, 不影响全局的 session
+    """
+
+    def __init__(self, lease: float, max_attempts: int) -> None:
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def enqueue(self, kind: str, payload: dict[str, Any]) -> int:
+        with Session() as s:
+            job = Job(kind=kind, status="queued", payload=json.dumps(payload))
+            s.add(job)
+            s.commit()
+            return job.id
+
+    def queued_count(self) -> int:
+        with Session() as s:
+            return s.query(Job).filter(Job.status == "queued").count()
+
+    def claim(self, worker: str) -> Optional[tuple[int, str, dict[str, Any]]]:
+        """
+        领取最早的一个任务
+        :return: (job id, kind, payload), 没有任务时返回 None
+        """
+        with Session() as s:
+            while True:
+                now = time.time()
+                job = (
+                    s.query(Job)
+                    .filter(
+                        or_(
+                            Job.status == "queued",
+                            and_(Job.status == "running", Job.lease_until < now),
+                        )
+                    )
+                    .order_by(Job.id)
+                    .first()
+                )
+                if job is None:
+                    return None
+                if job.attempts >= self.max_attempts:
+                    job.status = "failed"
+                    job.result = json.dumps({"error": f"重试 {job.attempts} 次后仍未完成"})
+                    s.commit()
+                    continue
+                # 带上读到的状态做条件更新, 多个 worker 抢同一个任务时只有一个成功
+                claimed = (
+                    s.query(Job)
+                    .filter(
+                        Job.id == job.id,
+                        Job.status == job.status,
+                        Job.attempts == job.attempts,
+                    )
+                    .update(
+                        {
+                            Job.status: "running",
+                            Job.worker: worker,
+                            Job.attempts: job.attempts + 1,
+                            Job.lease_until: now + self.lease,
+                        },
+                        synchronize_session=False,
+                    )
+                )
+                s.commit()
+                if claimed:
+                    return job.id, job.kind, json.loads(job.payload)
+
+    def renew(self, job_id: int, worker: str) -> bool:
+        """续约, 任务已被其他 worker 接手时返回 False"""
+        with Session() as s:
+            renewed = (
+                s.query(Job)
+                .filter(Job.id == job_id, Job.worker == worker, Job.status == "running")
+                .update({Job.lease_until: time.time() + self.lease}, synchronize_session=False)
+            )
+            s.commit()
+            return bool(renewed)
+
+    def finish(self, job_id: int, worker: str, result: dict[str, Any], failed: bool = False) -> None:
+        with Session() as s:
+            s.query(Job).filter(Job.id == job_id, Job.worker == worker).update(
+                {
+                    Job.status: "failed" if failed else "done",
+                    Job.result: json.dumps(result),
+                },
+                synchronize_session=False,
+            )
+            s.commit()
+
+    def status(self, job_id: int) -> tuple[str, dict[str, Any]]:
+        with Session() as s:
+            job = s.get(Job, job_id)
+            if job is None:
+                return "failed", {"error": "任务不存在"}
+            return job.status, json.loads(job.result) if job.result else {}
+
+    async def wait(self, job_id: int, interval: float = 0.5) -> tuple[str, dict[str, Any]]:
+        """
+        等待任务完成
+        :return: (done / failed, result)
+        """
+        while True:
+            status, result = self.status(job_id)
+            if status in ("done", "failed"):
+                return status, result
+            await asyncio.sleep(interval)
+
+
+job_queue = JobQueue(config.worker_lease, config.worker_max_attempts)
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from sqlalchemy import exists, text, tuple_
+from sqlalchemy.orm import Session as OrmSession
+
+from config import config
+from db import Session, engine
+from entities import ArtworkUrl, Image, ImageTag, Job
+from utils import format_size
+from utils.storage import COMPRESSED_VARIANT, hash_path
+
+logger = logging.getLogger(__name__)
+
+# 每批删除的行数, 分批提交, 不长时间占用写锁
+BATCH_SIZE = 1000
+# ANALYZE 每个索引最多扫描的行数
+ANALYSIS_LIMIT = 1000
+
+
+class DatabaseMaintenance:
+    """
+    每天在 hour 点 (低峰期) 维护数据库
+    - 删除 guest_retention_days 天前的 guest 图片 (期间被 /post 过的已不再是 guest), 以及只属于它们的 tag、链接与本地原图
+    - 清空 guest_compact_days 天前的 guest 图片的 full_info
+    - 删除 job_retention_days 天前已完成的任务
+    - sqlite: 增量 VACUUM, ANALYZE, PRAGMA optimize, 截断 WAL
+    """
+
+    def __init__(
+        self,
+        hour: int,
+        guest_retention_days: int,
+        guest_compact_days: int,
+        job_retention_days: int,
+    ) -> None:
+        self.hour = hour
+        self.guest_retention_days = guest_retention_days
+        self.guest_compact_days = guest_compact_days
+        self.job_retention_days = job_retention_days
+        self.last_report = ""
+
+    def db_size(self) -> Optional[int]:
+        """sqlite 数据库文件与 WAL 的大小, 其他数据库返回 None"""
+        if engine.dialect.name != "sqlite" or not engine.url.database:
+            return None
+        return sum(
+            os.path.getsize(path)
+            for path in (engine.url.database, f"{engine.url.database}-wal")
+            if os.path.exists(path)
+        )
+
+    @staticmethod
+    def guest_images(days: int, *criteria: Any) -> list[Any]:
+        cutoff = datetime.now() - timedelta(days=days)
+        return [Image.post_by_guest.is_(True), Image.create_time < cutoff, *criteria]
+
+    def purge_guest_images(self, s: OrmSession) -> tuple[int, int]:
+        """
+        :return: (删除的行数, 删除的文件数)
+        """
+        deleted = removed_files = 0
+        criteria = self.guest_images(self.guest_retention_days)
+        while rows := (
+            s.query(Image.id, Image.platform, Image.pid, Image.file_hash, Image.extension)
+            .filter(*criteria)
+            .limit(BATCH_SIZE)
+            .all()
+        ):
+            s.query(Image).filter(Image.id.in_([row.id for row in rows])).delete(
+                synchronize_session=False
+            )
+            artworks = {(row.platform, row.pid) for row in rows}
+            # 作品的其他页或正式发送的记录还在时保留
+            orphans = [
+                artwork
+                for artwork in artworks
+                if not s.query(exists().where(Image.platform == artwork[0], Image.pid == artwork[1])).scalar()
+            ]
+            if orphans:
+                s.query(ArtworkUrl).filter(
+                    tuple_(ArtworkUrl.platform, ArtworkUrl.pid).in_(orphans)
+                ).delete(synchronize_session=False)
+                s.query(ImageTag).filter(
+                    ImageTag.pid.in_({pid for _, pid in orphans}),
+                    ~exists().where(Image.pid == ImageTag.pid),
+                ).delete(synchronize_session=False)
+            s.commit()
+            deleted += len(rows)
+            removed_files += self.remove_files(
+                s, {(row.file_hash, row.extension) for row in rows if row.file_hash}
+            )
+        return deleted, removed_files
+
+    @staticmethod
+    def remove_files(s: OrmSession, files: set[tuple[str, Optional[str]]]) -> int:
+        """删除不再被任何 Image 引用的原图与压缩图"""
+        removed = 0
+        for file_hash, extension in files:
+            if s.query(exists().where(Image.file_hash == file_hash)).scalar():
+                continue
+            for path in (
+                hash_path(file_hash, extension or "bin"),
+                hash_path(file_hash, "jpg", COMPRESSED_VARIANT),
+            ):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def compact_guest_images(self, s: OrmSession) -> int:
+        compacted = 0
+        criteria = self.guest_images(self.guest_compact_days, Image.full_info.isnot(None))
+        while ids := [
+            row.id for row in s.query(Image.id).filter(*criteria).limit(BATCH_SIZE).all()
+        ]:
+            s.query(Image).filter(Image.id.in_(ids)).update(
+                {Image.full_info: None}, synchronize_session=False
+            )
+            s.commit()
+            compacted += len(ids)
+        return compacted
+
+    def purge_jobs(self, s: OrmSession) -> int:
+        cutoff = datetime.now() - timedelta(days=self.job_retention_days)
+        deleted = (
+            s.query(Job)
+            .filter(Job.status.in_(["done", "failed"]), Job.updated_at < cutoff)
+            .delete(synchronize_session=False)
+        )
+        s.commit()
+        return deleted
+
+    @staticmethod
+    def optimize() -> None:
+        if engine.dialect.name == "postgresql":
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text("ANALYZE"))
+            return
+        if engine.dialect.name != "sqlite":
+            return
+        # VACUUM 与部分 PRAGMA 不能在事务中执行
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+                # 已有的数据库需要完整 VACUUM 一次才能切换为增量模式
+                logger.info("数据库切换为增量 VACUUM 模式, 执行一次完整 VACUUM")
+                conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+                conn.execute(text("VACUUM"))
+            else:
+                # 每一步只释放一页, 需要取完全部结果
+                # sqlalchemy 会直接关闭没有列的结果, 使用 DBAPI 的 cursor
+                cursor = conn.connection.cursor()
+                try:
+                    cursor.execute("PRAGMA incremental_vacuum")
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+            conn.execute(text(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}"))
+            conn.execute(text("ANALYZE"))
+            conn.execute(text("PRAGMA optimize"))
+            conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)")).fetchall()
+
+    def run_once(self) -> str:
+        """在线程中执行, 使用独立的 Session"""
+        started_at = time.perf_counter()
+        size_before = self.db_size()
+        with Session() as s:
+            deleted, removed_files = (
+                self.purge_guest_images(s) if self.guest_retention_days > 0 else (0, 0)
+            )
+            compacted = self.compact_guest_images(s) if self.guest_compact_days > 0 else 0
+            jobs = self.purge_jobs(s) if self.job_retention_days > 0 else 0
+        self.optimize()
+        size_after = self.db_size()
+        size = (
+            f"{format_size(size_before)} -> {format_size(size_after)}"
+            if size_before is not None and size_after is not None
+            else "未知"
+        )
+        self.last_report = (
+            f"数据库维护 ({datetime.now():%Y-%m-%d %H:%M}): 删除 guest 图片 {deleted} 条 "
+            f"(本地文件 {removed_files} 个), 清空 full_info {compacted} 条, 删除任务 {jobs} 条, "
+            f"数据库大小 {size}, 耗时 {time.perf_counter() - started_at:.1f} 秒"
+        )
+        return self.last_report
+
+    def seconds_until_next_run(self) -> float:
+        now = datetime.now()
+        next_run = now.replace(hour=self.hour, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        return (next_run - now).total_seconds()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.seconds_until_next_run())
+            try:
+                logger.info(await asyncio.to_thread(self.run_once))
+            except Exception as e:
+                logger.error(f"数据库维护出错: {e}")
+
+    def stats(self) -> str:
+        if self.hour < 0:
+            return "数据库维护: 未开启"
+        return self.last_report or f"数据库维护: 每天 {self.hour} 点执行, 尚未执行"
+
+
+database_maintenance = DatabaseMaintenance(
+    config.db_maintenance_hour,
+    config.db_guest_retention_days,
+    config.db_guest_compact_days,
+    config.db_job_retention_days,
+)
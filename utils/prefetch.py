@@ -0,0 +1,174 @@
+import asyncio
+import copy
+import functools
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, Optional, TypeVar
+
+from config import config
+from db import session
+from entities import Image, ImageInfo
+from utils.storage import image_path
+from utils.urls import canonicalize, normalize_url
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 为 True 时处于投机预取中, 平台不创建预览图任务
+prefetching: ContextVar[bool] = ContextVar("prefetching", default=False)
+
+
+class TTLCache:
+    """
+    带过期时间的缓存
+    memoize 缓存异步函数的结果, 相同参数的并发调用共享同一个请求, 出错或返回 None 时不缓存
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.entries: dict[Hashable, tuple[float, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def purge(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+        return len(expired)
+
+    def memoize(self, func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+            task: Optional[asyncio.Future[T]] = self.get(key)
+            if task is None:
+                self.misses += 1
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                self.put(key, task)
+            else:
+                self.hits += 1
+            try:
+                # 调用方被取消时不影响共享的请求
+                value = await asyncio.shield(task)
+            except Exception:
+                if self.get(key) is task:
+                    del self.entries[key]
+                raise
+            if value is None and self.get(key) is task:
+                del self.entries[key]
+            # 调用方可能修改返回的 dict
+            return copy.deepcopy(value)
+
+        return wrapper
+
+
+@dataclass
+class Prefetch:
+    expires_at: float
+    task: asyncio.Task[list[ImageInfo]]
+    images: list[ImageInfo] = field(default_factory=list)
+
+
+class Prefetcher:
+    """
+    私聊分享链接时的投机预取, 按规范化后的链接记录
+    之后的 /post 或 /echo 用到时移出记录, 由发图流程接手; 过期仍未使用的取消下载, 并删除没有被 Image 引用的原图
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.entries: dict[str, Prefetch] = {}
+        self.started = 0
+        self.used = 0
+        self.abandoned = 0
+        self.removed_files = 0
+
+    @staticmethod
+    def key(url: str) -> str:
+        key = canonicalize(url)
+        return key.url if key else normalize_url(url)
+
+    def start(self, url: str, fetch: Callable[[], Awaitable[list[ImageInfo]]]) -> None:
+        key = self.key(url)
+        if (entry := self.entries.get(key)) and entry.expires_at > time.monotonic():
+            return
+        self.started += 1
+        task = asyncio.ensure_future(fetch())
+        entry = Prefetch(time.monotonic() + self.ttl, task)
+        self.entries[key] = entry
+        task.add_done_callback(lambda t: self.finished(entry, t))
+
+    @staticmethod
+    def finished(entry: Prefetch, task: asyncio.Task[list[ImageInfo]]) -> None:
+        if task.cancelled():
+            return
+        if e := task.exception():
+            logger.warning(f"预取失败: {e}")
+            return
+        entry.images = task.result()
+
+    def use(self, url: str) -> bool:
+        """/post 或 /echo 开始处理时调用, 返回是否命中预取"""
+        if self.entries.pop(self.key(url), None) is None:
+            return False
+        self.used += 1
+        return True
+
+    def purge(self) -> None:
+        now = time.monotonic()
+        for key, entry in list(self.entries.items()):
+            if entry.expires_at > now:
+                continue
+            del self.entries[key]
+            self.abandoned += 1
+            entry.task.cancel()
+            self.remove_files(entry.images)
+
+    def remove_files(self, images: list[ImageInfo]) -> None:
+        for image in images:
+            if not image.file_hash:
+                continue
+            with session.no_autoflush:
+                if session.query(Image.id).filter_by(file_hash=image.file_hash).first():
+                    continue
+            try:
+                os.remove(image_path(image))
+                self.removed_files += 1
+            except OSError:
+                pass
+
+    async def run(self, interval: float, *caches: TTLCache) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.purge()
+                for cache in caches:
+                    cache.purge()
+            except Exception as e:
+                logger.error(f"清理预取出错: {e}")
+
+    def stats(self) -> str:
+        return (
+            f"预取: 进行中 {len(self.entries)}, 共 {self.started} 次, 命中 {self.used} 次, "
+            f"过期 {self.abandoned} 次 (删除 {self.removed_files} 个文件)"
+        )
+
+
+metadata_cache = TTLCache(config.bot_prefetch_ttl)
+# 原图 url -> (sha256, 大小), 预取或刚发过的原图不再重复下载
+download_cache = TTLCache(config.bot_prefetch_ttl)
+prefetcher = Prefetcher(config.bot_prefetch_ttl)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import CodeType, FrameType
+from typing import Any, Coroutine, Optional, TypeVar
+
+from utils.watchdog import PROJECT_ROOT, is_project_file
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ROOT = "./data/profiles"
+
+T = TypeVar("T")
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+def short_filename(filename: str) -> str:
+    if is_project_file(filename):
+        return os.path.relpath(filename, PROJECT_ROOT)
+    if "site-packages" in filename:
+        return filename.split("site-packages" + os.sep, 1)[-1]
+    return os.path.basename(filename)
+
+
+class SamplingProfiler:
+    """
+    按需开启的采样分析器
+    开启后由旁路线程每隔 interval 秒通过 sys._current_frames 抓取所有线程的调用栈,
+    结束时输出 collapsed stack 格式 (flamegraph.pl / speedscope 均可打开)
+    不开启时没有任何开销
+    """
+
+    def __init__(self, interval: float = 0.005, root: str = PROFILE_ROOT) -> None:
+        self.interval = interval
+        self.root = root
+        self.samples: Counter[str] = Counter()
+        self.labels: dict[CodeType, str] = {}
+        self.started_at = 0.0
+        self.sample_count = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def label(self, code: CodeType) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({short_filename(code.co_filename)}:{code.co_firstlineno})"
+            label = self.labels[code] = label.replace(";", ":")
+        return label
+
+    def collapse(self, thread_name: str, frame: Optional[FrameType]) -> str:
+        stack: list[str] = []
+        while frame is not None:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ";".join(reversed(stack))
+
+    def sample(self) -> None:
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            self.samples[self.collapse(names.get(ident, str(ident)), frame)] += 1
+        self.sample_count += 1
+
+    def loop(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def start(self) -> None:
+        if self.running:
+            raise ProfilerBusyError("已经有一个分析任务在运行")
+        self.samples.clear()
+        self.sample_count = 0
+        self.started_at = time.monotonic()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.loop, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"采样分析已开启, 间隔 {self.interval * 1000:g} ms")
+
+    def stop(self, name: str = "profile") -> str:
+        """
+        停止采样并写入文件
+        :return: 文件路径
+        """
+        assert self._thread is not None
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        elapsed = time.monotonic() - self.started_at
+        os.makedirs(self.root, exist_ok=True)
+        path = f"{self.root}/{name}-{datetime.now():%Y%m%d-%H%M%S}.collapsed.txt"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"采样分析结束: {elapsed:.1f} 秒, {self.sample_count} 次采样, 写入 {path}")
+        return path
+
+    async def run_for(self, seconds: float) -> str:
+        self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            path = self.stop()
+        return path
+
+    async def profile(self, coro: Coroutine[Any, Any, T], name: str) -> tuple[T, str]:
+        """
+        分析单次调用, 期间并发处理的其他 update 也会被采样到
+        """
+        try:
+            self.start()
+        except ProfilerBusyError:
+            coro.close()
+            raise
+        try:
+            result = await coro
+        finally:
+            path = self.stop(name)
+        return result, path
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRateLimiter:
+    """
+    每个会话一个令牌桶, 每分钟最多发送 per_minute 条消息, 相册中每张图计一条
+    同一会话的请求按到达顺序排队, 不同会话之间互不影响
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.per_minute = per_minute
+        # 会话 -> (剩余令牌, 更新时间)
+        self.buckets: dict[int | str, tuple[float, float]] = {}
+        self.locks: defaultdict[int | str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+    async def acquire(self, chat_id: int | str, cost: int = 1) -> float:
+        """
+        等待直到可以向 chat_id 发送 cost 条消息
+        :return: 等待的秒数
+        """
+        if self.per_minute <= 0:
+            return 0.0
+        cost = min(cost, self.per_minute)
+        async with self.locks[chat_id]:
+            now = time.monotonic()
+            tokens, updated_at = self.buckets.get(chat_id, (self.per_minute, now))
+            tokens = min(self.per_minute, tokens + (now - updated_at) * self.rate)
+            waited = 0.0
+            if tokens < cost:
+                waited = (cost - tokens) / self.rate
+                logger.debug(f"{chat_id} 发送过快, 等待 {waited:.1f} 秒")
+                await asyncio.sleep(waited)
+                tokens, now = cost, time.monotonic()
+            self.buckets[chat_id] = (tokens - cost, now)
+            return waited
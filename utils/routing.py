@@ -0,0 +1,60 @@
+from config import Route, config
+from entities import ArtworkResult
+
+
+def routes() -> list[Route]:
+    """
+    生效的路由规则, 没有设置 bot_routes 时沿用 AI 分流的配置
+    """
+    if config.bot_routes:
+        return config.bot_routes
+    if config.bot_enable_ai_redirect and config.bot_enable_ai_redirect_channel:
+        return [Route(channel=config.bot_enable_ai_redirect_channel, ai=True)]
+    return []
+
+
+def default_route() -> Route:
+    return Route(channel=config.bot_channel, comment_group=config.bot_channel_comment_group)
+
+
+def normalize_tag(tag: str) -> str:
+    return tag.lstrip("#").lower()
+
+
+def matches(route: Route, artwork_result: ArtworkResult) -> bool:
+    image = artwork_result.images[0]
+    if route.r18 is not None and bool(image.r18) != route.r18:
+        return False
+    ai = bool(image.ai or artwork_result.is_AIGC)
+    if route.ai is not None and ai != route.ai:
+        return False
+    if route.platforms and image.platform not in route.platforms:
+        return False
+    if route.authors and not {image.author, str(image.authorid)} & set(route.authors):
+        return False
+    if route.tags:
+        tags = {normalize_tag(tag) for tag in artwork_result.tags + artwork_result.raw_tags}
+        if not tags & {normalize_tag(tag) for tag in route.tags}:
+            return False
+    return True
+
+
+def route(artwork_result: ArtworkResult) -> list[Route]:
+    """
+    作品要发往的频道, 按规则顺序去重, 一条都没命中时发到 bot_channel
+    """
+    matched: dict[str, Route] = {}
+    for rule in routes():
+        if rule.channel not in matched and matches(rule, artwork_result):
+            matched[rule.channel] = rule
+    return list(matched.values()) or [default_route()]
+
+
+def channels() -> list[str]:
+    return list(dict.fromkeys([config.bot_channel, *(rule.channel for rule in routes())]))
+
+
+def comment_groups() -> list[int]:
+    groups = [config.bot_channel_comment_group]
+    groups += [rule.comment_group for rule in routes() if rule.comment_group]
+    return list(dict.fromkeys(groups))
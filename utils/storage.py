@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from sqlalchemy.orm import Session as OrmSession
+
+from config import config
+from db import Session
+from entities import Image, ImageInfo
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADS = "./data/downloads"
+HASH_ROOT = f"{DOWNLOADS}/sha256"
+TMP_ROOT = f"{DOWNLOADS}/tmp"
+COMPRESSED_PREFIX = "compressed_"
+COMPRESSED_VARIANT = "compressed"
+
+
+def hash_path(digest: str, extension: str, variant: str = "") -> str:
+    """
+    内容寻址的存储路径: sha256/ab/cd/abcd....ext
+    两级分片, 单个目录下的文件数不会无限增长
+    """
+    extension = extension.lower().replace("jpeg", "jpg")
+    name = f"{digest}.{variant}.{extension}" if variant else f"{digest}.{extension}"
+    return f"{HASH_ROOT}/{digest[:2]}/{digest[2:4]}/{name}"
+
+
+def image_path(image: ImageInfo) -> str:
+    """
+    原图的本地路径, 没有 file_hash 的旧数据仍然位于 <platform>/<filename>
+    """
+    if image.file_hash:
+        return hash_path(image.file_hash, image.extension or "bin")
+    return f"{DOWNLOADS}/{image.platform}/{image.filename}"
+
+
+def compressed_path(image: ImageInfo) -> str:
+    if image.file_hash:
+        return hash_path(image.file_hash, "jpg", COMPRESSED_VARIANT)
+    return f"{DOWNLOADS}/{image.platform}/{COMPRESSED_PREFIX}{image.filename}"
+
+
+def store_file(tmp_path: str, digest: str, extension: str) -> str:
+    """
+    把下载完成的临时文件移动到内容寻址的位置
+    已经存在相同内容的文件时直接丢弃临时文件
+    """
+    path = hash_path(digest, extension)
+    if os.path.exists(path):
+        logger.debug(f"已存在相同内容的文件: {path}")
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return path
+
+
+@dataclass
+class StoredFile:
+    path: str
+    size: int
+    last_access: float
+
+
+class StorageManager:
+    """
+    data/downloads 的容量管理
+    图片的 file_id_thumb 与 file_id_original 都记录下来之后, 本地文件只在重新上传时才有用,
+    超出预算时按最近访问时间 (LRU) 淘汰这部分文件
+    访问时间记录在文件的 atime 上, 重启后依然有效
+    """
+
+    def __init__(self, root: str = DOWNLOADS, max_bytes: int = 0) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.evicted_files = 0
+        self.reclaimed_bytes = 0
+        self.last_run: float = 0
+
+    def touch(self, path: str) -> None:
+        """标记文件被访问, 只更新 atime"""
+        try:
+            st = os.stat(path)
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+
+    def scan(self) -> list[StoredFile]:
+        files: list[StoredFile] = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append(
+                    StoredFile(path, st.st_size, max(st.st_atime, st.st_mtime))
+                )
+        return files
+
+    @staticmethod
+    def is_evictable(s: OrmSession, path: str) -> bool:
+        """只有对应的 Image 都已经拿到两个 file_id, 才允许删除本地文件"""
+        if os.path.commonpath([path, TMP_ROOT]) == os.path.normpath(TMP_ROOT):
+            return False
+        if os.path.commonpath([path, HASH_ROOT]) == os.path.normpath(HASH_ROOT):
+            digest = os.path.basename(path).split(".")[0]
+            images = s.query(Image).filter_by(file_hash=digest).all()
+        else:
+            platform = os.path.basename(os.path.dirname(path))
+            filename = os.path.basename(path).removeprefix(COMPRESSED_PREFIX)
+            images = s.query(Image).filter_by(platform=platform, filename=filename).all()
+        if not images:
+            return False
+        return all(image.file_id_thumb and image.file_id_original for image in images)
+
+    async def evict(self, batch: int) -> int:
+        """
+        淘汰一批文件, 返回本次回收的字节数
+        """
+        files = await asyncio.to_thread(self.scan)
+        self.used_bytes = sum(f.size for f in files)
+        self.last_run = time.time()
+        if not self.max_bytes or self.used_bytes <= self.max_bytes:
+            return 0
+        reclaimed, evicted = await asyncio.to_thread(self.remove_files, files, batch)
+        self.used_bytes -= reclaimed
+        self.evicted_files += evicted
+        self.reclaimed_bytes += reclaimed
+        logger.info(f"存储淘汰: 删除 {evicted} 个文件, 回收 {reclaimed} 字节")
+        return reclaimed
+
+    def remove_files(self, files: list[StoredFile], batch: int) -> tuple[int, int]:
+        """
+        在线程中执行, 使用独立的 Session, 按最近访问时间删除可以淘汰的文件
+        :return: (回收的字节数, 删除的文件数)
+        """
+        reclaimed = 0
+        evicted = 0
+        with Session() as s:
+            for f in sorted(files, key=lambda f: f.last_access):
+                if self.used_bytes - reclaimed <= self.max_bytes or evicted >= batch:
+                    break
+                if not self.is_evictable(s, f.path):
+                    continue
+                try:
+                    os.remove(f.path)
+                except OSError as e:
+                    logger.warning(f"删除 {f.path} 失败: {e}")
+                    continue
+                reclaimed += f.size
+                evicted += 1
+        return reclaimed, evicted
+
+    async def run(self, interval: int, batch: int) -> None:
+        while True:
+            try:
+                # 一次只删一批, 仍然超出预算则尽快进入下一轮
+                reclaimed = await self.evict(batch)
+                await asyncio.sleep(1 if reclaimed else interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"存储淘汰出错: {e}")
+                await asyncio.sleep(interval)
+
+
+storage_manager = StorageManager(max_bytes=config.storage_max_bytes)
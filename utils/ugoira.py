@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# 帧间隔的最小单位 (ms), 即输出最高 50fps
+MIN_FRAME_UNIT = 20
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def frame_repeats(delays: list[int]) -> tuple[int, list[int]]:
+    """
+    ugoira 每帧的 delay 不同, 而管道输入只能是固定帧率
+    取 delay 的最大公约数作为帧间隔 (不小于 MIN_FRAME_UNIT), 每帧按 delay 重复若干次
+    :return: (帧间隔 ms, 每帧重复次数)
+    """
+    unit = max(reduce(math.gcd, delays), MIN_FRAME_UNIT)
+    return unit, [max(1, round(delay / unit)) for delay in delays]
+
+
+def encode_ugoira(zip_path: str, frames: list[dict[str, Any]], output_path: str) -> None:
+    """
+    在子进程中运行: 逐帧从 zip 中读出, 通过管道交给 ffmpeg 编码为 mp4
+    不解压到磁盘, 同一时间内存中只有一帧
+    """
+    unit, repeats = frame_repeats([int(frame["delay"]) for frame in frames])
+    codec = "png" if frames[0]["file"].lower().endswith(".png") else "mjpeg"
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "image2pipe", "-c:v", codec, "-framerate", f"{1000 / unit:g}", "-i", "-",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+        "-movflags", "+faststart",
+        output_path,
+    ]
+    with tempfile.TemporaryFile() as stderr, zipfile.ZipFile(zip_path) as z:
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr
+        )
+        assert process.stdin
+        try:
+            for frame, repeat in zip(frames, repeats):
+                data = z.read(frame["file"])
+                for _ in range(repeat):
+                    process.stdin.write(data)
+        finally:
+            process.stdin.close()
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg 编码失败: {stderr.read().decode(errors='ignore')}")
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn 避免在多线程的进程中 fork
+        _executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+async def encode(zip_path: str, frames: list[dict[str, Any]], tmp_root: str) -> str:
+    """
+    在工作进程中编码, 不阻塞事件循环
+    :return: 临时 mp4 文件的路径
+    """
+    os.makedirs(tmp_root, exist_ok=True)
+    output_path = f"{tmp_root}/{uuid.uuid4().hex}.mp4"
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(get_executor(), encode_ugoira, zip_path, frames, output_path)
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    return output_path
@@ -0,0 +1,92 @@
+import logging
+import time
+from collections import deque
+from typing import Optional
+from urllib.parse import urlparse
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# telegram 通过 URL 发送图片的大小上限
+URL_PHOTO_MAX_SIZE = 5 * 1024 * 1024
+# telegram 无法从 URL 拉取图片时的错误信息 (小写), 其他 BadRequest 与 URL 无关
+URL_FETCH_ERRORS = (
+    "wrong file identifier/http url specified",
+    "failed to get http url content",
+    "wrong type of the web page content",
+)
+
+
+def is_url_fetch_error(message: str) -> bool:
+    message = message.lower()
+    return any(error in message for error in URL_FETCH_ERRORS)
+
+
+class UrlUploadTracker:
+    """
+    让 telegram 直接从 URL 拉取预览图, 不经过本机下载和上传
+    按 host 统计最近的成功率, 过低时暂停该 host 的 URL 模式, cooldown 秒后再试
+    """
+
+    def __init__(
+        self,
+        hosts: list[str],
+        min_success_rate: float = 0.8,
+        min_samples: int = 5,
+        window: int = 50,
+        cooldown: int = 3600,
+    ) -> None:
+        self.hosts = hosts
+        self.min_success_rate = min_success_rate
+        self.min_samples = min_samples
+        self.window = window
+        self.cooldown = cooldown
+        self.results: dict[str, deque[bool]] = {}
+        self.disabled_until: dict[str, float] = {}
+
+    def host_of(self, url: Optional[str]) -> Optional[str]:
+        """
+        返回白名单中匹配的 host, 支持后缀匹配, 例如 hdslb.com 匹配 i0.hdslb.com
+        """
+        if not url:
+            return None
+        host = urlparse(url).hostname or ""
+        for allowed in self.hosts:
+            if host == allowed or host.endswith("." + allowed):
+                return allowed
+        return None
+
+    def accepts(self, url: Optional[str], size: Optional[int] = None) -> bool:
+        host = self.host_of(url)
+        if not host:
+            return False
+        if size and size > URL_PHOTO_MAX_SIZE:
+            return False
+        if time.time() < self.disabled_until.get(host, 0):
+            return False
+        return True
+
+    def record(self, url: str, success: bool) -> None:
+        host = self.host_of(url)
+        if not host:
+            return
+        results = self.results.setdefault(host, deque(maxlen=self.window))
+        results.append(success)
+        rate = self.success_rate(host)
+        if len(results) >= self.min_samples and rate < self.min_success_rate:
+            logger.warning(f"{host} URL 上传成功率 {rate:.0%}, 暂停 {self.cooldown} 秒")
+            self.disabled_until[host] = time.time() + self.cooldown
+            results.clear()
+
+    def success_rate(self, host: str) -> float:
+        results = self.results.get(host)
+        if not results:
+            return 1.0
+        return sum(results) / len(results)
+
+
+url_upload_tracker = UrlUploadTracker(
+    config.bot_url_upload_hosts,
+    min_success_rate=config.bot_url_upload_min_success_rate,
+)
@@ -0,0 +1,102 @@
+import re
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class ArtworkKey(NamedTuple):
+    """
+    :param platform: 与 Image.platform 一致
+    :param pid: 与 Image.pid 一致
+    :param url: 规范化后的作品链接
+    """
+    platform: str
+    pid: str
+    url: str
+
+
+TWITTER_HOSTS = {
+    "twitter.com",
+    "x.com",
+    "vxtwitter.com",
+    "fxtwitter.com",
+    "fixupx.com",
+    "fixvx.com",
+}
+MIYOUSHE_HOSTS = {"miyoushe.com", "bbs.mihoyo.com"}
+HOYOLAB_HOSTS = {"hoyolab.com"}
+BILIBILI_HOSTS = {"bilibili.com", "t.bilibili.com"}
+# 移动端等子域名, 去掉后再匹配
+HOST_PREFIXES = ("www.", "m.", "mobile.", "touch.")
+# 分享链接中常见的跟踪参数
+TRACKING_PARAMS = {"ref", "ref_src", "share_source", "spm_id_from", "vd_source"}
+
+PIXIV_PATH = re.compile(r"^/(?:[a-z]{2}/)?(?:artworks|i)/(\d+)")
+PXIMG_PATH = re.compile(r"/(\d+)_(?:p|ugoira)\d+")
+TWITTER_PATH = re.compile(r"^/(?:[^/]+|i/web)/status(?:es)?/(\d+)")
+ARTICLE_PATH = re.compile(r"article/(\d+)")
+BILIBILI_PATH = re.compile(r"^/(?:opus/|dynamic/)?(\d+)$")
+
+
+def split_url(url: str) -> tuple[str, str, str, str]:
+    """
+    :return: (去掉 www. 等前缀的 host, path, query, fragment)
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix) and host.count(".") > 1:
+            host = host[len(prefix):]
+            break
+    return host, parts.path.rstrip("/"), parts.query, parts.fragment
+
+
+def canonicalize(url: str) -> Optional[ArtworkKey]:
+    """
+    把支持的平台的各种链接形式 (查询参数、/en/、member_illust.php、移动端、vxtwitter 等) 转为作品标识
+    不支持的链接返回 None
+    """
+    if url.strip().isdigit():
+        pid = url.strip()
+        return ArtworkKey("Pixiv", pid, f"https://www.pixiv.net/artworks/{pid}")
+    host, path, query, fragment = split_url(url)
+    if host == "pixiv.net":
+        match = PIXIV_PATH.match(path)
+        pid = match[1] if match else dict(parse_qsl(query)).get("illust_id", "")
+        if pid.isdigit():
+            return ArtworkKey("Pixiv", pid, f"https://www.pixiv.net/artworks/{pid}")
+    elif host == "i.pximg.net":
+        if match := PXIMG_PATH.search(path):
+            pid = match[1]
+            return ArtworkKey("Pixiv", pid, f"https://www.pixiv.net/artworks/{pid}")
+    elif host in TWITTER_HOSTS:
+        if match := TWITTER_PATH.match(path):
+            pid = match[1]
+            return ArtworkKey("twitter", pid, f"https://twitter.com/i/web/status/{pid}")
+    elif host in MIYOUSHE_HOSTS or host in HOYOLAB_HOSTS:
+        # 移动端的文章 id 在 fragment 中, 例如 m.miyoushe.com/ys/#/article/54064752
+        if match := ARTICLE_PATH.search(f"{path}#{fragment}"):
+            pid = match[1]
+            if host in HOYOLAB_HOSTS:
+                return ArtworkKey("miyoushe", pid, f"https://www.hoyolab.com/article/{pid}")
+            return ArtworkKey("miyoushe", pid, f"https://www.miyoushe.com/ys/article/{pid}")
+    elif host in BILIBILI_HOSTS:
+        if match := BILIBILI_PATH.match(path):
+            pid = match[1]
+            return ArtworkKey("bilibili", pid, f"https://www.bilibili.com/opus/{pid}")
+    return None
+
+
+def normalize_url(url: str) -> str:
+    """
+    不支持的平台的链接只做简单的规范化: 统一 https 与 host, 去掉 fragment、末尾的 / 与跟踪参数
+    """
+    host, path, query, _ = split_url(url)
+    params = sorted(
+        (key, value)
+        for key, value in parse_qsl(query)
+        if key not in TRACKING_PARAMS and not key.startswith("utm_")
+    )
+    return urlunsplit(("https", host, path, urlencode(params), ""))
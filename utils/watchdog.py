@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def is_project_file(filename: str) -> bool:
+    filename = os.path.abspath(filename)
+    return filename.startswith(PROJECT_ROOT) and "site-packages" not in filename
+
+
+def format_frame(frame: traceback.FrameSummary) -> str:
+    return f"{os.path.relpath(frame.filename, PROJECT_ROOT)}:{frame.lineno} {frame.name}"
+
+
+class LoopWatchdog:
+    """
+    事件循环卡顿检测
+    协程定时更新心跳, 旁路线程发现心跳超过阈值没有更新时, 抓取事件循环所在线程的调用栈,
+    记录是哪个 handler 的哪一行阻塞了事件循环, 并按调用位置累计次数
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.1) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.max_lag = 0.0
+        self.stalls = 0
+        # (handler, 阻塞的代码行) -> 次数
+        self.call_sites: Counter[tuple[str, str]] = Counter()
+        self._stopped = threading.Event()
+        self._captured = False
+
+    def start(self) -> None:
+        from utils import run_in_background
+
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        run_in_background(self.beat())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"事件循环卡顿检测已开启, 阈值 {self.threshold} 秒")
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    async def beat(self) -> None:
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.max_lag = max(self.max_lag, now - start - self.interval)
+            self.heartbeat = now
+            self._captured = False
+
+    def watch(self) -> None:
+        while not self._stopped.wait(self.interval):
+            lag = time.monotonic() - self.heartbeat
+            if lag < self.threshold or self._captured:
+                continue
+            # 每次卡顿只抓取一次
+            self._captured = True
+            self.capture(lag)
+
+    def capture(self, lag: float) -> None:
+        assert self.loop_thread_id is not None
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)
+        # 只看事件循环正在执行的回调, 忽略 bot.py main -> run_polling 这一段
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].filename.endswith(os.path.join("asyncio", "events.py")):
+                stack = stack[i + 1 :]
+                break
+        project_frames = [f for f in stack if is_project_file(f.filename)]
+        if project_frames:
+            # 最外层的项目代码一般是 handler (跳过 @admin 之类的装饰器), 最内层的是阻塞的那一行
+            handlers = [f for f in project_frames if f.name != "__call__"]
+            handler = format_frame((handlers or project_frames)[0])
+            site = format_frame(project_frames[-1])
+        else:
+            handler = "?"
+            site = format_frame(stack[-1])
+        self.stalls += 1
+        self.call_sites[(handler, site)] += 1
+        logger.warning(
+            f"事件循环已阻塞 {lag:.2f} 秒, handler: {handler}, 位置: {site}\n"
+            + "".join(traceback.format_list(stack[-10:]))
+        )
+
+    def stats(self, top: int = 5) -> str:
+        lines = [f"事件循环卡顿: {self.stalls} 次, 最大延迟 {self.max_lag:.2f} 秒"]
+        for (handler, site), count in self.call_sites.most_common(top):
+            lines.append(f"  {count} 次 {site} (handler: {handler})")
+        return "\n".join(lines)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import socket
+from dataclasses import dataclass, field
+from typing import Any
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from config import config
+from commands import JOB_RUNNERS
+from entities import init_db
+from utils import bot_api_options, run_in_background
+from utils.jobs import job_queue
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WorkerContext:
+    """
+    代替 handler 的 context, 发图流程只用到 bot 与 bot_data
+    """
+
+    bot: Bot
+    bot_data: dict[Any, Any] = field(default_factory=dict)
+
+
+class Worker:
+    """
+    从任务队列领取 /post 与 /echo, 在本进程中完成获取、下载和上传
+    """
+
+    def __init__(self, bot: Bot, concurrency: int) -> None:
+        self.bot = bot
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self) -> None:
+        logger.info(f"worker {self.name} 已启动")
+        while True:
+            await self.semaphore.acquire()
+            try:
+                claimed = job_queue.claim(self.name)
+            except Exception as e:
+                logger.error(f"领取任务失败: {e}")
+                claimed = None
+            if claimed is None:
+                self.semaphore.release()
+                await asyncio.sleep(config.worker_poll_interval)
+                continue
+            run_in_background(self.execute(*claimed))
+
+    async def keep_lease(self, job_id: int) -> None:
+        while True:
+            await asyncio.sleep(config.worker_lease / 3)
+            if not job_queue.renew(job_id, self.name):
+                logger.warning(f"任务 {job_id} 的租约已被其他 worker 接手")
+
+    async def execute(self, job_id: int, kind: str, payload: dict[str, Any]) -> None:
+        logger.info(f"开始处理任务 {job_id} ({kind})")
+        keeper = asyncio.create_task(self.keep_lease(job_id))
+        try:
+            result = await JOB_RUNNERS[kind](WorkerContext(self.bot), payload)
+        except Exception as e:
+            logger.exception(f"任务 {job_id} 失败")
+            job_queue.finish(job_id, self.name, {"error": repr(e)}, failed=True)
+        else:
+            job_queue.finish(job_id, self.name, result)
+            logger.info(f"任务 {job_id} 完成")
+        finally:
+            keeper.cancel()
+            self.semaphore.release()
+
+
+async def main() -> None:
+    init_db()
+    request = HTTPXRequest(read_timeout=60, write_timeout=60, connect_timeout=60)
+    async with Bot(config.bot_token, request=request, **bot_api_options()) as bot:
+        await Worker(bot, config.worker_concurrency).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())